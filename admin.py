@@ -1,20 +1,404 @@
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
+from backends import COLLECTION, DATA_FILE, META_COLLECTION, SNAPSHOT_FILE, UPLOAD_DOCUMENT
+from connection import connection
 
+import argparse
+import codecs
 import json
+import os
+import random
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-# Login to Firebase
-cred = credentials.Certificate('cs3050-warmup-7457f-firebase-adminsdk-fbsvc-998bc9893a.json')
-firebase_admin.initialize_app(cred)
+# Firestore rejects batches with more than 500 writes
+BATCH_LIMIT = 500
+# Bytes read at a time when parsing a JSON array incrementally
+READ_SIZE = 1 << 16
+NUMERICAL_FIELDS = ("population", "num_counties")
 
-# Connect to Firestore DB
-db = firestore.client()
 
-# Load the data from JSON file
-with open('us_states_data.json', 'r') as f:
-    data = json.load(f)
+class MalformedRecord:
+    """
+    Stands in for a line of newline-delimited JSON that couldn't be decoded, so it is rejected
+    by validate and skipped like any other invalid record
+    """
 
-for item in data:
-    doc_ref = db.collection('us_states_data').document(item['uuid'])
-    doc_ref.set(item)
+    def __init__(self, error):
+        self.error = error
+
+
+def iter_ndjson(f, offset=0):
+    """
+    Reads newline-delimited JSON one record at a time
+
+    params: f - a file opened in binary mode
+            offset - the byte offset to start reading from
+    returns: a generator of (end offset, record) pairs, where record is a MalformedRecord for lines that aren't JSON
+    """
+    f.seek(offset)
+    for line in iter(f.readline, b""):
+        offset += len(line)
+        if line.strip():
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                # One bad line mustn't stop the load, or a resumed load would stop on it again
+                record = MalformedRecord("invalid JSON: %s" % e)
+            yield offset, record
+
+
+def iter_json_array(f, offset=0):
+    """
+    Parses a JSON array one element at a time so only the current element is held in memory
+
+    params: f - a file opened in binary mode
+            offset - 0, or the end offset of an element returned earlier to resume after it
+    returns: a generator of (end offset, record) pairs
+    """
+    decoder = json.JSONDecoder()
+    # Incremental so multi-byte characters split across reads decode correctly
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    f.seek(offset)
+    buffer = ""
+    # Offset of buffer[0] in the file. Only ASCII separators are skipped between elements,
+    # so byte offsets are tracked by encoding each decoded element back to UTF-8
+    buffer_offset = offset
+    expecting = "[" if offset == 0 else ","
+    eof = False
+
+    while True:
+        stripped = buffer.lstrip()
+        buffer_offset += len(buffer) - len(stripped)
+        buffer = stripped
+        if not buffer:
+            if eof:
+                raise ValueError("Unexpected end of JSON array")
+            chunk = f.read(READ_SIZE)
+            eof = not chunk
+            buffer += utf8.decode(chunk, final=eof)
+            continue
+
+        if expecting in ("[", ","):
+            if buffer[0] == "]" and expecting == ",":
+                return
+            if buffer[0] != expecting:
+                raise ValueError("Expected %r at byte %d" % (expecting, buffer_offset))
+            buffer = buffer[1:]
+            buffer_offset += 1
+            expecting = "element"
+            continue
+
+        if buffer[0] == "]":
+            return
+        try:
+            record, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            # The element continues past the end of the buffer
+            if eof:
+                raise
+            chunk = f.read(READ_SIZE)
+            eof = not chunk
+            buffer += utf8.decode(chunk, final=eof)
+            continue
+
+        if end == len(buffer) and not eof:
+            # A number can decode from a prefix of itself when a read ends inside it
+            chunk = f.read(READ_SIZE)
+            eof = not chunk
+            buffer += utf8.decode(chunk, final=eof)
+            continue
+
+        buffer_offset += len(buffer[:end].encode("utf-8"))
+        buffer = buffer[end:]
+        expecting = ","
+        yield buffer_offset, record
+
+
+def iter_records(path, offset=0):
+    """
+    Streams records from a JSON array or newline-delimited JSON file, choosing the format from its first character
+
+    params: path - the dataset file
+            offset - a checkpoint offset to resume from
+    returns: a generator of (end offset, record) pairs
+    """
+    with open(path, "rb") as f:
+        first = f.read(READ_SIZE).lstrip()[:1]
+        if first == b"[":
+            yield from iter_json_array(f, offset)
+        else:
+            yield from iter_ndjson(f, offset)
+
+
+def validate(record):
+    """
+    Checks that a record can be uploaded
+
+    params: record - a decoded record
+    returns: an error message, or None if the record is valid
+    """
+    if isinstance(record, MalformedRecord):
+        return record.error
+    if not isinstance(record, dict):
+        return "record is not an object"
+    if not isinstance(record.get("uuid"), str) or not record["uuid"]:
+        return "record has no uuid"
+    for field in NUMERICAL_FIELDS:
+        if field in record and not isinstance(record[field], int):
+            return "%s is not an integer" % field
+    return None
+
+
+def read_checkpoint(checkpoint_file, path):
+    """
+    Reads the offset an interrupted upload of path reached
+
+    params: checkpoint_file - the checkpoint file
+            path - the dataset file being uploaded
+    returns: the byte offset to resume from, or 0 to start over
+    """
+    try:
+        with open(checkpoint_file, "r") as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return 0
+    if checkpoint.get("file") != os.path.abspath(path):
+        return 0
+    return checkpoint["offset"]
+
+
+def write_checkpoint(checkpoint_file, path, offset):
+    """
+    Atomically records how far an upload has got
+
+    params: checkpoint_file - the checkpoint file
+            path - the dataset file being uploaded
+            offset - the byte offset every earlier record has been written up to
+    """
+    tmp_file = checkpoint_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"file": os.path.abspath(path), "offset": offset}, f)
+    os.replace(tmp_file, checkpoint_file)
+
+
+def chunked(records, size):
+    """
+    Splits records into lists of at most size records
+
+    params: records - an iterable of records
+            size - the maximum number of records per chunk
+    returns: a generator of lists of records
+    """
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def write_chunk(db, chunk, collection=COLLECTION, mode="upsert", retries=5, backoff=0.5):
+    """
+    Writes a chunk of records in a single batched write, retrying transient failures with exponential backoff.
+    Documents are keyed on uuid so writing the same chunk twice is safe
+
+    params: db - the Firestore client
+            chunk - a list of at most 500 records
+            collection - the collection to write to
+            mode - "upsert" merges into existing documents, "replace" overwrites them
+            retries - how many times to retry a failed commit
+            backoff - the delay in seconds before the first retry, doubled after each attempt
+    returns: the number of documents written
+    """
+    from google.api_core import exceptions
+
+    transient = (exceptions.Aborted, exceptions.DeadlineExceeded, exceptions.InternalServerError,
+                 exceptions.ResourceExhausted, exceptions.ServiceUnavailable)
+    collection_ref = db.collection(collection)
+    for attempt in range(retries + 1):
+        batch = db.batch()
+        for item in chunk:
+            batch.set(collection_ref.document(item['uuid']), item, merge=(mode == "upsert"))
+        try:
+            batch.commit()
+            return len(chunk)
+        except transient:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt + random.uniform(0, backoff))
+
+
+def load_chunks(db, chunks, collection=COLLECTION, workers=4, mode="upsert", retries=5, on_commit=None):
+    """
+    Commits chunks concurrently while keeping at most two chunks per worker in memory
+
+    params: db - the Firestore client
+            chunks - an iterable of (chunk, end offset) pairs
+            collection - the collection to write to
+            workers - the number of batches committed at the same time
+            mode - "upsert" or "replace"
+            retries - how many times to retry each failed batch
+            on_commit - called in file order with the end offset of each committed chunk
+    returns: the number of documents written
+    """
+    written = 0
+    pending = deque()
+
+    def finish_oldest():
+        future, end_offset = pending.popleft()
+        count = future.result()
+        if on_commit is not None:
+            on_commit(end_offset)
+        return count
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk, end_offset in chunks:
+            pending.append((executor.submit(write_chunk, db, chunk, collection, mode, retries), end_offset))
+            if len(pending) >= workers * 2:
+                written += finish_oldest()
+        while pending:
+            written += finish_oldest()
+    return written
+
+
+def bulk_load(db, records, collection=COLLECTION, chunk_size=BATCH_LIMIT, workers=4, mode="upsert", retries=5):
+    """
+    Uploads records as concurrent batched writes
+
+    params: db - the Firestore client
+            records - an iterable of records, each with a uuid
+            collection - the collection to write to
+            chunk_size - the number of documents per batch (at most 500)
+            workers - the number of batches committed at the same time
+            mode - "upsert" or "replace"
+            retries - how many times to retry each failed batch
+    returns: the number of documents written and the elapsed time in seconds
+    """
+    chunk_size = min(chunk_size, BATCH_LIMIT)
+    start = time.perf_counter()
+    chunks = ((chunk, None) for chunk in chunked(records, chunk_size))
+    written = load_chunks(db, chunks, collection, workers, mode, retries)
+    return written, time.perf_counter() - start
+
+
+def stream_load(db, path, collection=COLLECTION, chunk_size=BATCH_LIMIT, workers=4, mode="upsert", retries=5,
+                checkpoint_file=None):
+    """
+    Streams a JSON array or NDJSON file into Firestore in constant memory. With a checkpoint file, the
+    offset of the last committed record is saved after every batch and an interrupted upload resumes from it
+
+    params: db - the Firestore client
+            path - the dataset file
+            collection - the collection to write to
+            chunk_size - the number of documents per batch (at most 500)
+            workers - the number of batches committed at the same time
+            mode - "upsert" or "replace"
+            retries - how many times to retry each failed batch
+            checkpoint_file - where to save progress, or None
+    returns: the number of documents written, the number of invalid records skipped and the elapsed time in seconds
+    """
+    chunk_size = min(chunk_size, BATCH_LIMIT)
+    offset = read_checkpoint(checkpoint_file, path) if checkpoint_file else 0
+    rejected = 0
+
+    def valid_chunks():
+        nonlocal rejected
+        chunk, end_offset = [], offset
+        for end_offset, record in iter_records(path, offset):
+            error = validate(record)
+            if error:
+                rejected += 1
+                print("Skipping record ending at byte %d: %s" % (end_offset, error))
+                continue
+            chunk.append(record)
+            if len(chunk) == chunk_size:
+                yield chunk, end_offset
+                chunk = []
+        if chunk:
+            yield chunk, end_offset
+
+    on_commit = None
+    if checkpoint_file:
+        def on_commit(end_offset):
+            write_checkpoint(checkpoint_file, path, end_offset)
+
+    start = time.perf_counter()
+    written = load_chunks(db, valid_chunks(), collection, workers, mode, retries, on_commit)
+    return written, rejected, time.perf_counter() - start
+
+
+def bump_generation(db):
+    """
+    Bumps the upload generation so query engines drop their cached results
+
+    params: db - the Firestore client
+    """
+    from google.cloud.firestore_v1 import Increment, SERVER_TIMESTAMP
+
+    db.collection(META_COLLECTION).document(UPLOAD_DOCUMENT).set(
+        {"generation": Increment(1), "uploaded_at": SERVER_TIMESTAMP}, merge=True)
+
+
+def export_main(argv):
+    from snapshot import export_snapshot, write_snapshot
+
+    arg_parser = argparse.ArgumentParser(prog="admin.py export-snapshot",
+                                         description="Write the collection, its indexes and statistics to a snapshot "
+                                                     "file that query.py --snapshot memory-maps at startup")
+    arg_parser.add_argument("--output", default=SNAPSHOT_FILE, help="the snapshot file to write")
+    arg_parser.add_argument("--collection", default=COLLECTION)
+    arg_parser.add_argument("--from-file", metavar="FILE",
+                            help="build the snapshot from a dataset file instead of Firestore; it is refreshed "
+                                 "from Firestore the first time query.py can connect")
+    args = arg_parser.parse_args(argv)
+
+    start = time.perf_counter()
+    if args.from_file:
+        written = write_snapshot(args.output, (record for _, record in iter_records(args.from_file)
+                                              if validate(record) is None),
+                                 collection=args.collection)
+    else:
+        written = export_snapshot(args.output, connection.client(), args.collection)
+    print("Wrote %d documents to %s in %.2f s (%d bytes)" % (written, args.output, time.perf_counter() - start,
+                                                            os.path.getsize(args.output)))
+
+
+def main():
+    if sys.argv[1:2] == ["export-snapshot"]:
+        export_main(sys.argv[2:])
+        return
+
+    arg_parser = argparse.ArgumentParser(description="Upload the state dataset to Firestore",
+                                         epilog="Run 'admin.py export-snapshot --help' to write an offline snapshot")
+    arg_parser.add_argument("file", nargs="?", default=DATA_FILE,
+                            help="JSON array or newline-delimited JSON file of records")
+    arg_parser.add_argument("--collection", default=COLLECTION)
+    arg_parser.add_argument("--chunk-size", type=int, default=BATCH_LIMIT, help="documents per batched write (max 500)")
+    arg_parser.add_argument("--workers", type=int, default=4, help="batches committed concurrently")
+    arg_parser.add_argument("--mode", choices=["upsert", "replace"], default="upsert",
+                            help="merge into existing documents or overwrite them")
+    arg_parser.add_argument("--retries", type=int, default=5, help="retries per batch for transient errors")
+    arg_parser.add_argument("--checkpoint", help="file used to save progress and resume an interrupted upload")
+    args = arg_parser.parse_args()
+
+    # Login to Firebase and connect to Firestore DB through the same client the query engine uses.
+    # Set FIRESTORE_EMULATOR_HOST to load into a local emulator instead
+    db = connection.client()
+
+    # Stream the data from the file in batches
+    written, rejected, seconds = stream_load(db, args.file, args.collection, args.chunk_size, args.workers,
+                                             args.mode, args.retries, args.checkpoint)
+    bump_generation(db)
+    print("Uploaded %d documents in %.2f s (%.0f docs/sec)" % (written, seconds, written / seconds if seconds else 0))
+    if rejected:
+        print("Skipped %d invalid records" % rejected)
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        # The upload finished, so the next run starts from the beginning
+        os.remove(args.checkpoint)
+
+
+if __name__ == "__main__":
+    main()
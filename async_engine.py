@@ -0,0 +1,170 @@
+import asyncio
+import json
+import time
+from backends import AnyOf, FirestoreBackend, Select, conjunction_filter, matches_all, project, select_fields
+from query import StateQueryEngine
+
+
+class AsyncFirestoreBackend(FirestoreBackend):
+    """
+    FirestoreBackend that runs its queries on the asyncio Firestore client. It plans
+    queries the same way, but when a compound query has to fall back to one query
+    per clause the clauses are issued at the same time
+    """
+
+    async def fetch_async(self, field, op, value, limiter, fields=None):
+        """
+        Retrieves the records matching a single comparison
+
+        params: field - the field to filter on
+                op - the comparison operator
+                value - the already coerced value to compare against
+                limiter - semaphore bounding the number of requests in flight
+                fields - the fields to return for each record, or None for every field
+        returns: a dictionary of matching records keyed on uuid
+        """
+        db = self.connection.async_client()
+        async with limiter:
+            start = time.perf_counter()
+            query = db.collection(self.collection).where(filter=conjunction_filter([(field, op, value)]))
+            selected = select_fields(fields)
+            if selected is not None:
+                query = query.select(selected)
+            records = {doc.id: doc.to_dict() async for doc in query.stream()}
+            self.connection.record_query(time.perf_counter() - start)
+        return records
+
+    async def execute_async(self, subqueries, limiter, fields=None):
+        """
+        Retrieves the records matching every subquery of a (possibly compound) query
+
+        params: subqueries - a list of [field, operator, value] subqueries
+                limiter - semaphore bounding the number of requests in flight
+                fields - the fields to return for each record, or None for every field
+        returns: a list of matching records
+        """
+        from google.api_core.exceptions import FailedPrecondition
+
+        if not subqueries:
+            return []
+        db = self.connection.async_client()
+
+        plan = self.plan(subqueries)
+        query = db.collection(self.collection).where(filter=conjunction_filter(plan.pushed))
+        selected = select_fields(fields, plan.residual)
+        if selected is not None:
+            query = query.select(selected)
+        try:
+            async with limiter:
+                start = time.perf_counter()
+                records = [doc.to_dict() async for doc in query.stream()]
+                self.connection.record_query(time.perf_counter() - start)
+        except FailedPrecondition:
+            # Without a composite index, run every clause at once and intersect the results
+            doc_sets = await asyncio.gather(*(self.fetch_async(*subquery, limiter, fields)
+                                              for subquery in subqueries))
+            common_doc_ids = set(doc_sets[0].keys())
+            for doc_set in doc_sets[1:]:
+                common_doc_ids.intersection_update(doc_set.keys())
+            return [doc_sets[0][doc_uuid] for doc_uuid in common_doc_ids]
+
+        self.last_plan = plan
+        return [project(record, fields) for record in records if matches_all(record, plan.residual)]
+
+
+class AsyncStateQueryEngine(StateQueryEngine):
+    """
+    StateQueryEngine whose queries run on an asyncio event loop. Backends without an
+    execute_async method are run in a worker thread, and at most concurrency
+    queries are in flight at once
+    """
+
+    def __init__(self, backend=None, result_cache=None, concurrency=16):
+        super().__init__(backend if backend is not None else AsyncFirestoreBackend(), result_cache)
+        self.concurrency = concurrency
+        self._limiter = None
+
+    def limiter(self):
+        """
+        Returns the semaphore bounding concurrent queries, created in the running event loop
+
+        returns: the asyncio.Semaphore
+        """
+        if self._limiter is None:
+            self._limiter = asyncio.Semaphore(self.concurrency)
+        return self._limiter
+
+    async def run_query_async(self, parsed_query, fields=None):
+        """
+        Retrieves the documents that satisfy every subquery, reusing cached results for repeated queries
+
+        params: parsed_query - a list of [field, operator, value] subqueries, an AnyOf of them, or a Select
+                fields - the fields to return for each record, or None for every field
+        returns: a list of matching records, or the value of a Select's aggregate
+        """
+        self.normalize_query(parsed_query)
+        cache_key = self.result_cache.key(parsed_query, fields)
+        generation = self.backend.generation()
+        records = self.result_cache.get(cache_key, generation)
+        if records is None:
+            if hasattr(self.backend, "execute_async") and not isinstance(parsed_query, (AnyOf, Select)):
+                records = await self.backend.execute_async(parsed_query, self.limiter(), fields)
+            else:
+                if isinstance(parsed_query, Select):
+                    execute = self.backend.execute_select
+                elif isinstance(parsed_query, AnyOf):
+                    execute = self.backend.execute_any
+                else:
+                    execute = self.backend.execute
+                async with self.limiter():
+                    loop = asyncio.get_running_loop()
+                    records = await loop.run_in_executor(None, execute, parsed_query, fields)
+            self.result_cache.put(cache_key, records, generation)
+        return records
+
+    async def answer_batch_query_async(self, parsed_query, cursor=None):
+        """
+        Async version of answer_batch_query. Pages are read in a worker thread
+
+        params: parsed_query - the parsed query
+                cursor - the token of the page to return, or None for the first page
+        returns: the fields to add to the query's result
+        """
+        if not self.pages(parsed_query):
+            return {"results": await self.run_query_async(parsed_query)}
+        async with self.limiter():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.answer_batch_query, parsed_query, cursor)
+
+    async def run_batch_async(self, lines, out):
+        """
+        Async version of run_batch: writes one JSON result per query, in input order, running
+        identical queries once and distinct queries concurrently
+
+        params: lines - an iterable of queries, one per line (blank lines and lines starting with # are skipped).
+                        A line can also be {"query": ..., "cursor": ...} to resume a paged query
+                out - a text stream the results are written to
+        returns: the number of queries answered
+        """
+        queries = []  # (query text, cache key, parse error)
+        tasks = {}
+        for text, cursor, parsed_query, error in self.read_batch(lines):
+            if error is not None:
+                queries.append((text, None, error))
+                continue
+            key = (self.result_cache.key(self.normalize_query(parsed_query)), cursor)
+            if key not in tasks:
+                tasks[key] = asyncio.ensure_future(self.answer_batch_query_async(parsed_query, cursor))
+            queries.append((text, key, None))
+
+        for text, key, error in queries:
+            result = {"query": text}
+            if error is None:
+                try:
+                    result.update(await tasks[key])
+                except Exception as e:
+                    error = "Could not retrieve records from the database: %s" % e
+            if error is not None:
+                result["error"] = error
+            out.write(json.dumps(result, default=str) + "\n")
+        return len(queries)
@@ -0,0 +1,1458 @@
+import base64
+import bisect
+import binascii
+import heapq
+import json
+import operator
+import threading
+import time
+from connection import connection as shared_connection
+from tracing import NULL_TRACER
+
+DATA_FILE = "us_states_data.json"
+# Written by admin.py export-snapshot
+SNAPSHOT_FILE = "us_states_data.snapshot"
+COLLECTION = "us_states_data"
+# admin.py bumps the generation stored in this document after every upload
+META_COLLECTION = "us_states_meta"
+UPLOAD_DOCUMENT = "upload"
+
+CATEGORICAL_FIELDS = ("region", "capital", "governor", "state", "state_bird", "popular_food")
+NUMERICAL_FIELDS = ("population", "num_counties")
+
+OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+# between and startswith run as a pair of range filters in Firestore, so they count as inequalities
+INEQUALITY_OPERATORS = ("!=", "<", "<=", ">", ">=", "between", "startswith")
+# Firestore limits an in filter, and the branches of an Or filter, to 30 values
+MAX_DISJUNCTIONS = 30
+# Sorts after every character Firestore stores, so [prefix, prefix + PREFIX_END) is a prefix match
+PREFIX_END = "\uf8ff"
+# count takes no field; the others reduce a numerical field
+AGGREGATES = ("count", "sum", "avg", "min", "max")
+
+
+class AnyOf(list):
+    """
+    A query with || in it, kept as a list of branches. Each branch is a list of [field, operator, value]
+    subqueries joined by &&, and a record matches the query if it matches any branch.
+    Queries without || stay plain lists of subqueries
+    """
+
+
+class Select:
+    """
+    A query that reduces or ranks the records matching a filter instead of listing all of them:
+    an aggregate (count, or sum/avg/min/max of a numerical field), an order, and a limit. The
+    aggregate is computed over the ordered and limited records, so 'sum(population) order by
+    population desc limit 5' adds up the five largest populations
+    """
+
+    def __init__(self, where, aggregate=None, field=None, order_by=None, descending=False, limit=None):
+        # A list of [field, operator, value] subqueries, an AnyOf of them, or [] for every state
+        self.where = where
+        self.aggregate = aggregate
+        self.field = field
+        self.order_by = order_by
+        self.descending = descending
+        self.limit = limit
+
+    def ranked(self):
+        """
+        Tells whether the records have to be ordered or cut off before they are returned or reduced
+
+        returns: True if the select has an order or a limit
+        """
+        return self.order_by is not None or self.limit is not None
+
+    def label(self):
+        """
+        Formats the aggregate, order and limit for display
+
+        returns: e.g. "sum(population) order by population desc limit 5"
+        """
+        parts = []
+        if self.aggregate == "count":
+            parts.append("count")
+        elif self.aggregate is not None:
+            parts.append("%s(%s)" % (self.aggregate, self.field))
+        if self.order_by is not None:
+            parts.append("order by %s%s" % (self.order_by, " desc" if self.descending else ""))
+        if self.limit is not None:
+            parts.append("limit %d" % self.limit)
+        return " ".join(parts)
+
+    def key(self):
+        """
+        Identifies everything but the filter, for cache keys
+
+        returns: a hashable tuple
+        """
+        return (self.aggregate, self.field, self.order_by, self.descending, self.limit)
+
+    def to_dict(self):
+        """
+        Converts the select to a JSON-friendly dictionary, e.g. for the query server
+        """
+        where = [[list(subquery) for subquery in branch] for branch in self.where] \
+            if isinstance(self.where, AnyOf) else [list(subquery) for subquery in self.where]
+        return {"where": where, "any_of": isinstance(self.where, AnyOf), "aggregate": self.aggregate,
+                "field": self.field, "order_by": self.order_by, "descending": self.descending, "limit": self.limit}
+
+    @classmethod
+    def from_dict(cls, body):
+        """
+        Rebuilds a select from Select.to_dict
+
+        params: body - the dictionary
+        returns: the Select (raises ValueError if the aggregate, field, order or limit isn't valid)
+        """
+        if not isinstance(body, dict):
+            raise ValueError("a select must be an object, got %r" % (body,))
+        aggregate, field = body.get("aggregate"), body.get("field")
+        order_by, limit = body.get("order_by"), body.get("limit")
+        if aggregate is not None and aggregate not in AGGREGATES:
+            raise ValueError("unknown aggregate %r" % (aggregate,))
+        if aggregate not in (None, "count") and field not in NUMERICAL_FIELDS:
+            raise ValueError("%s needs a numerical field, got %r" % (aggregate, field))
+        if order_by is not None and order_by not in CATEGORICAL_FIELDS + NUMERICAL_FIELDS:
+            raise ValueError("unknown order by field %r" % (order_by,))
+        if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 0):
+            raise ValueError("limit must be a non-negative integer, got %r" % (limit,))
+        if body.get("any_of"):
+            where = AnyOf([[list(subquery) for subquery in branch] for branch in body["where"]])
+        else:
+            where = [list(subquery) for subquery in body.get("where", [])]
+        return cls(where, aggregate, field if aggregate not in (None, "count") else None, order_by,
+                   bool(body.get("descending")), limit)
+
+
+def compare(left, op, right):
+    """
+    Applies a query operator the way Firestore does, where values of different types never match
+
+    params: left - the stored value
+            op - one of the query operators (==, !=, <, <=, >, >=, in, between, startswith)
+            right - the value from the query: a tuple of values for in, a (low, high) pair for between
+    returns: True if the stored value satisfies the comparison
+    """
+    if op == "in":
+        return any(compare(left, "==", item) for item in right)
+    elif op == "between":
+        return compare(left, ">=", right[0]) and compare(left, "<=", right[1])
+    elif op == "startswith":
+        return isinstance(left, str) and isinstance(right, str) and left.startswith(right)
+    if isinstance(left, int) != isinstance(right, int):
+        return False
+    return OPERATORS[op](left, right)
+
+
+def field_filters(field, op, value):
+    """
+    Translates a subquery into Firestore filters
+
+    params: field - the field to filter on
+            op - the query operator
+            value - the already coerced value to compare against
+    returns: a list of FieldFilters that all have to match
+    """
+    from google.cloud.firestore_v1 import FieldFilter
+
+    if op == "in":
+        return [FieldFilter(field, "in", list(value))]
+    elif op == "between":
+        return [FieldFilter(field, ">=", value[0]), FieldFilter(field, "<=", value[1])]
+    elif op == "startswith":
+        return [FieldFilter(field, ">=", value), FieldFilter(field, "<", value + PREFIX_END)]
+    return [FieldFilter(field, op, value)]
+
+
+def conjunction_filter(subqueries):
+    """
+    Combines subqueries into a single Firestore filter
+
+    params: subqueries - a list of [field, operator, value] subqueries
+    returns: a FieldFilter, or an And of them
+    """
+    from google.cloud.firestore_v1 import And
+
+    filters = [query_filter for subquery in subqueries for query_filter in field_filters(*subquery)]
+    return filters[0] if len(filters) == 1 else And(filters=filters)
+
+
+class QueryPlan:
+    """
+    Describes how a compound query is run: the subqueries sent to the store as a
+    single query and the ones checked in memory against the returned records
+    """
+
+    def __init__(self, strategy, pushed, residual):
+        self.strategy = strategy
+        self.pushed = pushed
+        self.residual = residual
+        # Filled in by QueryBackend.explain: (subquery, access path, estimate) in execution order, and caveats
+        self.steps = []
+        self.notes = []
+
+    def describe(self):
+        """
+        Formats the plan for display
+
+        returns: a multi-line description of the plan
+        """
+        lines = ["Plan: %s" % self.strategy]
+        if self.steps:
+            for number, ((field, op, value), access, estimate) in enumerate(self.steps, 1):
+                clause = "%s %s %r" % (field, op, value)
+                cardinality = "unknown" if estimate is None else str(estimate)
+                lines.append("  %d. %-36s %-40s est. rows: %s" % (number, clause, access, cardinality))
+        else:
+            for field, op, value in self.pushed:
+                lines.append("  store filter:       %s %s %r" % (field, op, value))
+            for field, op, value in self.residual:
+                lines.append("  client-side filter: %s %s %r" % (field, op, value))
+        for note in self.notes:
+            lines.append("  note: %s" % note)
+        return "\n".join(lines)
+
+
+def matches_all(record, subqueries):
+    """
+    Checks a record against subqueries in memory. Records missing a field never match a filter on it
+
+    params: record - a state record
+            subqueries - a list of [field, operator, value] subqueries
+    returns: True if the record satisfies every subquery
+    """
+    return all(field in record and compare(record[field], op, value)
+               for field, op, value in subqueries)
+
+
+def project(record, fields):
+    """
+    Keeps only the requested fields of a record
+
+    params: record - a state record
+            fields - the fields to keep, or None to keep every field
+    returns: the projected record
+    """
+    if fields is None:
+        return record
+    return {field: record[field] for field in fields if field in record}
+
+
+def select_fields(fields, residual=()):
+    """
+    Lists the fields to request from Firestore: the requested fields, the uuid, and any
+    field a client-side filter still has to check
+
+    params: fields - the fields the caller needs, or None for every field
+            residual - the subqueries filtered client-side
+    returns: a sorted list of field paths, or None to fetch whole documents
+    """
+    if fields is None:
+        return None
+    return sorted(set(fields) | {"uuid"} | {field for field, _, _ in residual})
+
+
+def reduce_values(values, aggregate):
+    """
+    Computes an aggregate of numerical values
+
+    params: values - a list of integers
+            aggregate - count, sum, avg, min or max
+    returns: the aggregate; avg, min and max of no values are None, like in Firestore
+    """
+    if aggregate == "count":
+        return len(values)
+    elif aggregate == "sum":
+        return sum(values)
+    elif not values:
+        return None
+    elif aggregate == "avg":
+        return sum(values) / len(values)
+    return min(values) if aggregate == "min" else max(values)
+
+
+def reduce_records(records, aggregate, field=None):
+    """
+    Computes an aggregate of records. Like Firestore, sum/avg/min/max skip records where the field
+    is missing or not a number
+
+    params: records - an iterable of state records
+            aggregate - count, sum, avg, min or max
+            field - the numerical field to reduce (unused for count)
+    returns: the aggregate
+    """
+    if aggregate == "count":
+        return sum(1 for _ in records)
+    values = [record[field] for record in records
+              if isinstance(record.get(field), int) and not isinstance(record.get(field), bool)]
+    return reduce_values(values, aggregate)
+
+
+def top_k(records, order_by, descending=False, limit=None):
+    """
+    Orders records the way Firestore does: records without the order field are left out, and ties
+    (or every record, without an order field) are ordered by uuid. With a limit only the first
+    records are kept, using a heap of that size rather than sorting everything
+
+    params: records - an iterable of state records
+            order_by - the field to order on, or None to order by uuid
+            descending - True for largest first
+            limit - the number of records to keep, or None for all of them
+    returns: a list of records
+    """
+    if order_by is None:
+        def sort_key(record):
+            return record["uuid"]
+    else:
+        records = (record for record in records if order_by in record)
+
+        def sort_key(record):
+            return record[order_by], record["uuid"]
+    if limit is None:
+        return sorted(records, key=sort_key, reverse=descending)
+    pick = heapq.nlargest if descending else heapq.nsmallest
+    return pick(limit, records, key=sort_key)
+
+
+def select_needs(select, fields):
+    """
+    Lists the fields a Select has to read: the requested fields plus the ones it orders on and reduces
+
+    params: select - the Select
+            fields - the fields the caller needs, or None for every field
+    returns: a tuple of field names, or None for whole records
+    """
+    if fields is None:
+        return None
+    extra = [field for field in ("uuid", select.order_by, select.field) if field is not None and field not in fields]
+    return tuple(fields) + tuple(extra)
+
+
+def encode_cursor(values):
+    """
+    Turns the sort key of the last record of a page into an opaque token the next page starts after
+
+    params: values - the record's values for the fields the pages are ordered on, ending with its uuid
+    returns: a URL-safe string
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(token, length=None):
+    """
+    Reads a token made by encode_cursor
+
+    params: token - the cursor token
+            length - the number of values the backend orders pages on, or None to accept any
+    returns: the list of values (raises ValueError if the token is malformed or belongs to another kind of query)
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError("Invalid cursor %r" % token)
+    if not isinstance(values, list) or not values or (length is not None and len(values) != length):
+        raise ValueError("Cursor %r doesn't belong to this query" % token)
+    return values
+
+
+def page_of(candidates, page_size, sort_key):
+    """
+    Picks the first page_size candidates with a heap, plus one more to tell whether there is a next page
+
+    params: candidates - an iterable of records or row ids
+            page_size - the number of records per page
+            sort_key - the key the pages are ordered on
+    returns: (the page, True if more candidates follow it)
+    """
+    page = heapq.nsmallest(page_size + 1, candidates, key=sort_key)
+    return page[:page_size], len(page) > page_size
+
+
+class Statistics:
+    """
+    Cardinality statistics for the dataset: the number of records holding each value of
+    every categorical field, and the sorted values of every numerical field
+    """
+
+    def __init__(self, records):
+        self.count = 0
+        self.value_counts = {field: {} for field in CATEGORICAL_FIELDS}
+        self.sorted_values = {field: [] for field in NUMERICAL_FIELDS}
+        for record in records:
+            self.count += 1
+            for field, counts in self.value_counts.items():
+                if field in record:
+                    counts[record[field]] = counts.get(record[field], 0) + 1
+            for field, values in self.sorted_values.items():
+                if field in record:
+                    values.append(record[field])
+        for values in self.sorted_values.values():
+            values.sort()
+
+    @classmethod
+    def from_file(cls, data_file=DATA_FILE):
+        """
+        Computes statistics from a JSON dataset such as the one admin.py uploads
+
+        params: data_file - path to the JSON array of records
+        returns: the Statistics, or None if the file doesn't exist
+        """
+        try:
+            with open(data_file, "r") as f:
+                return cls(json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def estimate(self, field, op, value):
+        """
+        Estimates how many records match a single comparison
+
+        params: field - the field to filter on
+                op - the comparison operator
+                value - the already coerced value to compare against
+        returns: the estimated number of matching records
+        """
+        if field in self.sorted_values:
+            return count_sorted_range(self.sorted_values[field], op, value)
+        counts = self.value_counts.get(field, {})
+        if op == "==":
+            return counts.get(value, 0)
+        elif op == "in":
+            return sum(counts.get(item, 0) for item in set(value))
+        return sum(count for key, count in counts.items() if compare(key, op, value))
+
+
+def sorted_range(values, op, value):
+    """
+    Finds the slices of a sorted list of integers that satisfy a comparison
+
+    params: values - the sorted values
+            op - the comparison operator
+            value - the value to compare against
+    returns: a list of (start, end) slice bounds
+    """
+    if op == "in":
+        return [bounds for item in sorted(set(value), key=repr) for bounds in sorted_range(values, "==", item)]
+    elif op == "between":
+        low, high = value
+        if not isinstance(low, int) or not isinstance(high, int) or low > high:
+            return []
+        return [(bisect.bisect_left(values, low), bisect.bisect_right(values, high))]
+    if not isinstance(value, int) or op == "startswith":
+        return []
+    left = bisect.bisect_left(values, value)
+    right = bisect.bisect_right(values, value)
+    if op == "==":
+        return [(left, right)]
+    elif op == "!=":
+        return [(0, left), (right, len(values))]
+    elif op == "<":
+        return [(0, left)]
+    elif op == "<=":
+        return [(0, right)]
+    elif op == ">":
+        return [(right, len(values))]
+    else:
+        return [(left, len(values))]
+
+
+def count_sorted_range(values, op, value):
+    """
+    Counts the entries of a sorted list of integers that satisfy a comparison
+
+    params: values - the sorted values
+            op - the comparison operator
+            value - the value to compare against
+    returns: the number of matching entries
+    """
+    return sum(end - start for start, end in sorted_range(values, op, value))
+
+
+class QueryBackend:
+    """
+    Interface between StateQueryEngine and the store that holds the state records.
+    Subclasses implement fetch for a single comparison; execute combines the
+    subqueries of a compound query.
+    """
+    last_plan = None
+    # StateQueryEngine.set_tracer replaces this when profiling is on
+    tracer = NULL_TRACER
+
+    def connect(self):
+        """
+        Prepares the backend for queries. Backends that need no setup leave this as a no-op
+        """
+
+    def warm_up(self):
+        """
+        Does any expensive one-time setup ahead of the first query
+        """
+        self.connect()
+
+    def generation(self):
+        """
+        Identifies the current version of the data so cached results can be invalidated when it changes
+
+        returns: a value that changes whenever the data does, or None if the backend can't tell
+        """
+        return None
+
+    def fetch(self, field, op, value):
+        """
+        Retrieves the records matching a single comparison
+
+        params: field - the field to filter on
+                op - the comparison operator
+                value - the already coerced value to compare against
+        returns: a dictionary of matching records keyed on uuid
+        """
+        raise NotImplementedError
+
+    def estimate(self, field, op, value):
+        """
+        Estimates how many records match a single comparison
+
+        params: field - the field to filter on
+                op - the comparison operator
+                value - the already coerced value to compare against
+        returns: the estimated number of matching records, or None if the backend keeps no statistics
+        """
+        return None
+
+    def order_by_selectivity(self, subqueries):
+        """
+        Orders subqueries from the fewest to the most estimated matches
+
+        params: subqueries - a list of [field, operator, value] subqueries
+        returns: a list of (estimate, subquery) pairs, in original order if there are no statistics
+        """
+        estimates = [(self.estimate(*subquery), tuple(subquery)) for subquery in subqueries]
+        if any(estimate is None for estimate, _ in estimates):
+            return estimates
+        return sorted(estimates, key=lambda pair: pair[0])
+
+    def plan(self, subqueries):
+        """
+        Runs the most selective subquery against the store and checks the rest in memory
+        against the records it returns
+
+        params: subqueries - a list of [field, operator, value] subqueries
+        returns: the QueryPlan for the query
+        """
+        ordered = [subquery for _, subquery in self.order_by_selectivity(subqueries)]
+        return QueryPlan("most selective clause + in-memory filter", ordered[:1], ordered[1:])
+
+    def execute_any(self, branches, fields=None):
+        """
+        Retrieves the records matching any branch of a query with ||. Branches are run one at a
+        time and the results are merged on uuid, so a record matching several branches is kept once
+
+        params: branches - an AnyOf of lists of [field, operator, value] subqueries
+                fields - the fields to return for each record, or None for every field
+        returns: a list of matching records
+        """
+        records = {}
+        for branch in branches:
+            for record in self.execute(branch, fields):
+                records.setdefault(record["uuid"], record)
+        return list(records.values())
+
+    def union_strategy(self, branches):
+        """
+        Describes how execute_any combines the branches of a query with ||
+
+        params: branches - an AnyOf of lists of [field, operator, value] subqueries
+        returns: a short description
+        """
+        return "each branch run separately, results merged on uuid"
+
+    def all_records(self, fields=None):
+        """
+        Retrieves every record, for selects without a filter such as 'count'
+
+        params: fields - the fields to return for each record, or None for every field
+        returns: a list of records
+        """
+        raise NotImplementedError
+
+    def select_records(self, where, fields=None):
+        """
+        Retrieves the records a Select filters on
+
+        params: where - a list of [field, operator, value] subqueries, an AnyOf of them, or [] for every record
+                fields - the fields to return for each record, or None for every field
+        returns: a list of matching records
+        """
+        if not where:
+            return self.all_records(fields)
+        elif isinstance(where, AnyOf):
+            return self.execute_any(where, fields)
+        return self.execute(where, fields)
+
+    def execute_select(self, select, fields=None):
+        """
+        Runs a Select: the matching records are ordered and cut off with a heap of the limit's size,
+        then reduced. This default retrieves the matching records (only the fields it needs) and does
+        the rest in memory; backends override it to leave the work to the store or its indexes
+
+        params: select - the Select
+                fields - the fields to return for each record, or None for every field
+        returns: the aggregate if the select has one, otherwise the list of ordered records
+        """
+        records = self.select_records(select.where, select_needs(select, fields))
+        if select.ranked():
+            with self.tracer.span("top-k"):
+                records = top_k(records, select.order_by, select.descending, select.limit)
+        if select.aggregate is not None:
+            with self.tracer.span("aggregate"):
+                return reduce_records(records, select.aggregate, select.field)
+        return [project(record, fields) for record in records]
+
+    def execute_page(self, parsed_query, page_size, cursor=None, fields=None):
+        """
+        Retrieves one page of the records matching a query, starting after a cursor. Pages are in
+        uuid order here and in the in-memory backends; FirestoreBackend orders them on the query's
+        inequality field first. This default runs the whole query and keeps the page with a heap, so
+        it bounds what is returned but not what is read; backends override it to read only one page
+
+        params: parsed_query - a list of [field, operator, value] subqueries, or an AnyOf of them
+                page_size - the number of records per page
+                cursor - the token returned with the previous page, or None for the first page
+                fields - the fields to return for each record, or None for every field
+        returns: (records, the cursor token of the next page or None if this is the last page)
+        """
+        after = decode_cursor(cursor, 1)[0] if cursor is not None else None
+        needed = fields if fields is None or "uuid" in fields else tuple(fields) + ("uuid",)
+        if isinstance(parsed_query, AnyOf):
+            records = self.execute_any(parsed_query, needed)
+        else:
+            records = self.execute(parsed_query, needed)
+        page, more = page_of((record for record in records if after is None or record["uuid"] > after),
+                             page_size, lambda record: record["uuid"])
+        next_cursor = encode_cursor([page[-1]["uuid"]]) if more else None
+        return [project(record, fields) for record in page], next_cursor
+
+    def select_strategy(self, select):
+        """
+        Describes how execute_select orders, limits and reduces the matching records
+
+        params: select - the Select
+        returns: a short description
+        """
+        return "matching records retrieved and reduced in memory"
+
+    def access_path(self, field, op, value):
+        """
+        Describes how the store looks up the records matching a subquery sent to it
+
+        params: field - the field to filter on
+                op - the comparison operator
+                value - the already coerced value to compare against
+        returns: a short description
+        """
+        return "fetch from store"
+
+    def explain(self, subqueries):
+        """
+        Plans a query without running it, noting how each clause is evaluated and how many
+        records it is estimated to match
+
+        params: subqueries - a list of normalized [field, operator, value] subqueries
+        returns: the QueryPlan, with steps and notes filled in
+        """
+        estimates = {subquery: estimate for estimate, subquery in self.order_by_selectivity(subqueries)}
+        plan = self.plan(subqueries)
+        for subquery in plan.pushed:
+            plan.steps.append((subquery, self.access_path(*subquery), estimates.get(tuple(subquery))))
+        for subquery in plan.residual:
+            plan.steps.append((subquery, "client-side filter", estimates.get(tuple(subquery))))
+        if plan.residual:
+            fetched = estimates.get(tuple(plan.pushed[0])) if plan.pushed else None
+            bound = "" if fetched is None else " (at most %d)" % fetched
+            plan.notes.append("%d clause(s) checked by a client-side scan of the records the store returns%s"
+                              % (len(plan.residual), bound))
+        if any(estimate is None for estimate in estimates.values()):
+            plan.notes.append("no statistics: clauses run in the order they were written")
+        return plan
+
+    def execute(self, subqueries, fields=None):
+        """
+        Retrieves the records matching every subquery of a (possibly compound) query
+
+        params: subqueries - a list of [field, operator, value] subqueries
+                fields - the fields to return for each record, or None for every field
+        returns: a list of matching records
+        """
+        if not subqueries:
+            return []
+
+        plan = self.plan(subqueries)
+        self.last_plan = plan
+        with self.tracer.span("fetch"):
+            records = self.fetch(*plan.pushed[0])
+        self.tracer.count("documents_read", len(records))
+
+        # Short-circuit if the most selective clause already matched nothing
+        if not records:
+            return []
+        with self.tracer.span("filter"):
+            return [project(record, fields) for record in records.values() if matches_all(record, plan.residual)]
+
+
+class FirestoreBackend(QueryBackend):
+    """
+    Runs every subquery against the us_states_data Firestore collection
+    """
+
+    def __init__(self, collection=COLLECTION, statistics=None, connection=None):
+        self.collection = collection
+        # The firebase app and client are shared with every other backend and with admin.py
+        self.connection = connection if connection is not None else shared_connection
+        self.db = None
+        self._generation = None
+        self._listener = None
+        # Batch workers and server threads all call generation(), and only one of them may start the listener
+        self._watch_lock = threading.Lock()
+        # Computed from the uploaded dataset; used to pick which inequality field Firestore filters on
+        self.statistics = statistics if statistics is not None else Statistics.from_file()
+
+    def estimate(self, field, op, value):
+        if self.statistics is None:
+            return None
+        return self.statistics.estimate(field, op, value)
+
+    def connect(self):
+        self.db = self.connection.client()
+
+    def warm_up(self):
+        self.connect()
+        self.connection.warm_up(self.collection)
+        self.watch()
+
+    def watch(self):
+        """
+        Listens to the upload document admin.py writes so the generation changes as soon as the collection is reloaded
+        """
+        if self._listener is not None:
+            return
+
+        def on_upload(snapshots, changes, read_time):
+            for snapshot in snapshots:
+                self._generation = (snapshot.to_dict() or {}).get("generation")
+
+        with self._watch_lock:
+            if self._listener is None:
+                if self.db is None:
+                    self.connect()
+                self._listener = (
+                    self.db.collection(META_COLLECTION)
+                    .document(UPLOAD_DOCUMENT)
+                    .on_snapshot(on_upload)
+                )
+
+    def generation(self):
+        self.watch()
+        return self._generation
+
+    def fetch(self, field, op, value, fields=None):
+        if self.db is None:
+            self.connect()
+
+        # Retrieve documents from the database, with only the fields that are needed
+        start = time.perf_counter()
+        query = self.db.collection(self.collection).where(filter=conjunction_filter([(field, op, value)]))
+        selected = select_fields(fields)
+        if selected is not None:
+            query = query.select(selected)
+        with self.tracer.span("network"):
+            snapshots = list(query.stream())
+        with self.tracer.span("materialize"):
+            records = {doc.id: doc.to_dict() for doc in snapshots}
+        self.connection.record_query(time.perf_counter() - start)
+        self.tracer.count("documents_read", len(snapshots))
+        return records
+
+    def plan(self, subqueries):
+        """
+        Splits a compound query into the filters Firestore can combine in one query and the
+        ones that have to be checked client-side. Equality filters can always be combined;
+        inequality filters are limited to a single field and a single != clause, so the
+        most selective inequality is the one sent to Firestore. between and startswith are range
+        filters, and in filters are limited to 30 values
+
+        params: subqueries - a list of [field, operator, value] subqueries
+        returns: the QueryPlan for the query
+        """
+        pushed, residual = [], []
+        inequality_field = None
+        has_not_equal = False
+        for _, (field, op, value) in self.order_by_selectivity(subqueries):
+            if op == "in" and len(value) > MAX_DISJUNCTIONS:
+                residual.append((field, op, value))
+                continue
+            if op in INEQUALITY_OPERATORS:
+                if inequality_field not in (None, field) or (op == "!=" and has_not_equal):
+                    residual.append((field, op, value))
+                    continue
+                inequality_field = field
+                has_not_equal = has_not_equal or op == "!="
+            pushed.append((field, op, value))
+
+        if residual:
+            strategy = "single Firestore query + client-side filter"
+        else:
+            strategy = "single Firestore query"
+        return QueryPlan(strategy, pushed, residual)
+
+    def access_path(self, field, op, value):
+        return "Firestore filter (index on %s)" % field
+
+    def explain(self, subqueries):
+        plan = super().explain(subqueries)
+        fields = sorted({field for field, _, _ in plan.pushed})
+        if len(fields) > 1 and any(op in INEQUALITY_OPERATORS for _, op, _ in plan.pushed):
+            plan.notes.append("needs a composite index on (%s); without one every clause runs as its own query "
+                              "and the results are intersected client-side" % ", ".join(fields))
+        return plan
+
+    def execute(self, subqueries, fields=None):
+        from google.api_core.exceptions import FailedPrecondition
+
+        if not subqueries:
+            return []
+        if self.db is None:
+            self.connect()
+
+        plan = self.plan(subqueries)
+        query = self.db.collection(self.collection).where(filter=conjunction_filter(plan.pushed))
+        # Projection pushdown: only transfer and deserialize the fields the caller needs
+        selected = select_fields(fields, plan.residual)
+        if selected is not None:
+            query = query.select(selected)
+        try:
+            start = time.perf_counter()
+            with self.tracer.span("network"):
+                snapshots = list(query.stream())
+            with self.tracer.span("materialize"):
+                records = [doc.to_dict() for doc in snapshots]
+            self.connection.record_query(time.perf_counter() - start)
+            self.tracer.count("documents_read", len(snapshots))
+        except FailedPrecondition:
+            # The collection is missing the composite index this combination needs
+            self.last_plan = QueryPlan("one Firestore query per clause + intersection",
+                                       [tuple(subquery) for subquery in subqueries], [])
+            doc_sets = [self.fetch(*subquery, fields=fields) for subquery in subqueries]
+            with self.tracer.span("intersect"):
+                common_doc_ids = set(doc_sets[0].keys())
+                for doc_set in doc_sets[1:]:
+                    common_doc_ids.intersection_update(doc_set.keys())
+                return [doc_sets[0][doc_uuid] for doc_uuid in common_doc_ids]
+
+        self.last_plan = plan
+        with self.tracer.span("filter"):
+            return [project(record, fields) for record in records if matches_all(record, plan.residual)]
+
+    def single_or_query(self, branches):
+        """
+        Checks whether a query with || can be sent to Firestore as one query with an Or filter:
+        every branch has to be pushed down whole, without != (which Firestore doesn't allow in an
+        Or), and the branches and in values together can't exceed 30 disjunctions
+
+        params: branches - an AnyOf of lists of [field, operator, value] subqueries
+        returns: the plan of each branch if they can be combined, otherwise None
+        """
+        plans = [self.plan(branch) for branch in branches]
+        disjunctions = 0
+        for plan in plans:
+            if plan.residual or any(op == "!=" for _, op, _ in plan.pushed):
+                return None
+            combinations = 1
+            for _, op, value in plan.pushed:
+                if op == "in":
+                    combinations *= len(value)
+            disjunctions += combinations
+        return plans if disjunctions <= MAX_DISJUNCTIONS else None
+
+    def union_strategy(self, branches):
+        if self.single_or_query(branches) is not None:
+            return "single Firestore query with an Or filter"
+        return "one Firestore query per branch, merged on document id"
+
+    def execute_any(self, branches, fields=None):
+        from google.api_core.exceptions import FailedPrecondition, InvalidArgument
+        from google.cloud.firestore_v1 import Or
+
+        if self.db is None:
+            self.connect()
+        plans = self.single_or_query(branches)
+        if plans is not None:
+            query_filter = Or(filters=[conjunction_filter(plan.pushed) for plan in plans])
+            query = self.db.collection(self.collection).where(filter=query_filter)
+            selected = select_fields(fields)
+            if selected is not None:
+                query = query.select(selected)
+            try:
+                start = time.perf_counter()
+                with self.tracer.span("network"):
+                    snapshots = list(query.stream())
+                self.connection.record_query(time.perf_counter() - start)
+                self.tracer.count("documents_read", len(snapshots))
+                # Firestore returns each matching document once, however many branches it matches
+                with self.tracer.span("materialize"):
+                    return [doc.to_dict() for doc in snapshots]
+            except (FailedPrecondition, InvalidArgument):
+                # Missing composite index, or a combination Firestore rejects: run the branches separately
+                pass
+
+        records = {}
+        for branch in branches:
+            plan = self.plan(branch)
+            query = self.db.collection(self.collection).where(filter=conjunction_filter(plan.pushed))
+            selected = select_fields(fields, plan.residual)
+            if selected is not None:
+                query = query.select(selected)
+            try:
+                start = time.perf_counter()
+                with self.tracer.span("network"):
+                    snapshots = list(query.stream())
+                self.connection.record_query(time.perf_counter() - start)
+            except FailedPrecondition:
+                for record in self.execute(branch, fields):
+                    records.setdefault(record["uuid"], record)
+                continue
+            self.tracer.count("documents_read", len(snapshots))
+            # Documents already matched by an earlier branch are skipped before they are materialized
+            with self.tracer.span("materialize"):
+                for doc in snapshots:
+                    if doc.id in records:
+                        continue
+                    record = doc.to_dict()
+                    if matches_all(record, plan.residual):
+                        records[doc.id] = project(record, fields)
+        return list(records.values())
+
+
+    def page_query(self, parsed_query):
+        """
+        Builds the query execute_page reads pages of. Pages are ordered by document id, after the
+        inequality field if there is one since Firestore orders on it first
+
+        params: parsed_query - a list of [field, operator, value] subqueries, or an AnyOf of them
+        returns: (query, the fields it is ordered on before the document id, the subqueries left to check
+                 client-side), or None if the query can't be paged in Firestore
+        """
+        from google.cloud.firestore_v1 import Or
+
+        if isinstance(parsed_query, AnyOf):
+            plans = self.single_or_query(parsed_query)
+            # Inequalities in different branches would each add an implicit order
+            if plans is None or any(op in INEQUALITY_OPERATORS for plan in plans for _, op, _ in plan.pushed):
+                return None
+            query_filter, order, residual = Or(filters=[conjunction_filter(plan.pushed) for plan in plans]), [], []
+        else:
+            plan = self.plan(parsed_query)
+            query_filter, residual = conjunction_filter(plan.pushed), plan.residual
+            order = sorted({field for field, op, _ in plan.pushed if op in INEQUALITY_OPERATORS})
+        query = self.db.collection(self.collection).where(filter=query_filter)
+        for field in order:
+            query = query.order_by(field)
+        return query.order_by("__name__"), order, residual
+
+    def execute_page(self, parsed_query, page_size, cursor=None, fields=None):
+        """
+        Reads one page of the records matching a query with a Firestore cursor. Like Firestore, pages
+        are ordered on the query's inequality field, if it has one, and then on document id. Queries
+        Firestore can't page fall back to QueryBackend.execute_page, in uuid order
+
+        params: parsed_query - a list of [field, operator, value] subqueries, or an AnyOf of them
+                page_size - the number of records per page
+                cursor - the token returned with the previous page, or None for the first page
+                fields - the fields to return for each record, or None for every field
+        returns: (records, the cursor token of the next page or None if this is the last page)
+        """
+        from google.api_core.exceptions import FailedPrecondition, InvalidArgument
+
+        if self.db is None:
+            self.connect()
+        paged = self.page_query(parsed_query)
+        if paged is None:
+            return super().execute_page(parsed_query, page_size, cursor, fields)
+        query, order, residual = paged
+        after = decode_cursor(cursor) if cursor is not None else None
+        if after is not None and len(after) != len(order) + 1:
+            # A cursor from the fallback, which orders on uuid alone
+            return super().execute_page(parsed_query, page_size, cursor, fields)
+        selected = select_fields(None if fields is None else tuple(fields) + tuple(order), residual)
+        if selected is not None:
+            query = query.select(selected)
+
+        # Batches of page_size + 1 documents are read until the page is full, so a page is found without
+        # holding more than one batch, and the extra document tells whether there is a next page
+        page = []
+        try:
+            while True:
+                batch_query = query
+                if after is not None:
+                    batch_query = batch_query.start_after(dict(zip(order + ["__name__"], after)))
+                start = time.perf_counter()
+                with self.tracer.span("network"):
+                    snapshots = list(batch_query.limit(page_size + 1).stream())
+                self.connection.record_query(time.perf_counter() - start)
+                self.tracer.count("documents_read", len(snapshots))
+                with self.tracer.span("materialize"):
+                    for doc in snapshots:
+                        record = doc.to_dict()
+                        after = [record.get(field) for field in order] + [doc.id]
+                        if not matches_all(record, residual):
+                            continue
+                        if len(page) == page_size:
+                            return [project(record, fields) for _, record in page], encode_cursor(page[-1][0])
+                        page.append((after, record))
+                if len(snapshots) <= page_size:
+                    return [project(record, fields) for _, record in page], None
+        except (FailedPrecondition, InvalidArgument):
+            # Missing composite index for the order
+            return super().execute_page(parsed_query, page_size, cursor, fields)
+
+    def all_records(self, fields=None):
+        if self.db is None:
+            self.connect()
+        query = self.db.collection(self.collection)
+        selected = select_fields(fields)
+        if selected is not None:
+            query = query.select(selected)
+        start = time.perf_counter()
+        with self.tracer.span("network"):
+            snapshots = list(query.stream())
+        self.connection.record_query(time.perf_counter() - start)
+        self.tracer.count("documents_read", len(snapshots))
+        with self.tracer.span("materialize"):
+            return [doc.to_dict() for doc in snapshots]
+
+    def select_query(self, select):
+        """
+        Builds a Firestore query for a Select's filter, order and limit. That is only possible when the
+        whole filter can be pushed down, and Firestore only orders on a field when no other field
+        has an inequality filter (min and max order on the reduced field)
+
+        params: select - the Select
+        returns: the query, or None if part of the select has to run client-side
+        """
+        from google.cloud.firestore_v1 import Or, Query
+
+        query = self.db.collection(self.collection)
+        if isinstance(select.where, AnyOf):
+            plans = self.single_or_query(select.where)
+            if plans is None or select.order_by is not None:
+                return None
+            query = query.where(filter=Or(filters=[conjunction_filter(plan.pushed) for plan in plans]))
+            pushed = [subquery for plan in plans for subquery in plan.pushed]
+        elif select.where:
+            plan = self.plan(select.where)
+            if plan.residual:
+                return None
+            query = query.where(filter=conjunction_filter(plan.pushed))
+            pushed = plan.pushed
+        else:
+            pushed = []
+
+        order_field = select.order_by
+        if order_field is None and select.aggregate in ("min", "max"):
+            order_field = select.field
+        if order_field is not None and {field for field, op, _ in pushed if op in INEQUALITY_OPERATORS} - {order_field}:
+            return None
+        if select.order_by is not None:
+            query = query.order_by(select.order_by,
+                                   direction=Query.DESCENDING if select.descending else Query.ASCENDING)
+        if select.limit is not None:
+            query = query.limit(select.limit)
+        return query
+
+    def select_strategy(self, select):
+        if self.db is None:
+            self.connect()
+        if self.select_query(select) is not None:
+            if select.aggregate in ("count", "sum", "avg"):
+                return "Firestore %s aggregation query" % select.aggregate
+            elif select.aggregate is not None and not select.ranked():
+                return "Firestore query ordered on %s, limit 1" % select.field
+            return "Firestore query with order_by/limit"
+        return super().select_strategy(select)
+
+    def execute_select(self, select, fields=None):
+        from google.api_core.exceptions import FailedPrecondition, InvalidArgument
+        from google.cloud.firestore_v1 import Query
+
+        if self.db is None:
+            self.connect()
+        query = self.select_query(select)
+        if query is None:
+            return super().execute_select(select, fields)
+        try:
+            if select.aggregate in ("count", "sum", "avg"):
+                # The store reduces the matching documents and sends back a single value
+                if select.aggregate == "count":
+                    aggregation = query.count(alias="value")
+                else:
+                    aggregation = getattr(query, select.aggregate)(select.field, alias="value")
+                start = time.perf_counter()
+                with self.tracer.span("network"):
+                    results = aggregation.get()
+                self.connection.record_query(time.perf_counter() - start)
+                self.tracer.count("aggregation_queries")
+                return results[0][0].value
+
+            if select.aggregate is not None and not select.ranked():
+                # min and max read one document: the first in the field's index
+                direction = Query.DESCENDING if select.aggregate == "max" else Query.ASCENDING
+                query = query.order_by(select.field, direction=direction).limit(1)
+            selected = select_fields(select_needs(select, fields))
+            if selected is not None:
+                query = query.select(selected)
+            start = time.perf_counter()
+            with self.tracer.span("network"):
+                snapshots = list(query.stream())
+            self.connection.record_query(time.perf_counter() - start)
+            self.tracer.count("documents_read", len(snapshots))
+        except (FailedPrecondition, InvalidArgument):
+            # Missing composite index for the order, or a combination Firestore rejects
+            return super().execute_select(select, fields)
+
+        with self.tracer.span("materialize"):
+            records = [doc.to_dict() for doc in snapshots]
+        if select.aggregate is not None:
+            return reduce_records(records, select.aggregate, select.field)
+        # Firestore already returned them in order
+        return [project(record, fields) for record in records]
+
+
+class LocalBackend(QueryBackend):
+    """
+    In-memory copy of the dataset with a hash index on each categorical field and
+    a sorted index on each numerical field, so queries are answered without a
+    network round trip
+    """
+
+    def __init__(self, records=None, data_file=DATA_FILE):
+        if records is None:
+            with open(data_file, "r") as f:
+                records = json.load(f)
+
+        self.docs = {}
+        self._generation = 0
+        # Held while the indexes change so concurrent queries never see a half-updated index
+        self.lock = threading.RLock()
+        # value -> set of uuids
+        self.hash_indexes = {field: {} for field in CATEGORICAL_FIELDS}
+        # parallel lists of sorted values and their uuids
+        self.sorted_indexes = {field: ([], []) for field in NUMERICAL_FIELDS}
+        self.load(records)
+
+    def load(self, records):
+        """
+        Replaces every record and rebuilds the indexes in one pass. The sorted indexes are sorted once,
+        instead of inserting each record into them as add does
+
+        params: records - an iterable of state records containing a uuid
+        """
+        docs = {record["uuid"]: record for record in records}
+        hash_indexes = {field: {} for field in CATEGORICAL_FIELDS}
+        for doc_uuid, record in docs.items():
+            for field, index in hash_indexes.items():
+                if field in record:
+                    index.setdefault(record[field], set()).add(doc_uuid)
+        sorted_indexes = {}
+        for field in NUMERICAL_FIELDS:
+            pairs = sorted((record[field], doc_uuid) for doc_uuid, record in docs.items() if field in record)
+            sorted_indexes[field] = ([value for value, _ in pairs], [doc_uuid for _, doc_uuid in pairs])
+        with self.lock:
+            self.docs = docs
+            self.hash_indexes = hash_indexes
+            self.sorted_indexes = sorted_indexes
+            self._generation += 1
+
+    def add(self, record):
+        """
+        Adds or replaces a record and updates every index
+
+        params: record - a state record containing a uuid
+        """
+        with self.lock:
+            doc_uuid = record["uuid"]
+            if doc_uuid in self.docs:
+                self.remove(doc_uuid)
+            self.docs[doc_uuid] = record
+            self._generation += 1
+
+            for field, index in self.hash_indexes.items():
+                if field in record:
+                    index.setdefault(record[field], set()).add(doc_uuid)
+            for field, (values, uuids) in self.sorted_indexes.items():
+                if field in record:
+                    position = bisect.bisect_right(values, record[field])
+                    values.insert(position, record[field])
+                    uuids.insert(position, doc_uuid)
+
+    def remove(self, doc_uuid):
+        """
+        Removes a record and its index entries if it is present
+
+        params: doc_uuid - the uuid of the record to remove
+        """
+        with self.lock:
+            record = self.docs.pop(doc_uuid, None)
+            if record is None:
+                return
+            self._generation += 1
+
+            for field, index in self.hash_indexes.items():
+                if field in record:
+                    matches = index[record[field]]
+                    matches.discard(doc_uuid)
+                    if not matches:
+                        del index[record[field]]
+            for field, (values, uuids) in self.sorted_indexes.items():
+                if field in record:
+                    start = bisect.bisect_left(values, record[field])
+                    end = bisect.bisect_right(values, record[field])
+                    position = uuids.index(doc_uuid, start, end)
+                    del values[position]
+                    del uuids[position]
+
+    def match_ids(self, field, op, value):
+        """
+        Looks up the uuids of the records matching a single comparison using the field's index
+
+        params: field - the field to filter on
+                op - the comparison operator
+                value - the already coerced value to compare against
+        returns: a set of matching uuids
+        """
+        if field in self.sorted_indexes:
+            values, uuids = self.sorted_indexes[field]
+            matches = set()
+            for start, end in sorted_range(values, op, value):
+                matches.update(uuids[start:end])
+            return matches
+
+        index = self.hash_indexes.get(field, {})
+        if op == "==":
+            return set(index.get(value, ()))
+        elif op == "in":
+            return set().union(*(index.get(item, ()) for item in value))
+        matches = set()
+        for key, key_uuids in index.items():
+            if compare(key, op, value):
+                matches |= key_uuids
+        return matches
+
+    def generation(self):
+        return self._generation
+
+    def access_path(self, field, op, value):
+        if field in self.sorted_indexes:
+            return "sorted index on %s (binary search)" % field
+        if op == "==":
+            return "hash index on %s (lookup)" % field
+        return "hash index on %s (scan of %d keys)" % (field, len(self.hash_indexes.get(field, {})))
+
+    def estimate(self, field, op, value):
+        # The indexes are always current, so estimates here are exact counts
+        if field in self.sorted_indexes:
+            return count_sorted_range(self.sorted_indexes[field][0], op, value)
+        index = self.hash_indexes.get(field, {})
+        if op == "==":
+            return len(index.get(value, ()))
+        elif op == "in":
+            return sum(len(index.get(item, ())) for item in set(value))
+        return sum(len(key_uuids) for key, key_uuids in index.items() if compare(key, op, value))
+
+    def execute(self, subqueries, fields=None):
+        with self.lock:
+            ordered = self.order_by_selectivity(subqueries)
+
+            # An exact estimate of zero means nothing can match
+            if not ordered or ordered[0][0] == 0:
+                self.last_plan = self.plan(subqueries)
+                return []
+            return super().execute(subqueries, fields)
+
+    def fetch(self, field, op, value):
+        return {doc_uuid: self.docs[doc_uuid] for doc_uuid in self.match_ids(field, op, value)}
+
+    def union_strategy(self, branches):
+        return "index lookups per branch, union of uuid sets"
+
+    def match_branches(self, branches):
+        """
+        Looks up the uuids of the records matching any branch of a query
+
+        params: branches - a list of lists of [field, operator, value] subqueries
+        returns: a set of matching uuids
+        """
+        matches = set()
+        for branch in branches:
+            ordered = [subquery for _, subquery in self.order_by_selectivity(branch)]
+            with self.tracer.span("fetch"):
+                uuids = self.match_ids(*ordered[0])
+            self.tracer.count("documents_read", len(uuids))
+            # Records already matched by an earlier branch don't need checking again
+            with self.tracer.span("filter"):
+                matches.update(doc_uuid for doc_uuid in uuids - matches
+                               if matches_all(self.docs[doc_uuid], ordered[1:]))
+        return matches
+
+    def execute_any(self, branches, fields=None):
+        with self.lock:
+            matches = self.match_branches(branches)
+            # Each matching record is projected once, however many branches it matched
+            return [project(self.docs[doc_uuid], fields) for doc_uuid in matches]
+
+    def execute_page(self, parsed_query, page_size, cursor=None, fields=None):
+        after = decode_cursor(cursor, 1)[0] if cursor is not None else None
+        with self.lock:
+            uuids = self.match_branches(parsed_query if isinstance(parsed_query, AnyOf) else [parsed_query])
+            # Only uuids are compared; records are read for the page alone
+            page, more = page_of((doc_uuid for doc_uuid in uuids if after is None or doc_uuid > after),
+                                 page_size, None)
+            records = [project(self.docs[doc_uuid], fields) for doc_uuid in page]
+        return records, encode_cursor(page[-1:]) if more else None
+
+    def all_records(self, fields=None):
+        with self.lock:
+            return [project(record, fields) for record in self.docs.values()]
+
+    def walk_sorted_index(self, field, descending, limit):
+        """
+        Reads the first records in a numerical field's order straight from its sorted index. Records
+        tied with the last one are read as well so ties can be ordered by uuid
+
+        params: field - a field with a sorted index
+                descending - True to walk from the largest value
+                limit - the number of records wanted
+        returns: the first limit records, in order
+        """
+        if limit <= 0:
+            return []
+        values, uuids = self.sorted_indexes[field]
+        positions = range(len(values) - 1, -1, -1) if descending else range(len(values))
+        picked = []
+        for position in positions:
+            if len(picked) >= limit and values[position] != values[picked[-1]]:
+                break
+            picked.append(position)
+        self.tracer.count("documents_read", len(picked))
+        return top_k((self.docs[uuids[position]] for position in picked), field, descending, limit)
+
+    def select_strategy(self, select):
+        if not select.where and select.order_by in self.sorted_indexes and select.limit is not None:
+            return "walk of the sorted index on %s" % select.order_by
+        elif (not select.where and not select.ranked() and select.field in self.sorted_indexes
+              and select.aggregate in ("min", "max")):
+            end = "first" if select.aggregate == "min" else "last"
+            return "%s value of the sorted index on %s" % (end, select.field)
+        elif select.aggregate == "count" and not select.ranked():
+            return "index lookups, size of the matching uuid set"
+        elif select.limit is not None:
+            return "index lookups, then a heap of the first %d records" % select.limit
+        elif select.order_by is not None:
+            return "index lookups, then a sort on %s" % select.order_by
+        return "index lookups, reduced in memory"
+
+    def execute_select(self, select, fields=None):
+        with self.lock:
+            if not select.where and select.order_by in self.sorted_indexes and select.limit is not None:
+                # Only the first records of the index are read
+                records = self.walk_sorted_index(select.order_by, select.descending, select.limit)
+            elif (not select.where and not select.ranked() and select.field in self.sorted_indexes
+                  and select.aggregate in ("min", "max")):
+                values = self.sorted_indexes[select.field][0]
+                if not values:
+                    return None
+                return values[0] if select.aggregate == "min" else values[-1]
+            else:
+                if not select.where:
+                    uuids = set(self.docs)
+                else:
+                    uuids = self.match_branches(select.where if isinstance(select.where, AnyOf) else [select.where])
+                if select.aggregate == "count" and not select.ranked():
+                    # Counting needs the uuids only, not the records
+                    return len(uuids)
+                records = [self.docs[doc_uuid] for doc_uuid in uuids]
+                if select.ranked():
+                    with self.tracer.span("top-k"):
+                        records = top_k(records, select.order_by, select.descending, select.limit)
+            if select.aggregate is not None:
+                with self.tracer.span("aggregate"):
+                    return reduce_records(records, select.aggregate, select.field)
+            return [project(record, fields) for record in records]
+
+
+class ReplicaBackend(LocalBackend):
+    """
+    LocalBackend kept in sync with the Firestore collection by a snapshot listener. The
+    collection is read once when the listener starts and after that only changed documents
+    are sent, so every query is answered from memory while results stay fresh
+    """
+
+    def __init__(self, collection=COLLECTION, connection=None, timeout=30):
+        super().__init__(records=[])
+        self.collection = collection
+        self.connection = connection if connection is not None else shared_connection
+        self.timeout = timeout
+        # Number of document changes received, which is what Firestore bills as reads
+        self.reads = 0
+        self._listener = None
+        self._synced = threading.Event()
+
+    def connect(self):
+        if self._listener is not None:
+            return
+        with self.lock:
+            if self._listener is None:
+                db = self.connection.client()
+                self._listener = db.collection(self.collection).on_snapshot(self.on_snapshot)
+        # Queries wait until the first snapshot has filled the replica
+        if not self._synced.wait(self.timeout):
+            raise TimeoutError("Timed out waiting for the first snapshot of %s" % self.collection)
+
+    def on_snapshot(self, snapshots, changes, read_time):
+        """
+        Applies the documents that were added, changed or removed since the last snapshot
+
+        params: snapshots - every document currently in the collection (unused)
+                changes - the DocumentChanges since the last snapshot
+                read_time - when the snapshot was taken
+        """
+        with self.lock:
+            if not self.docs:
+                # The first snapshot holds the whole collection, so the indexes are built in one pass
+                self.reads += len(changes)
+                self.load(dict(change.document.to_dict(), uuid=change.document.id)
+                          for change in changes if change.type.name != "REMOVED")
+                changes = []
+            for change in changes:
+                self.reads += 1
+                if change.type.name == "REMOVED":
+                    self.remove(change.document.id)
+                else:
+                    self.add(dict(change.document.to_dict(), uuid=change.document.id))
+        self._synced.set()
+
+    def close(self):
+        """
+        Stops listening for changes
+        """
+        if self._listener is not None:
+            self._listener.unsubscribe()
+            self._listener = None
+            self._synced.clear()
@@ -0,0 +1,471 @@
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+from backends import COLLECTION, DATA_FILE, FirestoreBackend, Statistics, compare, reduce_records
+from connection import FirestoreConnection
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Code run in a fresh interpreter for each startup scenario
+STARTUP_SCENARIOS = {
+    "import": "import query",
+    "help": (
+        "import io, contextlib\n"
+        "from query import StateQueryEngine\n"
+        "from backends import LocalBackend\n"
+        "with contextlib.redirect_stdout(io.StringIO()):\n"
+        "    StateQueryEngine(LocalBackend()).validate_and_parse_input('help')"
+    ),
+    "local query": (
+        "import io, contextlib\n"
+        "from query import StateQueryEngine\n"
+        "from backends import LocalBackend\n"
+        "with contextlib.redirect_stdout(io.StringIO()):\n"
+        "    StateQueryEngine(LocalBackend()).validate_and_parse_input('region == northeast')"
+    ),
+}
+
+
+def parse_importtime(stderr):
+    """
+    Reads the output of python -X importtime
+
+    params: stderr - the interpreter's stderr
+    returns: a list of (cumulative microseconds, module name) for top-level imports
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented; only modules imported directly are kept
+        if not name[1:].startswith(" "):
+            imports.append((int(cumulative), name.strip()))
+    return imports
+
+
+def startup_benchmark(runs=5):
+    """
+    Times each startup scenario in a fresh interpreter, like python -X importtime, and reports
+    the median wall clock time and the slowest top-level imports
+
+    params: runs - the number of interpreters started per scenario
+    returns: a dictionary of scenario name to (median seconds, slowest imports)
+    """
+    results = {}
+    for name, code in STARTUP_SCENARIOS.items():
+        times = []
+        imports = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            completed = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=HERE,
+                                       capture_output=True, text=True, check=True)
+            times.append(time.perf_counter() - start)
+            imports = parse_importtime(completed.stderr)
+        times.sort()
+        slowest = sorted(imports, reverse=True)[:5]
+        results[name] = (times[len(times) // 2], slowest)
+    return results
+
+
+# One query of each shape the planner treats differently
+QUERY_SHAPES = {
+    "single": "state == vermont",
+    "compound": "region == northeast && population > 5000000",
+    "range": "population > 1000000 && population < 5000000",
+    "not equal": "region != west",
+}
+
+# Rendered by every output format
+RENDER_QUERY = "population > 0"
+
+# Page size of the time-to-first-page benchmarks, the REPL's default
+PAGE_SIZE = 50
+# Committed timings of the default query benchmark; refresh with --save-baseline after an intended change
+BASELINE_FILE = "benchmarks_baseline.json"
+# Timings are compared relative to this benchmark of the same run, so a faster or slower machine doesn't count as a change
+REFERENCE_BENCHMARK = "grammar"
+# Slowdowns smaller than this are timer noise, whatever their ratio
+REGRESSION_FLOOR_MS = 0.5
+
+
+class FakeSnapshot:
+    """
+    Stand-in for a Firestore DocumentSnapshot
+    """
+
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self):
+        # Like Firestore, a document that doesn't exist has no data
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocument:
+    """
+    Stand-in for a Firestore DocumentReference that never changes, such as the upload stamp
+    """
+
+    def __init__(self, doc_id=None, data=None):
+        self.id = doc_id
+        self.data = data
+
+    def get(self):
+        return FakeSnapshot(self.id, self.data)
+
+    def on_snapshot(self, callback):
+        callback([self.get()] if self.data is not None else [], [], None)
+        return self
+
+    def unsubscribe(self):
+        pass
+
+
+class FakeAggregationResult:
+    """
+    Stand-in for an AggregationResult
+    """
+
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class FakeAggregation:
+    """
+    Stand-in for an AggregationQuery: count, sum or avg of the documents a FakeQuery returns
+    """
+
+    def __init__(self, query, aggregate, field, alias):
+        self.query = query
+        self.aggregate = aggregate
+        self.field = field
+        self.alias = alias
+
+    def get(self):
+        records = [snapshot.to_dict() for snapshot in self.query.stream()]
+        return [[FakeAggregationResult(self.alias, reduce_records(records, self.aggregate, self.field))]]
+
+
+class FakeQuery:
+    """
+    In-process stand-in for a Firestore collection or query. It evaluates FieldFilter, And and Or
+    filters, order_by, limit, start_after and select() projections against a list of records, so FirestoreBackend
+    runs its real query building code without a network round trip. Like Firestore, results are
+    ordered by document id unless an order is given
+    """
+
+    def __init__(self, records, filters=(), fields=None, max_count=None, orders=(), after=None):
+        self.records = records
+        self.filters = filters
+        self.fields = fields
+        self.max_count = max_count
+        self.orders = orders
+        self.after = after
+
+    def copy(self, **changes):
+        attributes = dict(records=self.records, filters=self.filters, fields=self.fields, max_count=self.max_count,
+                          orders=self.orders, after=self.after)
+        attributes.update(changes)
+        return FakeQuery(**attributes)
+
+    def where(self, filter):
+        return self.copy(filters=self.filters + (filter,))
+
+    def select(self, field_paths):
+        return self.copy(fields=list(field_paths))
+
+    def limit(self, count):
+        return self.copy(max_count=count)
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        # The document id is the record's uuid
+        field = "uuid" if field_path == "__name__" else field_path
+        return self.copy(orders=self.orders + ((field, direction == "DESCENDING"),))
+
+    def start_after(self, document_fields):
+        values = [document_fields[field] for field in document_fields]
+        return self.copy(after=values)
+
+    def count(self, alias=None):
+        return FakeAggregation(self, "count", None, alias)
+
+    def sum(self, field_ref, alias=None):
+        return FakeAggregation(self, "sum", field_ref, alias)
+
+    def avg(self, field_ref, alias=None):
+        return FakeAggregation(self, "avg", field_ref, alias)
+
+    def document(self, doc_id):
+        return FakeDocument(doc_id, next((record for record in self.records if record.get("uuid") == doc_id), None))
+
+    def matches(self, record, query_filter):
+        if hasattr(query_filter, "filters"):
+            combine = any if query_filter.operator.name == "OR" else all
+            return combine(self.matches(record, nested) for nested in query_filter.filters)
+        field = query_filter.field_path
+        return field in record and compare(record[field], query_filter.op_string, query_filter.value)
+
+    def stream(self):
+        records = [record for record in self.records
+                   if all(self.matches(record, query_filter) for query_filter in self.filters)
+                   and all(field in record for field, _ in self.orders)]
+        # Ties are ordered by document id, in the direction of the last order
+        records.sort(key=lambda record: record["uuid"], reverse=bool(self.orders) and self.orders[-1][1])
+        for field, descending in reversed(self.orders):
+            records.sort(key=lambda record: record[field], reverse=descending)
+        if self.after is not None:
+            # Cursors are only used with ascending orders
+            fields = [field for field, _ in self.orders[:len(self.after)]]
+            records = [record for record in records if [record[field] for field in fields] > self.after]
+        if self.max_count is not None:
+            records = records[:self.max_count]
+        for record in records:
+            data = record if self.fields is None else {f: record[f] for f in self.fields if f in record}
+            yield FakeSnapshot(record["uuid"], data)
+
+
+class FakeFirestore:
+    """
+    In-process stand-in for the Firestore client, seeded with one collection of records
+    """
+
+    def __init__(self, records, collection=COLLECTION):
+        self.collections = {collection: list(records)}
+
+    def collection(self, name):
+        return FakeQuery(self.collections.get(name, []))
+
+
+class FakeConnection(FirestoreConnection):
+    """
+    FirestoreConnection that hands out a FakeFirestore instead of logging in
+    """
+
+    def __init__(self, db):
+        super().__init__()
+        self._db = db
+
+
+def load_records(data_file=DATA_FILE):
+    """
+    Reads the dataset admin.py uploads
+
+    params: data_file - path to the JSON array of records
+    returns: a list of records
+    """
+    with open(data_file, "r") as f:
+        return json.load(f)
+
+
+def synthetic_records(records, scale):
+    """
+    Scales a dataset up by repeating it. Copies get their own uuid and state name, and their
+    numbers are shifted slightly so range queries don't match whole copies at once
+
+    params: records - the base records
+            scale - how many copies of the dataset to make
+    returns: a list of len(records) * scale records
+    """
+    scaled = []
+    for copy in range(scale):
+        for record in records:
+            if copy == 0:
+                scaled.append(record)
+                continue
+            synthetic = dict(record, uuid="%s-%d" % (record["uuid"], copy), state="%s %d" % (record["state"], copy))
+            for field in ("population", "num_counties"):
+                if field in synthetic:
+                    synthetic[field] += copy % 97
+            scaled.append(synthetic)
+    return scaled
+
+
+def make_backend(kind, records):
+    """
+    Builds the backend a benchmark runs against
+
+    params: kind - "fake" (FirestoreBackend on an in-process FakeFirestore), "emulator" (FirestoreBackend on the
+                   emulator at FIRESTORE_EMULATOR_HOST, seeded with the records), "local" or "columnar"
+            records - the records to serve
+    returns: the backend
+    """
+    if kind == "fake":
+        return FirestoreBackend(statistics=Statistics(records), connection=FakeConnection(FakeFirestore(records)))
+    if kind == "emulator":
+        import admin
+
+        if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+            raise RuntimeError("Set FIRESTORE_EMULATOR_HOST to benchmark against the Firestore emulator")
+        connection = FirestoreConnection()
+        admin.bulk_load(connection.client(), records, COLLECTION, mode="replace")
+        return FirestoreBackend(statistics=Statistics(records), connection=connection)
+    if kind == "local":
+        from backends import LocalBackend
+        return LocalBackend(records)
+    if kind == "columnar":
+        from columnar import ColumnarBackend, StateTable
+        return ColumnarBackend(StateTable(records))
+    raise ValueError("Unknown backend %s" % kind)
+
+
+def measure(func, runs, warmup=1):
+    """
+    Times repeated calls of a function
+
+    params: func - the function to call with no arguments
+            runs - the number of timed calls
+            warmup - the number of untimed calls made first, so lazy imports and connections aren't counted
+    returns: a list of wall clock times in seconds
+    """
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summarize(times):
+    """
+    Summarizes a list of timings
+
+    params: times - wall clock times in seconds
+    returns: a dictionary of p50 and p99 in milliseconds and calls per second
+    """
+    times = sorted(times)
+    total = sum(times)
+    return {
+        "p50_ms": times[len(times) // 2] * 1000,
+        "p99_ms": times[min(len(times) - 1, int(len(times) * 0.99))] * 1000,
+        "ops_per_sec": len(times) / total if total else float("inf"),
+    }
+
+
+def query_benchmark(backend="fake", scales=(1,), runs=100):
+    """
+    Times each stage of answering a query separately: building the grammar, parsing each
+    query shape, planning and executing it, reading its first page, and rendering the results
+    in every output format. Parsing and execution bypass the parse and result caches
+
+    params: backend - the kind of backend, see make_backend
+            scales - the dataset sizes to run, as multiples of us_states_data.json
+            runs - the number of timed calls per benchmark
+    returns: a dictionary of "<scale>x <stage>" to its summary
+    """
+    from query import QueryGrammar, StateQueryEngine
+    from results import RENDERERS, ResultSet
+
+    results = {}
+    results["grammar"] = summarize(measure(QueryGrammar._build, max(5, runs // 10)))
+
+    grammar = QueryGrammar(cache_size=0)
+    for shape, text in QUERY_SHAPES.items():
+        results["parse " + shape] = summarize(measure(lambda: grammar.parse(text), runs))
+
+    base_records = load_records()
+    for scale in scales:
+        engine = StateQueryEngine(make_backend(backend, synthetic_records(base_records, scale)))
+        prefix = "%dx " % scale
+        for shape, text in QUERY_SHAPES.items():
+            parsed_query = engine.normalize_query(engine.parse_query(text))
+            fields = ResultSet.required_fields(parsed_query)
+            results[prefix + "plan " + shape] = summarize(measure(lambda: engine.backend.plan(parsed_query), runs))
+            results[prefix + "execute " + shape] = summarize(
+                measure(lambda: engine.backend.execute(parsed_query, fields), runs))
+            # Reads one page (and one more document) from the store, however many records match
+            results[prefix + "first page " + shape] = summarize(
+                measure(lambda: engine.backend.execute_page(parsed_query, PAGE_SIZE, None, fields), runs))
+
+        parsed_query = engine.normalize_query(engine.parse_query(RENDER_QUERY))
+        records = engine.backend.execute(parsed_query)
+        for name, renderer in RENDERERS.items():
+            results[prefix + "render " + name] = summarize(
+                measure(lambda: renderer().render(ResultSet(parsed_query, records), io.StringIO()), runs))
+    return results
+
+
+def find_regressions(results, baseline, tolerance=0.25, floor_ms=REGRESSION_FLOOR_MS):
+    """
+    Compares benchmark results against a stored baseline. Baseline timings are first scaled by how
+    much faster or slower REFERENCE_BENCHMARK ran this time, so only changes relative to the rest of
+    the run count
+
+    params: results - the output of query_benchmark
+            baseline - an earlier output of query_benchmark
+            tolerance - how much slower than the scaled baseline p50 a benchmark may be, as a fraction
+            floor_ms - how much slower, in milliseconds, it has to be as well
+    returns: a list of (benchmark, scaled baseline p50, current p50) for every benchmark that regressed
+    """
+    speed = 1.0
+    if REFERENCE_BENCHMARK in results and REFERENCE_BENCHMARK in baseline:
+        speed = results[REFERENCE_BENCHMARK]["p50_ms"] / baseline[REFERENCE_BENCHMARK]["p50_ms"]
+    regressions = []
+    for name, summary in results.items():
+        if name not in baseline or name == REFERENCE_BENCHMARK:
+            continue
+        expected = baseline[name]["p50_ms"] * speed
+        if summary["p50_ms"] > expected * (1 + tolerance) and summary["p50_ms"] - expected > floor_ms:
+            regressions.append((name, expected, summary["p50_ms"]))
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="State Query Engine benchmarks")
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+    startup_parser = subparsers.add_parser("startup", help="time interpreter startup for common commands")
+    startup_parser.add_argument("--runs", type=int, default=5)
+    query_parser = subparsers.add_parser("query", help="time parsing, planning, execution and rendering")
+    query_parser.add_argument("--backend", choices=["fake", "emulator", "local", "columnar"], default="fake")
+    query_parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100],
+                              help="dataset sizes as multiples of us_states_data.json (up to 10000)")
+    query_parser.add_argument("--runs", type=int, default=30)
+    query_parser.add_argument("--baseline", metavar="FILE", nargs="?", const=BASELINE_FILE,
+                              help="fail if any benchmark is slower than this baseline, relative to the %r benchmark "
+                                   "(%s without FILE)" % (REFERENCE_BENCHMARK, BASELINE_FILE))
+    query_parser.add_argument("--tolerance", type=float, default=0.25,
+                              help="allowed slowdown against the baseline p50, as a fraction")
+    query_parser.add_argument("--floor", type=float, default=REGRESSION_FLOOR_MS,
+                              help="smallest slowdown in milliseconds that counts as a regression")
+    query_parser.add_argument("--save-baseline", metavar="FILE", help="store the results as a new baseline")
+    args = arg_parser.parse_args()
+
+    if args.command == "startup":
+        for name, (seconds, slowest) in startup_benchmark(args.runs).items():
+            print("%-12s %8.1f ms" % (name, seconds * 1000))
+            for microseconds, module in slowest:
+                print("    %-30s %8.1f ms" % (module, microseconds / 1000))
+
+    elif args.command == "query":
+        results = query_benchmark(args.backend, args.scales, args.runs)
+        print("%-32s %10s %10s %12s" % ("benchmark", "p50 ms", "p99 ms", "ops/sec"))
+        for name, summary in results.items():
+            print("%-32s %10.3f %10.3f %12.1f" % (name, summary["p50_ms"], summary["p99_ms"], summary["ops_per_sec"]))
+
+        if args.save_baseline:
+            with open(args.save_baseline, "w") as f:
+                json.dump({"backend": args.backend, "results": results}, f, indent=2)
+        if args.baseline:
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+            if baseline["backend"] != args.backend:
+                # Benchmark names don't say which backend they ran on, so other backends' timings aren't comparable
+                print("Baseline %s is for --backend %s; not checked" % (args.baseline, baseline["backend"]))
+                return
+            regressions = find_regressions(results, baseline["results"], args.tolerance, args.floor)
+            for name, before, after in regressions:
+                print("REGRESSION %s: %.3f ms -> %.3f ms" % (name, before, after))
+            if regressions:
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
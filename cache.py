@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+from backends import AnyOf, Select
+
+
+class ResultCache:
+    """
+    LRU cache of query results keyed on the normalized parsed query. Entries expire
+    after ttl seconds, and every entry is tagged with the backend's data generation
+    so results are dropped as soon as the underlying collection changes.
+    """
+
+    def __init__(self, max_size=128, ttl=300, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(subqueries, fields=None):
+        """
+        Builds the cache key for a parsed query. Clause order doesn't change the result, so clauses are sorted
+
+        params: subqueries - a list of coerced [field, operator, value] subqueries, an AnyOf of such lists, or a Select
+                fields - the fields the result was projected to, or None for whole records
+        returns: a hashable key
+        """
+        if isinstance(subqueries, Select):
+            # The order matters for a Select, but only through its order by, so the filter is still sorted
+            clauses = ("select", ResultCache.key(subqueries.where)) + subqueries.key()
+        elif isinstance(subqueries, AnyOf):
+            # Branch order doesn't change the result either
+            clauses = ("||",) + tuple(sorted((ResultCache.key(branch) for branch in subqueries), key=repr))
+        else:
+            clauses = tuple(sorted((tuple(subquery) for subquery in subqueries), key=repr))
+        return clauses if fields is None else (clauses, tuple(fields))
+
+    def get(self, key, generation=None):
+        """
+        Looks up a cached result
+
+        params: key - the key from ResultCache.key
+                generation - the backend's current data generation
+        returns: the cached records, or None if there is no fresh entry
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, stored_generation, records = entry
+                if self._clock() - stored_at <= self.ttl and stored_generation == generation:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return records
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, records, generation=None):
+        """
+        Stores a result, evicting the least recently used entry if the cache is full
+
+        params: key - the key from ResultCache.key
+                records - the records matching the query
+                generation - the backend's data generation the records were read at
+        """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self._clock(), generation, records)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        """
+        Drops every cached result
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,289 @@
+import json
+import sys
+from array import array
+from backends import (AnyOf, CATEGORICAL_FIELDS, COLLECTION, DATA_FILE, NUMERICAL_FIELDS, QueryBackend, QueryPlan,
+                      compare, decode_cursor, encode_cursor, page_of, reduce_values, sorted_range)
+
+
+def bit_count(bits):
+    """
+    Counts the set bits of a row-id bitset
+
+    params: bits - the bitset
+    returns: the number of rows in the bitset
+    """
+    return bin(bits).count("1")
+
+
+def iter_rows(bits):
+    """
+    Lists the row ids in a bitset, lowest first
+
+    params: bits - the bitset
+    returns: a generator of row ids
+    """
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+
+def bits_of(rows, row_count):
+    """
+    Builds a row-id bitset from row ids
+
+    params: rows - an iterable of row ids
+            row_count - the number of rows in the table
+    returns: the bitset
+    """
+    if isinstance(rows, list) and len(rows) * 64 < row_count:
+        # A few rows, e.g. a value only one state has: shifting each one in beats filling a table-sized buffer
+        bits = 0
+        for row in rows:
+            bits |= 1 << row
+        return bits
+    flags = bytearray((row_count + 7) // 8)
+    for row in rows:
+        flags[row >> 3] |= 1 << (row & 7)
+    return int.from_bytes(flags, "little")
+
+
+class StateTable:
+    """
+    Columnar copy of the dataset. Categorical fields are dictionary encoded: each distinct
+    (interned) string keeps a bitset of the rows holding it. Numerical fields are array('q')
+    columns. Every field has a validity bitset marking the rows where it is present, so
+    optional fields cost nothing for states that don't have them.
+    Predicates evaluate to row-id bitsets, which compound queries combine with a bitwise AND.
+    """
+
+    def __init__(self, records):
+        self.uuids = []
+        # string -> bitset of the rows holding it
+        self.dictionaries = {field: {} for field in CATEGORICAL_FIELDS}
+        self.string_columns = {field: [] for field in CATEGORICAL_FIELDS}
+        self.int_columns = {field: array("q") for field in NUMERICAL_FIELDS}
+        self.validity = {field: 0 for field in CATEGORICAL_FIELDS + NUMERICAL_FIELDS}
+        # field -> (sorted values, row ids in that order), so range predicates are binary searches
+        self.sorted_rows = {}
+
+        # Rows are collected in lists and every bitset is built once at the end; or-ing a bit into a
+        # growing int for every row would copy the int each time
+        key_rows = {field: {} for field in CATEGORICAL_FIELDS}
+        present = {field: [] for field in CATEGORICAL_FIELDS + NUMERICAL_FIELDS}
+        for row, record in enumerate(records):
+            self.uuids.append(sys.intern(record["uuid"]))
+            for field, column in self.string_columns.items():
+                if field in record:
+                    value = sys.intern(record[field])
+                    column.append(value)
+                    key_rows[field].setdefault(value, []).append(row)
+                    present[field].append(row)
+                else:
+                    column.append(None)
+            for field, column in self.int_columns.items():
+                if field in record:
+                    column.append(record[field])
+                    present[field].append(row)
+                else:
+                    column.append(0)
+
+        row_count = len(self.uuids)
+        for field, rows_by_key in key_rows.items():
+            self.dictionaries[field] = {key: bits_of(rows, row_count) for key, rows in rows_by_key.items()}
+        for field, rows in present.items():
+            self.validity[field] = bits_of(rows, row_count)
+        for field, column in self.int_columns.items():
+            order = sorted(present[field], key=column.__getitem__)
+            self.sorted_rows[field] = (array("q", (column[row] for row in order)), array("i", order))
+        self.all_rows = (1 << row_count) - 1
+
+    @classmethod
+    def from_file(cls, data_file=DATA_FILE):
+        """
+        Loads the table from a JSON array of records
+
+        params: data_file - the dataset file
+        returns: the StateTable
+        """
+        with open(data_file, "r") as f:
+            return cls(json.load(f))
+
+    @classmethod
+    def from_firestore(cls, db, collection=COLLECTION):
+        """
+        Loads the table by streaming every document of a Firestore collection
+
+        params: db - the Firestore client
+                collection - the collection to read
+        returns: the StateTable
+        """
+        return cls(dict(doc.to_dict(), uuid=doc.id) for doc in db.collection(collection).stream())
+
+    def __len__(self):
+        return len(self.uuids)
+
+    def scan(self, field, op, value):
+        """
+        Evaluates a single comparison against a whole column
+
+        params: field - the field to filter on
+                op - the comparison operator
+                value - the already coerced value to compare against
+        returns: the bitset of matching rows
+        """
+        if field in self.int_columns:
+            if op not in ("in", "between") and (not isinstance(value, int) or isinstance(value, bool)):
+                return 0
+            # Ranges of the sorted index instead of a compare per row
+            values, order = self.sorted_rows[field]
+            return bits_of((row for start, end in sorted_range(values, op, value) for row in order[start:end]),
+                           len(self.uuids))
+
+        dictionary = self.dictionaries.get(field, {})
+        if op == "==":
+            return dictionary.get(value, 0)
+        elif op == "in":
+            bits = 0
+            for item in value:
+                bits |= dictionary.get(item, 0)
+            return bits
+        # Each distinct value is compared once, however many rows hold it
+        bits = 0
+        for key, key_bits in dictionary.items():
+            if compare(key, op, value):
+                bits |= key_bits
+        return bits
+
+    def row(self, row, fields=None):
+        """
+        Rebuilds the record stored in a row, without the fields it doesn't have
+
+        params: row - the row id
+                fields - the columns to read, or None for every column
+        returns: a dictionary of field values
+        """
+        record = {"uuid": self.uuids[row]}
+        for field, column in self.string_columns.items():
+            if (fields is None or field in fields) and column[row] is not None:
+                record[field] = column[row]
+        for field, column in self.int_columns.items():
+            if (fields is None or field in fields) and self.validity[field] >> row & 1:
+                record[field] = column[row]
+        return record
+
+
+class ColumnarBackend(QueryBackend):
+    """
+    Answers queries from a StateTable, intersecting the bitsets of each clause
+    """
+
+    def __init__(self, table=None):
+        self.table = table if table is not None else StateTable.from_file()
+
+    def estimate(self, field, op, value):
+        return bit_count(self.table.scan(field, op, value))
+
+    def plan(self, subqueries):
+        return QueryPlan("columnar scan + bitset AND", [tuple(subquery) for subquery in subqueries], [])
+
+    def access_path(self, field, op, value):
+        if field in self.table.sorted_rows:
+            return "range scan of the sorted index on %s" % field
+        if op == "==":
+            return "dictionary bitset lookup on %s" % field
+        return "dictionary scan of %s (%d keys)" % (field, len(self.table.dictionaries.get(field, {})))
+
+    def match_rows(self, subqueries):
+        """
+        Evaluates every subquery and ANDs the resulting bitsets, stopping as soon as no rows are left
+
+        params: subqueries - a list of [field, operator, value] subqueries
+        returns: the bitset of rows matching every subquery
+        """
+        bits = self.table.all_rows
+        for subquery in subqueries:
+            bits &= self.table.scan(*subquery)
+            if not bits:
+                break
+        return bits
+
+    def union_strategy(self, branches):
+        return "bitset OR of the branches"
+
+    def execute_any(self, branches, fields=None):
+        with self.tracer.span("scan"):
+            rows = 0
+            for branch in branches:
+                rows |= self.match_rows(branch)
+        with self.tracer.span("materialize"):
+            records = [self.table.row(row, fields) for row in iter_rows(rows)]
+        self.tracer.count("documents_read", len(records))
+        return records
+
+    def execute_page(self, parsed_query, page_size, cursor=None, fields=None):
+        after = decode_cursor(cursor, 1)[0] if cursor is not None else None
+        uuids = self.table.uuids
+        with self.tracer.span("scan"):
+            rows = 0
+            for branch in parsed_query if isinstance(parsed_query, AnyOf) else [parsed_query]:
+                rows |= self.match_rows(branch)
+            page, more = page_of((row for row in iter_rows(rows) if after is None or uuids[row] > after),
+                                 page_size, uuids.__getitem__)
+        with self.tracer.span("materialize"):
+            records = [self.table.row(row, fields) for row in page]
+        self.tracer.count("documents_read", len(records))
+        return records, encode_cursor([uuids[page[-1]]]) if more else None
+
+    def all_records(self, fields=None):
+        records = [self.table.row(row, fields) for row in range(len(self.table))]
+        self.tracer.count("documents_read", len(records))
+        return records
+
+    def select_strategy(self, select):
+        if select.ranked() or (select.aggregate != "count" and select.field not in self.table.int_columns):
+            return super().select_strategy(select)
+        elif select.aggregate == "count":
+            return "bit count of the matching rows"
+        return "%s over the %s column of the matching rows" % (select.aggregate, select.field)
+
+    def execute_select(self, select, fields=None):
+        if select.ranked() or (select.aggregate != "count" and select.field not in self.table.int_columns):
+            return super().execute_select(select, fields)
+        # Aggregates are computed from the bitset and the column without rebuilding any record
+        with self.tracer.span("scan"):
+            if not select.where:
+                rows = self.table.all_rows
+            elif isinstance(select.where, AnyOf):
+                rows = 0
+                for branch in select.where:
+                    rows |= self.match_rows(branch)
+            else:
+                rows = self.match_rows(select.where)
+        with self.tracer.span("aggregate"):
+            if select.aggregate == "count":
+                # Counted from the bitset; no row is read
+                self.tracer.count("documents_read", 0)
+                return bit_count(rows)
+            column = self.table.int_columns[select.field]
+            values = [column[row] for row in iter_rows(rows & self.table.validity[select.field])]
+            self.tracer.count("documents_read", len(values))
+            return reduce_values(values, select.aggregate)
+
+    def fetch(self, field, op, value):
+        rows = iter_rows(self.table.scan(field, op, value))
+        records = {self.table.uuids[row]: self.table.row(row) for row in rows}
+        self.tracer.count("documents_read", len(records))
+        return records
+
+    def execute(self, subqueries, fields=None):
+        if not subqueries:
+            return []
+        self.last_plan = self.plan(subqueries)
+        with self.tracer.span("scan"):
+            rows = self.match_rows(subqueries)
+        # Only the requested columns are read for each matching row
+        with self.tracer.span("materialize"):
+            records = [self.table.row(row, fields) for row in iter_rows(rows)]
+        self.tracer.count("documents_read", len(records))
+        return records
@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+
+CREDENTIALS_FILE = "cs3050-warmup-7457f-firebase-adminsdk-fbsvc-998bc9893a.json"
+
+
+class FirestoreConnection:
+    """
+    Creates the firebase app and Firestore client once per process so every query
+    and the upload path in admin.py reuse the same gRPC channel. Also records how
+    long connecting, the first query and later queries take.
+    """
+
+    def __init__(self, credentials_file=CREDENTIALS_FILE):
+        self.credentials_file = credentials_file
+        self.connect_time = None
+        self.first_query_time = None
+        self.query_times = []
+        self._db = None
+        self._async_db = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        """
+        Returns the shared Firestore client, logging in on first use
+
+        returns: the Firestore client
+        """
+        if self._db is None:
+            with self._lock:
+                if self._db is None:
+                    import firebase_admin
+                    from firebase_admin import credentials, firestore
+
+                    start = time.perf_counter()
+                    if os.getenv("FIRESTORE_EMULATOR_HOST"):
+                        # The local emulator needs no service account; the client connects to it anonymously
+                        from google.cloud import firestore as cloud_firestore
+                        self._db = cloud_firestore.Client()
+                    else:
+                        # Log in to the firebase system
+                        if not firebase_admin._apps:
+                            cred = credentials.Certificate(self.credentials_file)
+                            firebase_admin.initialize_app(cred)
+
+                        # Establish connection to Firestore DB
+                        self._db = firestore.client()
+                    self.connect_time = time.perf_counter() - start
+        return self._db
+
+    def async_client(self):
+        """
+        Returns the shared asyncio Firestore client, logging in on first use. It must only be used
+        from one event loop
+
+        returns: the AsyncClient
+        """
+        if self._async_db is None:
+            with self._lock:
+                if self._async_db is None:
+                    import firebase_admin
+                    from firebase_admin import credentials, firestore_async
+
+                    if os.getenv("FIRESTORE_EMULATOR_HOST"):
+                        from google.cloud import firestore as cloud_firestore
+                        self._async_db = cloud_firestore.AsyncClient()
+                    else:
+                        if not firebase_admin._apps:
+                            cred = credentials.Certificate(self.credentials_file)
+                            firebase_admin.initialize_app(cred)
+                        self._async_db = firestore_async.client()
+        return self._async_db
+
+    def warm_up(self, collection):
+        """
+        Connects and runs a one-document query so the gRPC channel is open before the first real query
+
+        params: collection - the name of the collection to read from
+        """
+        start = time.perf_counter()
+        list(self.client().collection(collection).limit(1).stream())
+        self.record_query(time.perf_counter() - start)
+
+    def record_query(self, seconds):
+        """
+        Records how long a query took. The first query is kept separately since it pays for opening the channel
+
+        params: seconds - the query's wall clock time
+        """
+        with self._lock:
+            if self.first_query_time is None:
+                self.first_query_time = seconds
+            else:
+                self.query_times.append(seconds)
+
+    def timings(self):
+        """
+        Summarizes the recorded timings
+
+        returns: a dictionary with the connect, first query and median steady-state query times in seconds
+        """
+        with self._lock:
+            query_times = sorted(self.query_times)
+        steady_state = query_times[len(query_times) // 2] if query_times else None
+        return {
+            "connect": self.connect_time,
+            "first_query": self.first_query_time,
+            "steady_state": steady_state,
+            "steady_state_queries": len(query_times),
+        }
+
+    def format_timings(self):
+        """
+        Formats the recorded timings for display
+
+        returns: a multi-line string with each timing in milliseconds
+        """
+        lines = []
+        for name, value in self.timings().items():
+            if name == "steady_state_queries":
+                lines.append("%s: %d" % (name, value))
+            elif value is None:
+                lines.append("%s: n/a" % name)
+            else:
+                lines.append("%s: %.2f ms" % (name, value * 1000))
+        return "\n".join(lines)
+
+
+# Shared by every FirestoreBackend and by admin.py
+connection = FirestoreConnection()
@@ -1,13 +1,246 @@
-import pyparsing as pp
-from prettytable import PrettyTable
+from collections import OrderedDict
 import json
 import sys
-import firebase_admin
-from firebase_admin import credentials, firestore
-from google.cloud.firestore_v1 import FieldFilter
+import threading
+import argparse
+import atexit
+import re
+from backends import AGGREGATES, SNAPSHOT_FILE, AnyOf, FirestoreBackend, LocalBackend, ReplicaBackend, Select
+from cache import ResultCache
+from results import RENDERERS, ResultSet, TextRenderer
+from connection import connection
+from tracing import NULL_TRACER, TextExporter, Tracer
+
+QUOTED = re.compile(r"""("[^"]*"|'[^']*')""")
+WHITESPACE = re.compile(r"\s+")
+
+
+class QueryGrammar:
+    """
+    Compiled query language grammar. The pyparsing grammar is built once per
+    process and shared by every instance, and parsed queries are kept in an
+    LRU cache keyed on the normalized query text.
+    """
+    _parser = None
+    _build_lock = threading.Lock()
+
+    def __init__(self, cache_size=256):
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def parser(cls):
+        """
+        Returns the compiled grammar, building it on first use
+
+        returns: the pyparsing element that parses a full query
+        """
+        if cls._parser is None:
+            with cls._build_lock:
+                if cls._parser is None:
+                    cls._parser = cls._build()
+        return cls._parser
+
+    @staticmethod
+    def _build():
+        # pyparsing is imported here rather than at module load so startup, 'help' and cached queries don't pay for it
+        import pyparsing as pp
+
+        # Packrat parsing memoizes the alternatives tried by single_query
+        pp.ParserElement.enable_packrat()
+
+        # Define possible tokens
+        region = pp.Literal("region")
+        population = pp.Literal("population")
+        capital = pp.Literal("capital")
+        governor = pp.Literal("governor")
+        num_counties = pp.Literal("num_counties")
+        popular_food = pp.Literal("popular_food")
+        state_bird = pp.Literal("state_bird")
+        help = pp.Literal("help")
+        exit = pp.Literal("exit")
+        next_page = pp.Literal("next")
+        explain = pp.Literal("explain")
+        analyze = pp.Literal("analyze")
+        state = pp.Literal("state") # doesn't work yet
+
+        numerical_op = pp.oneOf("!= == >= <= > <")
+        categorical_op = pp.oneOf("!= ==")
+        in_op = pp.Literal("in")
+        between_op = pp.Literal("between")
+        startswith_op = pp.Literal("startswith")
+
+        string = pp.Word(pp.alphas) | pp.QuotedString(
+            '"') | pp.QuotedString("'")
+        integer = pp.Word(pp.nums)
+
+        # Multi-value operands are grouped so every single query is still three tokens
+        string_list = pp.Group(pp.Suppress("[") + pp.delimitedList(string) + pp.Suppress("]"))
+        integer_list = pp.Group(pp.Suppress("[") + pp.delimitedList(integer) + pp.Suppress("]"))
+        integer_range = pp.Group(integer + pp.Suppress("and") + integer)
+
+        # Define the conditions each kind of field accepts
+        categorical_condition = categorical_op + string | in_op + string_list | startswith_op + string
+        text_condition = numerical_op + string | in_op + string_list | startswith_op + string
+        numerical_condition = numerical_op + integer | in_op + integer_list | between_op + integer_range
+
+        # Define possible queries
+        region_query = region + categorical_condition
+        population_query = population + numerical_condition
+        num_counties_query = num_counties + numerical_condition
+        capital_query = capital + categorical_condition
+        governor_query = governor + text_condition
+        food_query = popular_food + text_condition
+        bird_query = state_bird + text_condition
+        state_query = state + categorical_condition
+
+        # Build parser
+        single_query = (
+            region_query
+            | population_query
+            | num_counties_query
+            | capital_query
+            | governor_query
+            | food_query
+            | bird_query
+            | state_query
+        )
+        # && binds tighter than ||; parentheses group a sub-expression into a nested list
+        expression = pp.Forward()
+        operand = single_query | pp.Group(pp.Suppress("(") + expression + pp.Suppress(")"))
+        conjunction = pp.delimitedList(operand, delim="&&")
+        expression <<= conjunction + pp.ZeroOrMore(pp.Literal("||") + conjunction)
+
+        # count, sum(field), avg(field), min(field) and max(field) reduce the matching states to one value;
+        # order by and limit rank them. Every part is optional, but a query needs at least one
+        count = pp.Literal("count")
+        numerical_field = pp.oneOf("population num_counties")
+        reduction = pp.oneOf("sum avg min max") + pp.Suppress("(") + numerical_field + pp.Suppress(")")
+        aggregate = count | reduction
+        field = pp.oneOf("state region capital governor population num_counties popular_food state_bird")
+        order = pp.Literal("order") + pp.Suppress("by") + field + pp.Optional(pp.oneOf("asc desc"))
+        limit = pp.Literal("limit") + integer
+        statement = (
+            aggregate + pp.Optional(expression) + pp.Optional(order) + pp.Optional(limit)
+            | expression + pp.Optional(order) + pp.Optional(limit)
+            | order + pp.Optional(limit)
+            | limit
+        )
+
+        # 'explain' shows a query's plan; 'explain analyze' also runs it and profiles each stage
+        return help | exit | next_page | pp.Optional(explain + pp.Optional(analyze)) + statement
+
+    @classmethod
+    def built(cls):
+        """
+        Tells whether the grammar has been built yet
+
+        returns: True once parser() has been called
+        """
+        return cls._parser is not None
+
+    @staticmethod
+    def parse_exception():
+        """
+        Returns the exception raised for queries that can't be parsed, importing pyparsing on first use
+
+        returns: pyparsing.ParseException
+        """
+        import pyparsing as pp
+        return pp.ParseException
+
+    @staticmethod
+    def normalize(text):
+        """
+        Collapses surrounding and repeated whitespace so equivalent queries share a cache entry.
+        Quoted values are left as typed, since their whitespace is part of the value
+
+        params: text - the raw query text
+        returns: the normalized query text
+        """
+        parts = QUOTED.split(text)
+        # split keeps the quoted strings at the odd positions
+        return "".join(part if index % 2 else WHITESPACE.sub(" ", part) for index, part in enumerate(parts)).strip()
+
+    def parse(self, text):
+        """
+        Parses a query into a list of tokens, reusing earlier results for repeated queries. Lists of
+        values and parenthesized groups are nested lists; everything else is flat
+
+        params: text - the user's query
+        returns: a new list of tokens (raises pp.ParseException if the query is invalid)
+        """
+        key = self.normalize(text)
+        # Commands are answered without building the grammar
+        if key in ("help", "exit", "next"):
+            return [key]
+        with self._lock:
+            tokens = self._cache.get(key)
+            if tokens is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self.copy_tokens(tokens)
+            self.misses += 1
+
+        tokens = tuple(self.parser().parse_string(key, parse_all=True).as_list())
+
+        with self._lock:
+            self._cache[key] = tokens
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return self.copy_tokens(tokens)
+
+    @staticmethod
+    def copy_tokens(tokens):
+        """
+        Copies parsed tokens, including the nested lists of in/between values and parenthesized
+        groups, so callers can't change the cached copy
+
+        params: tokens - the parsed tokens
+        returns: a new list of tokens
+        """
+        return [QueryGrammar.copy_tokens(token) if isinstance(token, list) else token for token in tokens]
+
+    def clear(self):
+        """
+        Empties the parse cache and resets the hit/miss counters
+        """
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
 
 
 class StateQueryEngine:
+    # Shared by every engine so the grammar and parse cache are built once per process
+    grammar = QueryGrammar()
+
+    def __init__(self, backend=None, result_cache=None, renderer=None, tracer=None):
+        # Firestore is the default store; LocalBackend answers queries from us_states_data.json
+        self.backend = backend if backend is not None else FirestoreBackend()
+        self.result_cache = result_cache if result_cache is not None else ResultCache()
+        # Presentation is separate from retrieval; see results.RENDERERS for the output formats
+        self.renderer = renderer if renderer is not None else TextRenderer()
+        # Profiling is off unless a Tracer is given (--profile); the null tracer makes every span a no-op
+        self.tracer = NULL_TRACER
+        if tracer is not None:
+            self.set_tracer(tracer)
+        # Results are shown page_size states at a time when set (--page-size); 'next' shows the following page
+        self.page_size = None
+        self.pending_page = None
+
+    def set_tracer(self, tracer):
+        """
+        Sets the tracer that times each stage of a query, for the engine and its backend
+
+        params: tracer - a tracing.Tracer, or tracing.NULL_TRACER to turn profiling off
+        """
+        self.tracer = tracer
+        self.backend.tracer = tracer
+
     # noinspection PyMethodMayBeStatic
     def display_welcome_screen(self):
         border = "\n" + "*" * 48 + "\n"
@@ -43,6 +276,8 @@ class StateQueryEngine:
 
     # noinspection PyMethodMayBeStatic
     def display_help_screen(self):
+        from prettytable import PrettyTable
+
         ## show keywords, and give example queries
         keyword_table = PrettyTable(
             ["Keywords", "Example Query", "Example Return"])
@@ -62,6 +297,18 @@ class StateQueryEngine:
             ["popular_food", ">>> popular_food == 'clam chowder'", "massachusetts"])
         keyword_table.add_row(
             ["state_bird", ">>> state_bird == 'hermit thrush'", "vermont"])
+        keyword_table.add_row(
+            ["count", ">>> count region == northeast", "9"])
+        keyword_table.add_row(
+            ["sum / avg / min / max", ">>> avg(num_counties) region == west", "the average, e.g. 33.77"])
+        keyword_table.add_row(
+            ["order by / limit", ">>> order by population desc limit 2", "california, texas"])
+        keyword_table.add_row(
+            ["next", ">>> next", "the next page of the last query's results"])
+        keyword_table.add_row(
+            ["explain", ">>> explain region == northeast && population > 5000000", "the query plan"])
+        keyword_table.add_row(
+            ["explain analyze", ">>> explain analyze state == vermont", "vermont + time per stage"])
         keyword_table.align = "l"
         print(keyword_table)
 
@@ -82,6 +329,16 @@ class StateQueryEngine:
             ["not equal to", "!=", ">>> state_bird != hermit thrush", "alabama, arkansas, etc."])
         logic_table.add_row(
             ["and", "&&", ">>> capital == montpelier && governor == 'phil scott'", "vermont"])
+        logic_table.add_row(
+            ["or", "||", ">>> region == northeast || region == south", "alabama, arkansas, etc."])
+        logic_table.add_row(
+            ["grouping", "( )", ">>> (region == west || region == south) && num_counties > 150", "georgia, texas"])
+        logic_table.add_row(
+            ["one of", "in [ ]", ">>> state in [vermont, maine]", "maine, vermont"])
+        logic_table.add_row(
+            ["in range", "between", ">>> population between 1000000 and 1100000", "delaware"])
+        logic_table.add_row(
+            ["starts with", "startswith", ">>> state startswith new", "new hampshire, new jersey, etc."])
         logic_table.align = "l"
         print(logic_table)
 
@@ -97,250 +354,499 @@ class StateQueryEngine:
         returns: The parsed user's query OR error message if query is entered incorrectly
         """
 
-        # Define possible tokens
-        region = pp.Literal("region")
-        population = pp.Literal("population")
-        capital = pp.Literal("capital")
-        governor = pp.Literal("governor")
-        num_counties = pp.Literal("num_counties")
-        popular_food = pp.Literal("popular_food")
-        state_bird = pp.Literal("state_bird")
-        help = pp.Literal("help")
-        exit = pp.Literal("exit")
-        state = pp.Literal("state") # doesn't work yet
-
-        numerical_op = pp.oneOf("!= == >= <= > <")
-        categorical_op = pp.oneOf("!= ==")
+        # 'explain analyze <query>' runs the query and prints where the time went, so profiling has to be on
+        # before the query is parsed
+        if user_input.split()[:2] == ["explain", "analyze"]:
+            self.explain_analyze(user_input)
+            return
 
-        string = pp.Word(pp.alphas) | pp.QuotedString(
-            '"') | pp.QuotedString("'")
-        integer = pp.Word(pp.nums)
+        with self.tracer.trace(user_input):
+            self.answer(user_input)
 
-        # Define possible queries
-        region_query = region + categorical_op + string
-        population_query = population + numerical_op + integer
-        num_counties_query = num_counties + numerical_op + integer
-        capital_query = capital + categorical_op + string
-        governor_query = governor + numerical_op + string
-        food_query = popular_food + numerical_op + string
-        bird_query = state_bird + numerical_op + string
-        state_query = state + categorical_op + string
-
-        # Build parser
-        single_query = (
-            region_query
-            | population_query
-            | num_counties_query
-            | capital_query
-            | governor_query
-            | food_query
-            | bird_query
-            | state_query
-            | help
-            | exit
-        )
-        query_parser = pp.delimitedList(single_query, delim="&&")
+    def answer(self, user_input):
+        """
+        Runs a command or query typed at the prompt
 
+        params: user_input - the user's query
+        """
         try:
-            # Parse query into a list of tokens
-            tokens_list = query_parser.parse_string(user_input, parse_all=True)
+            # Parse query into a nested list of single queries
+            command, parsed_query = self.parse_command(user_input)
 
             # Display help screen on event user types 'help'
-            if tokens_list[0] == "help":
+            if command == "help":
                 self.display_help_screen()
                 return
 
             # Prompt exit on event user types 'exit'
-            elif tokens_list[0] == "exit":
+            elif command == "exit":
                 self.program_exit()
                 return
 
-            # Format list into nested list of single queries for compound queries
-            result = []
-            if len(tokens_list) >= 3:
-                while tokens_list:
-                    query = tokens_list[:3]
-                    result.append(query)
-                    tokens_list = tokens_list[3:]
+            # Show the next page of the last query's results
+            elif command == "next":
+                self.next_page()
+                return
+
+            # Show how the query would run without running it
+            elif command == "explain":
+                self.explain(parsed_query)
+                return
 
-            # Pass nested list of queries to query engine
-            self.query_database(result)
+            # Pass nested list of queries to query engine ('explain analyze' runs under a profiler)
+            self.query_database(parsed_query)
 
-        except pp.ParseException:
+        except self.grammar.parse_exception():
             # Print error message for when user enters invalid input that parser cannot interpret
             print("Error. Could not parse input.\nType 'help' to see how to properly format a query.")
 
+    def parse_query(self, user_input):
+        """
+        Parses the user's input into a nested list of single queries
+
+        params: user_input - the user's query
+        returns: a list of [field, operator, value] subqueries, an AnyOf or Select of them, or the command
+                 ("help", "exit", "next", "explain" or "explain analyze") (raises pp.ParseException if the query
+                 is entered incorrectly)
+        """
+        command, parsed_query = self.parse_command(user_input)
+        return parsed_query if command is None else command
+
+    def parse_command(self, user_input):
+        """
+        Parses the user's input into a command and a nested list of single queries
+
+        params: user_input - the user's query
+        returns: (command, subqueries) where command is None for plain queries, or "help", "exit", "next",
+                 "explain" or "explain analyze", and subqueries is a Select for queries with an aggregate, order
+                 or limit (raises pp.ParseException if the query is entered incorrectly)
+        """
+        if self.tracer.enabled and not self.grammar.built():
+            # Time building the grammar separately from parsing
+            with self.tracer.span("grammar"):
+                self.grammar.parser()
+
+        # Parse query into a list of tokens
+        hits = self.grammar.hits
+        with self.tracer.span("parse"):
+            tokens_list = self.grammar.parse(user_input)
+        if self.grammar.hits > hits:
+            self.tracer.count("parse_cache_hits")
+        else:
+            self.tracer.count("parse_cache_misses")
+        if tokens_list[0] in ("help", "exit", "next"):
+            return tokens_list[0], []
+
+        command = None
+        if tokens_list[0] == "explain":
+            if tokens_list[1:2] == ["analyze"]:
+                command, tokens_list = "explain analyze", tokens_list[2:]
+            else:
+                command, tokens_list = "explain", tokens_list[1:]
+
+        select, tokens_list = self.split_select(tokens_list)
+
+        # Format list into nested list of single queries for compound queries
+        where = []
+        if tokens_list:
+            branches = self.group_subqueries(tokens_list)
+            where = branches[0] if len(branches) == 1 else AnyOf(branches)
+        if select is None:
+            return command, where
+        select.where = where
+        return command, select
+
+    # noinspection PyMethodMayBeStatic
+    def split_select(self, tokens_list):
+        """
+        Splits a leading aggregate and a trailing order by and limit off the tokens of a query
+
+        params: tokens_list - the parsed tokens, without any explain prefix
+        returns: (select, tokens) where select is a Select with an empty filter, or None if the query
+                 has no aggregate, order or limit, and tokens are the tokens of the filter
+        """
+        select = Select([])
+        if tokens_list[:1] == ["count"]:
+            select.aggregate, tokens_list = "count", tokens_list[1:]
+        elif tokens_list[:1] and tokens_list[0] in AGGREGATES:
+            select.aggregate, select.field, tokens_list = tokens_list[0], tokens_list[1], tokens_list[2:]
+        if tokens_list[-2:-1] == ["limit"]:
+            select.limit, tokens_list = int(tokens_list[-1]), tokens_list[:-2]
+        if tokens_list[-3:-2] == ["order"] and tokens_list[-1] in ("asc", "desc"):
+            select.order_by, select.descending = tokens_list[-2], tokens_list[-1] == "desc"
+            tokens_list = tokens_list[:-3]
+        elif tokens_list[-2:-1] == ["order"]:
+            select.order_by, tokens_list = tokens_list[-1], tokens_list[:-2]
+        if select.aggregate is None and not select.ranked():
+            return None, tokens_list
+        return select, tokens_list
+
+    def group_subqueries(self, tokens_list):
+        """
+        Groups tokens into single queries, expanding || and parentheses so the result is a list of
+        && branches: (a || b) && c becomes [[a, c], [b, c]]
+
+        params: tokens_list - the parsed tokens, with parenthesized groups as nested lists
+        returns: a list of branches, each a list of [field, operator, value] subqueries
+        """
+        branches = []
+        term = [[]]
+        position = 0
+        while position < len(tokens_list):
+            token = tokens_list[position]
+            if token == "||":
+                # The && term so far is one complete branch (or several, if it held a group)
+                branches.extend(term)
+                term = [[]]
+                position += 1
+            elif isinstance(token, list):
+                group = self.group_subqueries(token)
+                term = [prefix + [list(subquery) for subquery in branch] for prefix in term for branch in group]
+                position += 1
+            else:
+                term = [prefix + [tokens_list[position:position + 3]] for prefix in term]
+                position += 3
+        branches.extend(term)
+        return branches
+
+    # noinspection PyMethodMayBeStatic
+    def normalize_query(self, parsed_query):
+        """
+        Converts the values of a parsed query in place to the types and capitalization stored in the database
+
+        params: parsed_query - a list of [field, operator, value] subqueries, an AnyOf of them, or a Select
+        returns: the same query, normalized
+        """
+        if isinstance(parsed_query, Select):
+            self.normalize_query(parsed_query.where)
+            return parsed_query
+        if isinstance(parsed_query, AnyOf):
+            for branch in parsed_query:
+                self.normalize_query(branch)
+            return parsed_query
+        for subquery in parsed_query:
+            subquery[2] = self.normalize_value(subquery[2])
+        return parsed_query
+
+    def normalize_value(self, value):
+        """
+        Converts a query value to the type and capitalization stored in the database
+
+        params: value - a value from a subquery, or a list of them for in and between
+        returns: the normalized value (lists become tuples)
+        """
+        if isinstance(value, (list, tuple)):
+            return tuple(self.normalize_value(item) for item in value)
+        if isinstance(value, str):
+            # Convert numbers to int type. isnumeric() also accepts characters such as '½' that int() rejects
+            if value.isdecimal():
+                return int(value)
+            # Capitalize proper nouns
+            return value.title()
+        return value
+
+    def run_query(self, parsed_query, fields=None):
+        """
+        Retrieves the documents that satisfy every subquery, reusing cached results for repeated queries
+
+        params: parsed_query - a list of [field, operator, value] subqueries, an AnyOf of such lists, or a Select
+                fields - the fields to return for each record, or None for every field
+        returns: a list of matching records, or the value of a Select's aggregate
+        """
+        self.normalize_query(parsed_query)
+        cache_key = self.result_cache.key(parsed_query, fields)
+        generation = self.backend.generation()
+        records = self.result_cache.get(cache_key, generation)
+        if records is None:
+            self.tracer.count("result_cache_misses")
+            with self.tracer.span("execute"):
+                if isinstance(parsed_query, Select):
+                    records = self.backend.execute_select(parsed_query, fields)
+                elif isinstance(parsed_query, AnyOf):
+                    records = self.backend.execute_any(parsed_query, fields)
+                else:
+                    records = self.backend.execute(parsed_query, fields)
+            self.result_cache.put(cache_key, records, generation)
+        else:
+            self.tracer.count("result_cache_hits")
+        return records
+
+    def run_page(self, parsed_query, fields=None, cursor=None, page_size=None):
+        """
+        Retrieves one page of the documents that satisfy a query, reusing cached pages. Pages are in
+        uuid order, except on Firestore, which orders them on the query's inequality field first
+
+        params: parsed_query - a list of [field, operator, value] subqueries, or an AnyOf of such lists
+                fields - the fields to return for each record, or None for every field
+                cursor - the token returned with the previous page, or None for the first page
+                page_size - the number of records per page (defaults to the engine's page_size)
+        returns: (records, the cursor token of the next page or None if this is the last page)
+        """
+        page_size = page_size or self.page_size
+        self.normalize_query(parsed_query)
+        cache_key = ("page", page_size, cursor, self.result_cache.key(parsed_query, fields))
+        generation = self.backend.generation()
+        page = self.result_cache.get(cache_key, generation)
+        if page is None:
+            self.tracer.count("result_cache_misses")
+            with self.tracer.span("execute"):
+                page = self.backend.execute_page(parsed_query, page_size, cursor, fields)
+            self.result_cache.put(cache_key, page, generation)
+        else:
+            self.tracer.count("result_cache_hits")
+        return page
+
+    def pages(self, parsed_query):
+        """
+        Tells whether a query's results are shown a page at a time. Selects aren't: they are already
+        reduced to one value or cut off by their limit
+
+        params: parsed_query - the parsed user's query
+        returns: True if the engine has a page size and the query lists states
+        """
+        return bool(self.page_size) and not isinstance(parsed_query, Select)
+
+    def show_page(self, parsed_query, fields, cursor=None):
+        """
+        Prints one page of a query's results and remembers where the next one starts
+
+        params: parsed_query - the parsed user's query
+                fields - the fields the output shows
+                cursor - the token of the page to show, or None for the first page
+        returns: the ResultSet of the page
+        """
+        records, next_cursor = self.run_page(parsed_query, fields, cursor)
+        result_set = ResultSet(parsed_query, records)
+        self.pending_page = (parsed_query, fields, next_cursor) if next_cursor is not None else None
+        if result_set:
+            self.final_answer(result_set, parsed_query)
+            if self.pending_page is not None:
+                print("Type 'next' to see more states.\n")
+        return result_set
+
+    def next_page(self):
+        """
+        Prints the next page of the last paged query's results
+        """
+        if self.pending_page is None:
+            print("No more results.\n")
+            return
+        parsed_query, fields, cursor = self.pending_page
+        try:
+            return self.show_page(parsed_query, fields, cursor)
+        except Exception:
+            print("Error. Could not retrieve records from the database.\nType 'help' to see how to properly format a query.")
+
     def query_database(self, parsed_query):
         """
         Makes a call to the firestore database to retrieve specific records
         associated with the input
 
         params: parsed_query - the parsed user's query
-        returns: filtered_docs - a dictionary of documents matching the user's query passed to the final_answer function
-                 parsed_query - the parsed user's query passed to the final_answer function
+        returns: result_set - a ResultSet of the records matching the user's query, after they are
+                 rendered by the final_answer function
         """
-        # Log in to the firebase system
-        if not firebase_admin._apps:
-            cred = credentials.Certificate(
-                'cs3050-warmup-7457f-firebase-adminsdk-fbsvc-998bc9893a.json')
-            firebase_admin.initialize_app(cred)
-
-        # Establish connection to Firestore DB
-        db = firestore.client()
+        # Make sure the backend is ready before running any subqueries (the Firestore client is only created once)
+        with self.tracer.span("connect"):
+            self.backend.connect()
 
-        # Loop through subqueries in the parsed query, retrieving corresponding documents for each
-        doc_sets = [] # List to store retrieved documents
         try:
-            for subquery in parsed_query:
-                # Convert numbers to int type
-                if subquery[2].isnumeric():
-                    subquery[2] = int(subquery[2])
-                # Capitalize proper nouns
-                elif isinstance(subquery[2], str):
-                    subquery[2] = subquery[2].title()
-
-                # Retrieve documents from the database
-                docs = (
-                    db.collection("us_states_data")
-                    .where(filter=FieldFilter(subquery[0], subquery[1], subquery[2]))
-                    .stream()
-                )
-
-                doc_set = {}
-                for doc in docs:
-                    doc_set[doc.id] = doc.to_dict()
-                doc_sets.append(doc_set)
-
-            # Compute the intersection of the records to satisfy compound queries
-            if doc_sets:
-                common_doc_ids = set(doc_sets[0].keys())
-                for doc_set in doc_sets[1:]:
-                    common_doc_ids.intersection_update(doc_set.keys())
-                filtered_docs = [doc_sets[0][doc_uuid] for doc_uuid in common_doc_ids]
-            else:
-                filtered_docs = []
-
-            if filtered_docs == []:
+            if isinstance(parsed_query, Select) and parsed_query.aggregate is not None:
+                # An aggregate is a single value, computed without sending back the records
+                value = self.run_query(parsed_query)
+                with self.tracer.span("render"):
+                    self.renderer.render_aggregate(parsed_query, value, sys.stdout)
+                return value
+
+            # Only fetch the fields the output for this kind of query shows
+            fields = ResultSet.required_fields(parsed_query)
+            if self.pages(parsed_query):
+                # Rows are printed as soon as the first page arrives; 'next' fetches the rest
+                result_set = self.show_page(parsed_query, fields)
+                if not result_set:
+                    print("Error reading input. Did you misspell something?")
+                    return
+                return result_set
+            result_set = ResultSet(parsed_query, self.run_query(parsed_query, fields))
+
+            if not result_set:
                 print("Error reading input. Did you misspell something?")
             else:
-                return self.final_answer(filtered_docs, parsed_query)
+                self.final_answer(result_set, parsed_query)
+                return result_set
         except Exception:
             print("Error. Could not retrieve records from the database.\nType 'help' to see how to properly format a query.")
 
-    # noinspection PyMethodMayBeStatic
+    def run_batch(self, lines, out, workers=8):
+        """
+        Runs queries non-interactively and writes one JSON result per query, in input order.
+        Identical queries are only run once and distinct queries run concurrently
+
+        params: lines - an iterable of queries, one per line (blank lines and lines starting with # are skipped).
+                        A line can also be {"query": ..., "cursor": ...} to resume a paged query
+                out - a text stream the results are written to
+                workers - the number of queries run at the same time
+        returns: the number of queries answered
+        """
+        queries = []  # (query text, cache key, parse error)
+        unique_queries = {}
+        for text, cursor, parsed_query, error in self.read_batch(lines):
+            if error is not None:
+                queries.append((text, None, error))
+                continue
+            key = (self.result_cache.key(self.normalize_query(parsed_query)), cursor)
+            unique_queries.setdefault(key, (parsed_query, cursor))
+            queries.append((text, key, None))
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.backend.connect()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {key: executor.submit(self.answer_batch_query, parsed_query, cursor)
+                       for key, (parsed_query, cursor) in unique_queries.items()}
+            for text, key, error in queries:
+                result = {"query": text}
+                if error is None:
+                    try:
+                        result.update(futures[key].result())
+                    except Exception as e:
+                        error = "Could not retrieve records from the database: %s" % e
+                if error is not None:
+                    result["error"] = error
+                out.write(json.dumps(result, default=str) + "\n")
+        return len(queries)
+
+    def read_batch(self, lines):
+        """
+        Parses the lines of a batch file
+
+        params: lines - an iterable of query text or {"query": ..., "cursor": ...} lines
+        returns: a generator of (query text, cursor, parsed query, error) for every line that isn't blank or
+                 a comment, where error is None unless the line can't be run
+        """
+        for line in lines:
+            text = line.strip()
+            if not text or text.startswith("#"):
+                continue
+            cursor = None
+            if text.startswith("{"):
+                # A query resumed from the next_cursor of an earlier result
+                try:
+                    request = json.loads(text)
+                    text, cursor = request["query"], request.get("cursor")
+                except (ValueError, KeyError, TypeError):
+                    yield text, None, None, "Could not parse input"
+                    continue
+            try:
+                parsed_query = self.parse_query(text)
+            except self.grammar.parse_exception():
+                yield text, cursor, None, "Could not parse input"
+                continue
+            if isinstance(parsed_query, str):
+                yield text, cursor, None, "'%s' is not supported in batch mode" % parsed_query
+                continue
+            try:
+                # Normalizing is idempotent, so callers normalizing again get the same query
+                self.normalize_query(parsed_query)
+            except (ValueError, TypeError) as e:
+                yield text, cursor, None, "Could not read the query's values: %s" % e
+                continue
+            if cursor is not None and not self.pages(parsed_query):
+                yield text, cursor, None, "A cursor needs a page size (--page-size) and a query that lists states"
+            else:
+                yield text, cursor, parsed_query, None
+
+    def answer_batch_query(self, parsed_query, cursor=None):
+        """
+        Runs one query of a batch
+
+        params: parsed_query - the parsed query
+                cursor - the token of the page to return, or None for the first page
+        returns: the fields to add to the query's result: its results, and the cursor of the next page when
+                 there is one
+        """
+        if not self.pages(parsed_query):
+            return {"results": self.run_query(parsed_query)}
+        records, next_cursor = self.run_page(parsed_query, cursor=cursor)
+        if next_cursor is None:
+            return {"results": records}
+        return {"results": records, "next_cursor": next_cursor}
+
     def final_answer(self, records, queries):
         """
         Processes the data into user-friendly, readable format and prints it to the console
 
-        params: records - a dictionary of documents matching the user's query
+        params: records - the records matching the user's query (a ResultSet or a list of documents)
                 queries - a formatted list of the user's query
         returns: void
         """
-        # Gets the output from a user's query and formats it into a list
-        output = json.loads(json.dumps(records))
-        output = [list(data.values()) for data in output]
-
-        # Checks the length of the query list and assigns relevant category, operator, and value
-        if len(queries) == 1:
-            category = queries[0][0]
-            operator = queries[0][1]
-            value = queries[0][2]
-        elif len(queries) > 1:
-            category = "compound"
-            operator = None
-            value = None
-        else:
-            category = None
-            operator = None
-            value = None
-
-        # Adds context for the print statement depending on what category of query the user asked
-        if category == "state":
-            context = "info"
-        elif category == "region":
-            context = "States in the %s region: \n" % value
-        elif category == "capital":
-            context = "%s is the capital of: \n" % value
-        elif category == "governor":
-            context = "%s is the Governor of: \n" % value
-        elif category == "population":
-            if operator == "==":
-                context = f"States with a population of {value:,}: \n"
-            elif operator == "!=":
-                context = f"States with a population not exactly equal to {value:,}: \n"
-            else:
-                context = f"States with a population of {'over' if operator in ['>', '>='] else 'less than'} {value:,}: \n"
-        elif category == "num_counties":
-            if operator == "==":
-                context = f"States with exactly {value} counties: \n"
-            elif operator == "!=":
-                context = f"States that don't have exactly {value} counties: \n"
+        result_set = records if isinstance(records, ResultSet) else ResultSet(queries, records)
+        with self.tracer.span("render"):
+            self.renderer.render(result_set, sys.stdout)
+
+    def explain(self, parsed_query):
+        """
+        Prints how a query would run without running it: the predicates after normalization, the
+        order the clauses run in, how each one is looked up, its estimated number of matching records,
+        and anything checked client-side
+
+        params: parsed_query - the parsed user's query
+        returns: the backend's QueryPlan, a list of them for a query with ||, or None for a Select without a filter
+        """
+        if isinstance(parsed_query, Select):
+            select = self.normalize_query(parsed_query)
+            if select.where:
+                plan = self.explain(select.where)
             else:
-                context = f"States with {'over' if operator in ['>', '>='] else 'less than'} %s counties: \n" % value
-        elif category == "popular_food":
-            context = "States with %s as their popular food: \n" % value
-        elif category == "state_bird":
-            context = "States with the %s as their state bird: \n" % value
-        elif category == "compound":
-            context = "States that satisfy all queries: \n"
-        else:
-            context = None
-
-        # Formats queried data into digestible output to be printed
-        # Checks for special print conditions for select categories that require different output
-        if context:
-            if category == "population":
-                tmp = []
-                for i in range(len(output)):
-                    response = f"{output[i][5]} = {output[i][2]:,}"
-                    tmp.append(response)
-                print(context + "\n".join(tmp))
-                print("\n")
-            elif category == "num_counties":
-                tmp = []
-                for i in range(len(output)):
-                    response = f"{output[i][5]} = {output[i][6]}"
-                    tmp.append(response)
-                print(context + "\n".join(tmp))
-                print("\n")
-            elif category == "state":
-                print(f"Info for: {output[0][5]}")
-                print(f"Region: {output[0][4]}")
-                print(f"Capital: {output[0][0]}")
-                print(f"Governor: {output[0][3]}")
-                print(f"Population: {output[0][2]:,}")
-                print(f"Number of Counties: {output[0][6]}")
-                # Check to see if a state has the optional state_bird or popular_food fields
-                checking = True
-                while checking:
-                    foods = ["Clam Chowder", "Buckeye Candies"]
-                    birds = ["Yellowhammer", "Willow Ptarmigan", "Cactus Wren", "California Quail", "Blue Hen Chicken", "Brown Thrasher", "Western Meadowlark", "Northern Cardinal", "Black-capped Chickadee", "Northern Mockingbird", "Mountain Bluebird", "Rhode Island Red", "Hermit Thrush"]
-                    try:
-                        value = output[0][7]
-                    except IndexError:
-                        pass
-                    try:
-                        value2 = output[0][8]
-                        print(f"Popular Food: {value}")
-                        print(f"State Bird: {value2}")
-                        break
-                    except IndexError:
-                        pass
-                    if value in foods:
-                        print(f"Popular Food: {value}")
-                        checking = False
-                    elif value in birds:
-                        print(f"State Bird: {value}")
-                        checking = False
-                    else:
-                        break
-                print("\n")
-            else: # Default output statement
-                tmp = []
-                for i in range(len(output)):
-                    tmp.append(output[i][5])
-                print(context + "\n".join(tmp))
-                print("\n")
+                print("Query: every state")
+                plan = None
+            print("%s: %s" % (select.label(), self.backend.select_strategy(select)))
+            return plan
+        if not parsed_query:
+            print("Error. Could not parse input.\nType 'help' to see how to properly format a query.")
+            return
+        self.normalize_query(parsed_query)
+        if isinstance(parsed_query, AnyOf):
+            print("Query: " + " || ".join("(%s)" % self.format_subqueries(branch) for branch in parsed_query))
+            print("Union: %s" % self.backend.union_strategy(parsed_query))
+            plans = []
+            for number, branch in enumerate(parsed_query, 1):
+                plans.append(self.backend.explain(branch))
+                print("Branch %d: %s" % (number, plans[-1].describe()))
+            return plans
+        plan = self.backend.explain(parsed_query)
+        print("Query: " + self.format_subqueries(parsed_query))
+        print(plan.describe())
+        return plan
+
+    # noinspection PyMethodMayBeStatic
+    def format_subqueries(self, subqueries):
+        """
+        Formats normalized subqueries for display
+
+        params: subqueries - a list of [field, operator, value] subqueries
+        returns: the subqueries joined by &&
+        """
+        return " && ".join("%s %s %r" % tuple(subquery) for subquery in subqueries)
+
+    def explain_analyze(self, user_input):
+        """
+        Runs a query with profiling on and prints how long each stage took, how many documents
+        were read and whether the caches were hit
+
+        params: user_input - the query, including the 'explain analyze' prefix
+        """
+        previous = self.tracer
+        tracer = previous if previous.enabled else Tracer()
+        self.set_tracer(tracer)
+        try:
+            with tracer.trace(user_input) as trace:
+                self.answer(user_input)
+        finally:
+            self.set_tracer(previous)
+        # A --profile tracer already exported this trace
+        if tracer is not previous:
+            print(trace.format())
 
     def main(self):
         self.display_welcome_screen()
@@ -350,5 +856,97 @@ class StateQueryEngine:
             self.validate_and_parse_input(user_query)
 
 if __name__ == "__main__":
-    engine = StateQueryEngine()
-    engine.main()
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(description="State Query Engine")
+    arg_parser.add_argument("--local", action="store_true",
+                            help="answer queries from us_states_data.json instead of Firestore")
+    arg_parser.add_argument("--columnar", action="store_true",
+                            help="answer queries from a columnar copy of us_states_data.json")
+    arg_parser.add_argument("--replica", action="store_true",
+                            help="keep a local copy of the Firestore collection in sync and answer queries from it")
+    arg_parser.add_argument("--snapshot", nargs="?", const=SNAPSHOT_FILE, metavar="FILE",
+                            help="answer queries from a snapshot written by 'admin.py export-snapshot', refreshing it "
+                                 "in the background when Firestore has a newer upload")
+    arg_parser.add_argument("--connect", metavar="URL",
+                            help="send queries to a server started with --serve, e.g. http://127.0.0.1:8765")
+    arg_parser.add_argument("--cache-size", type=int, default=128,
+                            help="number of query results to keep cached (0 disables the cache)")
+    arg_parser.add_argument("--cache-ttl", type=float, default=300,
+                            help="seconds a cached query result stays valid")
+    arg_parser.add_argument("--format", choices=sorted(RENDERERS), default="text",
+                            help="how query results are printed")
+    arg_parser.add_argument("--page-size", type=int,
+                            help="number of states shown at a time, read with Firestore cursors (50 at the prompt; "
+                                 "batch results are only paged when this is given; 0 shows them all)")
+    arg_parser.add_argument("--timings", action="store_true",
+                            help="print Firestore connect, first-query and steady-state latencies")
+    arg_parser.add_argument("--profile", action="store_true",
+                            help="print how long each stage of a query took, and its document reads and cache hits")
+    arg_parser.add_argument("--batch", metavar="FILE",
+                            help="run the queries in FILE (one per line, '-' for stdin) and print JSON Lines results")
+    arg_parser.add_argument("--output", metavar="FILE", help="write batch results to FILE instead of stdout")
+    arg_parser.add_argument("--workers", type=int, default=8, help="queries run concurrently in batch mode")
+    arg_parser.add_argument("--async", dest="use_async", action="store_true",
+                            help="run batch queries on the asyncio Firestore client")
+    arg_parser.add_argument("--serve", action="store_true",
+                            help="keep the engine warm and answer queries over HTTP")
+    arg_parser.add_argument("--host", default="127.0.0.1", help="interface the server listens on")
+    arg_parser.add_argument("--port", type=int, default=8765, help="port the server listens on")
+    args = arg_parser.parse_args()
+
+    backend = None
+    if args.connect:
+        from server import RemoteBackend
+        backend = RemoteBackend(args.connect)
+    elif args.snapshot:
+        from snapshot import SnapshotBackend
+        try:
+            backend = SnapshotBackend(args.snapshot)
+        except FileNotFoundError:
+            sys.exit("No snapshot at %s; create one with 'python admin.py export-snapshot'" % args.snapshot)
+        except ValueError as e:
+            sys.exit(str(e))
+    elif args.replica:
+        backend = ReplicaBackend()
+    elif args.columnar:
+        from columnar import ColumnarBackend
+        backend = ColumnarBackend()
+    elif args.local:
+        backend = LocalBackend()
+
+    if args.use_async:
+        from async_engine import AsyncStateQueryEngine
+        engine = AsyncStateQueryEngine(backend, ResultCache(args.cache_size, args.cache_ttl), args.workers)
+    else:
+        engine = StateQueryEngine(backend, ResultCache(args.cache_size, args.cache_ttl))
+    engine.renderer = RENDERERS[args.format]()
+    if args.page_size is None:
+        # Batch consumers get whole results unless they ask for pages and follow next_cursor
+        args.page_size = 0 if args.batch else 50
+    engine.page_size = args.page_size or None
+    if args.profile:
+        engine.set_tracer(Tracer([TextExporter(sys.stderr)]))
+    if args.timings and (backend is None or args.replica):
+        atexit.register(lambda: print("\n" + connection.format_timings(), file=sys.stderr))
+
+    if args.serve:
+        from server import serve
+        serve(engine, args.host, args.port)
+        sys.exit()
+
+    # Connect before the first prompt so the first query doesn't pay for it
+    engine.backend.warm_up()
+    if args.batch:
+        query_file = sys.stdin if args.batch == "-" else open(args.batch, "r")
+        output_file = open(args.output, "w") if args.output else sys.stdout
+        try:
+            if args.use_async:
+                import asyncio
+                asyncio.run(engine.run_batch_async(query_file, output_file))
+            else:
+                engine.run_batch(query_file, output_file, args.workers)
+        finally:
+            for stream in (query_file, output_file):
+                if stream not in (sys.stdin, sys.stdout):
+                    stream.close()
+    else:
+        engine.main()
\ No newline at end of file
@@ -0,0 +1,371 @@
+import csv
+import json
+import sys
+from backends import AnyOf, Select
+
+# Display order of the fields of a state record
+FIELDS = ("state", "region", "capital", "governor", "population", "num_counties", "popular_food", "state_bird")
+
+# Fields shown for each query category, beyond the state name
+CATEGORY_COLUMNS = {
+    "state": FIELDS,
+    "population": ("state", "population"),
+    "num_counties": ("state", "num_counties"),
+}
+
+# How an aggregate's value is introduced
+AGGREGATE_LABELS = {
+    "count": "Number of states",
+    "sum": "Total %s",
+    "avg": "Average %s",
+    "min": "Lowest %s",
+    "max": "Highest %s",
+}
+
+
+def field_name(field):
+    """
+    Names a field in a sentence
+
+    params: field - the field
+    returns: e.g. "number of counties" for num_counties
+    """
+    return "number of counties" if field == "num_counties" else field.replace("_", " ")
+
+
+class StateRecord:
+    """
+    A single state returned by a query. Optional fields the state doesn't have are None
+    """
+    __slots__ = ("uuid",) + FIELDS
+
+    def __init__(self, uuid=None, state=None, region=None, capital=None, governor=None, population=None,
+                 num_counties=None, popular_food=None, state_bird=None):
+        self.uuid = uuid
+        self.state = state
+        self.region = region
+        self.capital = capital
+        self.governor = governor
+        self.population = population
+        self.num_counties = num_counties
+        self.popular_food = popular_food
+        self.state_bird = state_bird
+
+    @classmethod
+    def from_dict(cls, doc):
+        """
+        Builds a record from a document, ignoring fields the record doesn't know about
+
+        params: doc - a dictionary of field values
+        returns: the StateRecord
+        """
+        return cls(**{field: doc[field] for field in cls.__slots__ if field in doc})
+
+    def get(self, field):
+        return getattr(self, field)
+
+    def to_dict(self, fields=FIELDS):
+        """
+        Converts the record to a dictionary, leaving out fields the state doesn't have
+
+        params: fields - the fields to include
+        returns: a dictionary of field values
+        """
+        return {field: getattr(self, field) for field in fields if getattr(self, field) is not None}
+
+    def __eq__(self, other):
+        return isinstance(other, StateRecord) and all(
+            getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    def __repr__(self):
+        return "StateRecord(%s)" % ", ".join("%s=%r" % item for item in self.to_dict(self.__slots__).items())
+
+
+class ResultSet:
+    """
+    The records matching a query together with the query itself. Rows are converted to
+    StateRecords as they are read, so iterating a result set streams it
+    """
+
+    def __init__(self, queries, docs):
+        # For a Select, queries is its filter and the Select is kept for its order
+        self.select = queries if isinstance(queries, Select) else None
+        self.queries = queries.where if self.select is not None else queries
+        self._docs = docs
+
+    @staticmethod
+    def query_category(queries):
+        """
+        Finds the kind of query the results answer
+
+        params: queries - a formatted list of the user's query
+        returns: a field name for single queries, "compound" for compound queries, "any" for queries with ||,
+                 "all" for a Select without a filter
+        """
+        if isinstance(queries, Select):
+            return ResultSet.query_category(queries.where) or "all"
+        if isinstance(queries, AnyOf):
+            return "any"
+        if len(queries) == 1:
+            return queries[0][0]
+        elif len(queries) > 1:
+            return "compound"
+        return None
+
+    @classmethod
+    def required_fields(cls, queries):
+        """
+        Lists the fields a query's results need, so backends can skip fetching the rest
+
+        params: queries - a formatted list of the user's query
+        returns: a tuple of field names, including uuid
+        """
+        fields = ("uuid",) + CATEGORY_COLUMNS.get(cls.query_category(queries), ("state",))
+        # States ranked on a field show it
+        if isinstance(queries, Select) and queries.order_by is not None and queries.order_by not in fields:
+            fields += (queries.order_by,)
+        return fields
+
+    @property
+    def category(self):
+        """
+        The kind of query the results answer: a field name for single queries, "compound" for compound queries
+        """
+        return self.query_category(self.select if self.select is not None else self.queries)
+
+    @property
+    def order_by(self):
+        """
+        The field the results are ranked on, or None
+        """
+        return self.select.order_by if self.select is not None else None
+
+    @property
+    def columns(self):
+        """
+        The fields worth showing for this query
+        """
+        return self.required_fields(self.select if self.select is not None else self.queries)[1:]
+
+    def __iter__(self):
+        for doc in self._docs:
+            yield doc if isinstance(doc, StateRecord) else StateRecord.from_dict(doc)
+
+    def __bool__(self):
+        return bool(self._docs)
+
+
+class TextRenderer:
+    """
+    Prints results as readable sentences, the default output of the query engine
+    """
+
+    # noinspection PyMethodMayBeStatic
+    def context(self, result_set):
+        """
+        Builds the sentence introducing the results, depending on what category of query the user asked
+
+        params: result_set - the query results
+        returns: the sentence, or None if the query has no category
+        """
+        category = result_set.category
+        if category is None:
+            return None
+        operator = value = None
+        if category not in ("compound", "any", "all"):
+            operator = result_set.queries[0][1]
+            value = result_set.queries[0][2]
+
+        if operator in ("in", "between", "startswith"):
+            return self.range_context(category, operator, value)
+        elif category == "state":
+            return "info"
+        elif category == "region":
+            return "States in the %s region: \n" % value
+        elif category == "capital":
+            return "%s is the capital of: \n" % value
+        elif category == "governor":
+            return "%s is the Governor of: \n" % value
+        elif category == "population":
+            if operator == "==":
+                return f"States with a population of {value:,}: \n"
+            elif operator == "!=":
+                return f"States with a population not exactly equal to {value:,}: \n"
+            else:
+                return f"States with a population of {'over' if operator in ['>', '>='] else 'less than'} {value:,}: \n"
+        elif category == "num_counties":
+            if operator == "==":
+                return f"States with exactly {value} counties: \n"
+            elif operator == "!=":
+                return f"States that don't have exactly {value} counties: \n"
+            else:
+                return f"States with {'over' if operator in ['>', '>='] else 'less than'} %s counties: \n" % value
+        elif category == "popular_food":
+            return "States with %s as their popular food: \n" % value
+        elif category == "state_bird":
+            return "States with the %s as their state bird: \n" % value
+        elif category == "compound":
+            return "States that satisfy all queries: \n"
+        elif category == "any":
+            return "States that satisfy any of the queries: \n"
+        elif category == "all":
+            if result_set.order_by is None:
+                return "States: \n"
+            return "States by %s%s: \n" % (field_name(result_set.order_by),
+                                           ", largest first" if result_set.select.descending else "")
+        return None
+
+    # noinspection PyMethodMayBeStatic
+    def range_context(self, field, operator, value):
+        """
+        Builds the sentence introducing the results of an in, between or startswith query
+
+        params: field - the queried field
+                operator - in, between or startswith
+                value - the normalized value of the query
+        returns: the sentence
+        """
+        name = field.replace("_", " ")
+        if operator == "startswith":
+            return "States whose %s starts with %s: \n" % (name, value)
+        values = [f"{item:,}" if isinstance(item, int) else item for item in value]
+        if operator == "between":
+            return "States with a %s between %s and %s: \n" % (name, values[0], values[1])
+        return "States whose %s is %s: \n" % (name, " or ".join(values))
+
+    def render(self, result_set, out=None):
+        """
+        Prints each row as soon as it is read
+
+        params: result_set - the query results
+                out - the text stream to write to (defaults to stdout)
+        """
+        out = out or sys.stdout
+        category = result_set.category
+        context = self.context(result_set)
+        if not context:
+            return
+
+        # Checks for special print conditions for select categories that require different output
+        if context == "info":
+            for record in result_set:
+                print(f"Info for: {record.state}", file=out)
+                print(f"Region: {record.region}", file=out)
+                print(f"Capital: {record.capital}", file=out)
+                print(f"Governor: {record.governor}", file=out)
+                print(f"Population: {record.population:,}", file=out)
+                print(f"Number of Counties: {record.num_counties}", file=out)
+                # Only print the optional popular_food and state_bird fields when the state has them
+                if record.popular_food is not None:
+                    print(f"Popular Food: {record.popular_food}", file=out)
+                if record.state_bird is not None:
+                    print(f"State Bird: {record.state_bird}", file=out)
+                break
+        else:
+            out.write(context)
+            # States ranked on a number show it, like the results of a query on that number
+            shown = category if category in ("population", "num_counties") else result_set.order_by
+            for record in result_set:
+                if shown == "population":
+                    out.write(f"{record.state} = {record.population:,}\n")
+                elif shown == "num_counties":
+                    out.write(f"{record.state} = {record.num_counties}\n")
+                else:  # Default output statement
+                    out.write(f"{record.state}\n")
+        print("\n", file=out)
+
+    # noinspection PyMethodMayBeStatic
+    def render_aggregate(self, select, value, out=None):
+        """
+        Prints the value of an aggregate
+
+        params: select - the Select the value answers
+                value - the aggregate, or None if no state had the field
+                out - the text stream to write to (defaults to stdout)
+        """
+        out = out or sys.stdout
+        label = AGGREGATE_LABELS[select.aggregate]
+        if select.field is not None:
+            label = label % field_name(select.field)
+        if select.where:
+            label += " matching the query"
+        if value is None:
+            out.write(f"{label}: no states matched\n")
+        elif isinstance(value, float):
+            out.write(f"{label}: {value:,.2f}\n")
+        else:
+            out.write(f"{label}: {value:,}\n")
+        print("\n", file=out)
+
+
+class TableRenderer:
+    """
+    Prints results as a PrettyTable. The table is sized from every row, so it is printed once all rows are read
+    """
+
+    # noinspection PyMethodMayBeStatic
+    def render(self, result_set, out=None):
+        from prettytable import PrettyTable
+
+        out = out or sys.stdout
+        table = PrettyTable(list(result_set.columns))
+        for record in result_set:
+            table.add_row(["" if record.get(field) is None else record.get(field) for field in result_set.columns])
+        table.align = "l"
+        print(table, file=out)
+
+    # noinspection PyMethodMayBeStatic
+    def render_aggregate(self, select, value, out=None):
+        from prettytable import PrettyTable
+
+        out = out or sys.stdout
+        table = PrettyTable([select.label()])
+        table.add_row(["" if value is None else value])
+        table.align = "l"
+        print(table, file=out)
+
+
+class JsonLinesRenderer:
+    """
+    Writes one JSON object per row
+    """
+
+    # noinspection PyMethodMayBeStatic
+    def render(self, result_set, out=None):
+        out = out or sys.stdout
+        for record in result_set:
+            out.write(json.dumps(record.to_dict(result_set.columns)) + "\n")
+
+    # noinspection PyMethodMayBeStatic
+    def render_aggregate(self, select, value, out=None):
+        out = out or sys.stdout
+        out.write(json.dumps({"aggregate": select.label(), "value": value}) + "\n")
+
+
+class CsvRenderer:
+    """
+    Writes a CSV header followed by one row per record
+    """
+
+    # noinspection PyMethodMayBeStatic
+    def render(self, result_set, out=None):
+        out = out or sys.stdout
+        writer = csv.writer(out)
+        writer.writerow(result_set.columns)
+        for record in result_set:
+            writer.writerow(["" if record.get(field) is None else record.get(field) for field in result_set.columns])
+
+    # noinspection PyMethodMayBeStatic
+    def render_aggregate(self, select, value, out=None):
+        out = out or sys.stdout
+        writer = csv.writer(out)
+        writer.writerow([select.label()])
+        writer.writerow(["" if value is None else value])
+
+
+RENDERERS = {
+    "text": TextRenderer,
+    "table": TableRenderer,
+    "jsonl": JsonLinesRenderer,
+    "csv": CsvRenderer,
+}
@@ -0,0 +1,276 @@
+import json
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from backends import CATEGORICAL_FIELDS, NUMERICAL_FIELDS, OPERATORS, AnyOf, QueryBackend, QueryPlan, Select
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+QUERY_OPERATORS = tuple(OPERATORS) + ("in", "between", "startswith")
+
+
+def check_clauses(subqueries):
+    """
+    Checks the clauses of a request body, so a malformed one is a bad request rather than a server error
+
+    params: subqueries - the decoded "subqueries" list, or one branch of "any_of"
+    returns: the clauses as [field, operator, value] lists (raises ValueError if one is malformed)
+    """
+    if not isinstance(subqueries, list):
+        raise ValueError("expected a list of [field, operator, value] clauses, got %r" % (subqueries,))
+    for clause in subqueries:
+        if not isinstance(clause, list) or len(clause) != 3:
+            raise ValueError("%r is not a [field, operator, value] clause" % (clause,))
+        field, op, value = clause
+        if field not in CATEGORICAL_FIELDS + NUMERICAL_FIELDS:
+            raise ValueError("unknown field %r" % (field,))
+        if op not in QUERY_OPERATORS:
+            raise ValueError("unknown operator %r" % (op,))
+        if op == "in" and not isinstance(value, list):
+            raise ValueError("in needs a list of values")
+        if op == "between" and (not isinstance(value, list) or len(value) != 2):
+            raise ValueError("between needs a [low, high] pair")
+    return [list(clause) for clause in subqueries]
+
+
+def check_branches(branches):
+    """
+    Checks the branches of an "any_of" request body
+
+    params: branches - the decoded "any_of" list
+    returns: the branches as lists of [field, operator, value] lists (raises ValueError if one is malformed)
+    """
+    if not isinstance(branches, list) or not branches:
+        raise ValueError("any_of must be a non-empty list of branches")
+    return [check_clauses(branch) for branch in branches]
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles one HTTP request to the query server:
+        POST /query  body {"query": "<query text>"}, {"subqueries": [[field, operator, value], ...]} or
+                     {"any_of": [[[field, operator, value], ...], ...]} for || queries, or
+                     {"select": {...}} (see backends.Select.to_dict) for aggregates and order by/limit,
+                     optionally with "fields": [field, ...] to return only those fields, and "page_size": n
+                     to return one page; the response's "next_cursor" is sent back as "cursor" for the next one
+        GET  /stats  request count, latency percentiles and cache hit rates
+        GET  /health liveness check
+    """
+    server_version = "StateQueryServer/1.0"
+
+    def send_json(self, status, body, latency=None):
+        payload = json.dumps(body, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if latency is not None:
+            self.send_header("X-Query-Latency-Ms", "%.3f" % (latency * 1000))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        elif self.path == "/stats":
+            self.send_json(200, self.server.stats())
+        else:
+            self.send_json(404, {"error": "Unknown path %s" % self.path})
+
+    def do_POST(self):
+        if self.path != "/query":
+            self.send_json(404, {"error": "Unknown path %s" % self.path})
+            return
+
+        start = time.perf_counter()
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            status, body = 200, self.server.answer(request)
+        except (ValueError, KeyError, TypeError) as e:
+            status, body = 400, {"error": "Bad request: %s" % e}
+        except self.server.engine.grammar.parse_exception():
+            status, body = 400, {"error": "Could not parse input"}
+        except Exception as e:
+            status, body = 500, {"error": "Could not retrieve records from the database: %s" % e}
+        latency = time.perf_counter() - start
+        self.server.record_latency(latency)
+        body["latency_ms"] = round(latency * 1000, 3)
+        self.send_json(status, body, latency)
+
+    def log_message(self, format, *args):
+        # Per-request latency is reported in the response and /stats instead of stderr
+        pass
+
+
+class QueryServer(ThreadingHTTPServer):
+    """
+    Long-running HTTP server that keeps a StateQueryEngine, and with it the compiled grammar,
+    the backend connection and the caches, warm between requests. Each request runs on its own thread
+    """
+    daemon_threads = True
+
+    def __init__(self, engine, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        super().__init__((host, port), QueryRequestHandler)
+        self.engine = engine
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def answer(self, request):
+        """
+        Runs the query in a request
+
+        params: request - a dictionary holding "query" (query text), "subqueries", "any_of" or "select",
+                          and optionally "fields", "page_size" and "cursor"
+        returns: the response body
+        """
+        if "select" in request:
+            body = request["select"]
+            if isinstance(body, dict):
+                if body.get("any_of"):
+                    check_branches(body.get("where"))
+                else:
+                    check_clauses(body.get("where", []))
+            parsed_query = Select.from_dict(body)
+            text = None
+        elif "any_of" in request:
+            parsed_query = AnyOf(check_branches(request["any_of"]))
+            text = None
+        elif "subqueries" in request:
+            parsed_query = check_clauses(request["subqueries"])
+            text = None
+        else:
+            text = request["query"]
+            parsed_query = self.engine.parse_query(text)
+            if isinstance(parsed_query, str):
+                return {"query": text, "error": "'%s' is not supported by the server" % parsed_query}
+        fields = request.get("fields")
+        fields = tuple(fields) if fields is not None else None
+        page_size = request.get("page_size")
+        if page_size is not None and not isinstance(parsed_query, Select):
+            if not isinstance(page_size, int) or page_size <= 0:
+                raise ValueError("page_size must be a positive integer")
+            records, next_cursor = self.engine.run_page(parsed_query, fields, request.get("cursor"), page_size)
+            return {"query": text, "subqueries": parsed_query, "results": records, "next_cursor": next_cursor}
+        records = self.engine.run_query(parsed_query, fields)
+        if isinstance(parsed_query, Select):
+            # results is the aggregate's value for a select with one
+            return {"query": text, "select": parsed_query.to_dict(), "results": records}
+        return {"query": text, "subqueries": parsed_query, "results": records}
+
+    def record_latency(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def stats(self):
+        """
+        Summarizes the requests served so far
+
+        returns: a dictionary of request count, p50/p99 latency and cache hit/miss counts
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000, 3)
+
+        return {
+            "requests": len(latencies),
+            "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99),
+            "parse_cache": {"hits": self.engine.grammar.hits, "misses": self.engine.grammar.misses},
+            "result_cache": {"hits": self.engine.result_cache.hits, "misses": self.engine.result_cache.misses},
+        }
+
+
+class RemoteBackend(QueryBackend):
+    """
+    Sends queries to a running QueryServer, so the REPL can be a thin client that doesn't
+    have to connect to Firestore or load the dataset itself
+    """
+
+    def __init__(self, url="http://%s:%d" % (DEFAULT_HOST, DEFAULT_PORT), timeout=30):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def warm_up(self):
+        with urllib.request.urlopen(self.url + "/health", timeout=self.timeout) as response:
+            response.read()
+
+    def plan(self, subqueries):
+        # Every clause is sent as is; the server's own backend decides how to run them
+        return QueryPlan("sent to the query server", [tuple(subquery) for subquery in subqueries], [])
+
+    def access_path(self, field, op, value):
+        return "planned by %s" % self.url
+
+    def post(self, body, fields=None):
+        """
+        Sends a query to the server
+
+        params: body - the request body, holding "subqueries", "any_of" or "select"
+                fields - the fields to return for each record, or None for every field
+        returns: the response body, whose "results" are the matching records or an aggregate's value
+        """
+        if fields is not None:
+            body["fields"] = list(fields)
+        payload = json.dumps(body).encode("utf-8")
+        request = urllib.request.Request(self.url + "/query", data=payload,
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def execute(self, subqueries, fields=None):
+        return self.post({"subqueries": [list(subquery) for subquery in subqueries]}, fields)["results"]
+
+    def execute_any(self, branches, fields=None):
+        # The whole || query goes in one request; the server merges the branches
+        body = {"any_of": [[list(subquery) for subquery in branch] for branch in branches]}
+        return self.post(body, fields)["results"]
+
+    def union_strategy(self, branches):
+        return "sent to the query server"
+
+    def execute_select(self, select, fields=None):
+        # Aggregates and top-k are computed by the server, so only the result comes back
+        return self.post({"select": select.to_dict()}, fields)["results"]
+
+    def select_strategy(self, select):
+        return "sent to the query server"
+
+    def execute_page(self, parsed_query, page_size, cursor=None, fields=None):
+        # The server pages with its own backend; its cursor tokens are passed back unchanged
+        if isinstance(parsed_query, AnyOf):
+            body = {"any_of": [[list(subquery) for subquery in branch] for branch in parsed_query]}
+        else:
+            body = {"subqueries": [list(subquery) for subquery in parsed_query]}
+        body["page_size"] = page_size
+        if cursor is not None:
+            body["cursor"] = cursor
+        response = self.post(body, fields)
+        return response["results"], response.get("next_cursor")
+
+    def fetch(self, field, op, value):
+        return {record["uuid"]: record for record in self.execute([[field, op, value]])}
+
+
+def serve(engine, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """
+    Warms the engine up and answers queries until interrupted
+
+    params: engine - the StateQueryEngine answering queries
+            host - the interface to listen on (localhost by default)
+            port - the port to listen on
+    """
+    engine.backend.warm_up()
+    engine.grammar.parser()
+    server = QueryServer(engine, host, port)
+    print("Serving queries on http://%s:%d (Ctrl+C to stop)" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,341 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from backends import (CATEGORICAL_FIELDS, COLLECTION, META_COLLECTION, NUMERICAL_FIELDS, SNAPSHOT_FILE, UPLOAD_DOCUMENT,
+                      Statistics)
+from columnar import ColumnarBackend, StateTable, bits_of, iter_rows
+from connection import connection as shared_connection
+
+MAGIC = b"STATESNP"
+# Bumped whenever the layout changes; older files are rebuilt instead of misread
+FORMAT_VERSION = 1
+# magic, format version, reserved, header offset, header length
+PREAMBLE = struct.Struct("<8sIIQQ")
+# Sections start on 8-byte boundaries so integer columns can be cast in place
+ALIGNMENT = 8
+
+
+class CodedColumn:
+    """
+    Categorical column read from a snapshot. Each row holds the position of its value in the
+    field's dictionary, or -1 when the state doesn't have the field
+    """
+
+    def __init__(self, keys, codes):
+        self.keys = keys
+        self.codes = codes
+
+    def __getitem__(self, row):
+        code = self.codes[row]
+        return None if code < 0 else self.keys[code]
+
+    def __len__(self):
+        return len(self.codes)
+
+
+class PostingBitsets:
+    """
+    The value -> row bitset dictionary of a categorical field, read from the snapshot's posting
+    lists. A value's bitset is only built the first time it is looked up
+    """
+
+    def __init__(self, keys, postings, offsets, row_count):
+        self.keys = keys
+        self.positions = {key: position for position, key in enumerate(keys)}
+        self.postings = postings
+        self.offsets = offsets
+        self.row_count = row_count
+        self._bitsets = {}
+
+    def get(self, key, default=None):
+        position = self.positions.get(key)
+        if position is None:
+            return default
+        bits = self._bitsets.get(position)
+        if bits is None:
+            rows = self.postings[self.offsets[position]:self.offsets[position + 1]]
+            bits = self._bitsets[position] = bits_of(rows, self.row_count)
+        return bits
+
+    def __getitem__(self, key):
+        bits = self.get(key)
+        if bits is None:
+            raise KeyError(key)
+        return bits
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def items(self):
+        return ((key, self.get(key)) for key in self.keys)
+
+
+def write_snapshot(path, records, generation=None, collection=COLLECTION):
+    """
+    Writes records, with the indexes and statistics the query engine needs, to a snapshot file.
+    Every field is stored as a column: categorical fields as a dictionary, a code per row and
+    the rows holding each value; numerical fields as int64 values, sorted values and the rows in
+    that order. The file is written next to path and moved into place, so readers never see a
+    partial snapshot
+
+    params: path - the snapshot file
+            records - an iterable of state records
+            generation - the upload generation the records were read at, or None if unknown
+            collection - the collection the records came from
+    returns: the number of records written
+    """
+    table = StateTable(records)
+    row_count = len(table)
+    sections = {}
+
+    def add(name, data):
+        if isinstance(data, array):
+            data = data.tobytes()
+        sections[name] = data
+
+    def bitset_bytes(bits):
+        return bits.to_bytes((row_count + 7) // 8, "little")
+
+    add("uuids", "\n".join(table.uuids).encode("utf-8"))
+    for field in CATEGORICAL_FIELDS:
+        dictionary = table.dictionaries[field]
+        keys = list(dictionary)
+        positions = {key: position for position, key in enumerate(keys)}
+        add("keys:" + field, "\0".join(keys).encode("utf-8"))
+        add("codes:" + field, array("i", (positions[value] if value is not None else -1
+                                          for value in table.string_columns[field])))
+        postings, offsets = array("i"), array("q", [0])
+        for key in keys:
+            postings.extend(iter_rows(dictionary[key]))
+            offsets.append(len(postings))
+        add("postings:" + field, postings)
+        add("offsets:" + field, offsets)
+        add("valid:" + field, bitset_bytes(table.validity[field]))
+    for field in NUMERICAL_FIELDS:
+        values, order = table.sorted_rows[field]
+        add("int:" + field, table.int_columns[field])
+        add("sorted:" + field, values)
+        add("order:" + field, order)
+        add("valid:" + field, bitset_bytes(table.validity[field]))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(b"\0" * PREAMBLE.size)
+        locations = {}
+        for name, data in sections.items():
+            f.write(b"\0" * (-f.tell() % ALIGNMENT))
+            locations[name] = [f.tell(), len(data)]
+            f.write(data)
+        header = json.dumps({
+            "collection": collection,
+            "generation": generation,
+            "rows": row_count,
+            "byteorder": sys.byteorder,
+            "created_at": time.time(),
+            "sections": locations,
+        }).encode("utf-8")
+        header_offset = f.tell()
+        f.write(header)
+        f.seek(0)
+        f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, 0, header_offset, len(header)))
+    os.replace(tmp_path, path)
+    return row_count
+
+
+def export_snapshot(path=SNAPSHOT_FILE, db=None, collection=COLLECTION):
+    """
+    Writes a snapshot of a Firestore collection, stamped with the upload generation admin.py last wrote
+
+    params: path - the snapshot file
+            db - the Firestore client (the shared client by default)
+            collection - the collection to export
+    returns: the number of records written
+    """
+    db = db if db is not None else shared_connection.client()
+    # Read before the documents, so an upload that lands during the export makes the snapshot stale, not wrong
+    generation = upload_generation(db)
+    records = (dict(doc.to_dict(), uuid=doc.id) for doc in db.collection(collection).stream())
+    return write_snapshot(path, records, generation, collection)
+
+
+def upload_generation(db):
+    """
+    Reads the generation admin.py bumps after every upload
+
+    params: db - the Firestore client
+    returns: the generation, or None if nothing has been uploaded
+    """
+    snapshot = db.collection(META_COLLECTION).document(UPLOAD_DOCUMENT).get()
+    return (snapshot.to_dict() or {}).get("generation")
+
+
+class Snapshot:
+    """
+    A snapshot file mapped into memory. Columns, sorted indexes and posting lists are read in
+    place from the mapping, so opening a snapshot costs a header parse rather than a JSON parse
+    of the whole dataset
+    """
+
+    def __init__(self, path=SNAPSHOT_FILE):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mapping) < PREAMBLE.size:
+            raise ValueError("%s is not a state snapshot" % path)
+        magic, version, _, header_offset, header_length = PREAMBLE.unpack_from(self.mapping)
+        if magic != MAGIC:
+            raise ValueError("%s is not a state snapshot" % path)
+        if version != FORMAT_VERSION:
+            raise ValueError("%s has snapshot format %d, expected %d; export it again"
+                             % (path, version, FORMAT_VERSION))
+        self.header = json.loads(self.mapping[header_offset:header_offset + header_length])
+        if self.header["byteorder"] != sys.byteorder:
+            raise ValueError("%s was written on a %s-endian machine; export it again"
+                             % (path, self.header["byteorder"]))
+        self.generation = self.header["generation"]
+        self.collection = self.header["collection"]
+        self.rows = self.header["rows"]
+
+    def section(self, name, typecode=None):
+        """
+        Reads a section of the file without copying it
+
+        params: name - the section name, e.g. "int:population"
+                typecode - the array typecode to view it as, or None for bytes
+        returns: a memoryview of the section
+        """
+        offset, length = self.header["sections"][name]
+        view = memoryview(self.mapping)[offset:offset + length]
+        return view.cast(typecode) if typecode is not None else view
+
+    def strings(self, name, separator):
+        text = str(self.section(name), "utf-8")
+        return text.split(separator) if text else []
+
+    def bitset(self, name):
+        return int.from_bytes(self.section(name), "little")
+
+    def table(self):
+        """
+        Builds a StateTable over the mapped columns
+
+        returns: the StateTable
+        """
+        table = StateTable([])
+        table.uuids = self.strings("uuids", "\n")
+        for field in CATEGORICAL_FIELDS:
+            keys = [sys.intern(key) for key in self.strings("keys:" + field, "\0")]
+            table.string_columns[field] = CodedColumn(keys, self.section("codes:" + field, "i"))
+            table.dictionaries[field] = PostingBitsets(keys, self.section("postings:" + field, "i"),
+                                                       self.section("offsets:" + field, "q"), self.rows)
+            table.validity[field] = self.bitset("valid:" + field)
+        for field in NUMERICAL_FIELDS:
+            table.int_columns[field] = self.section("int:" + field, "q")
+            table.sorted_rows[field] = (self.section("sorted:" + field, "q"), self.section("order:" + field, "i"))
+            table.validity[field] = self.bitset("valid:" + field)
+        table.all_rows = (1 << self.rows) - 1
+        return table
+
+    def statistics(self):
+        """
+        Reads the cardinality statistics stored with the snapshot
+
+        returns: the Statistics
+        """
+        statistics = Statistics([])
+        statistics.count = self.rows
+        for field in CATEGORICAL_FIELDS:
+            keys = self.strings("keys:" + field, "\0")
+            offsets = self.section("offsets:" + field, "q")
+            statistics.value_counts[field] = {key: offsets[position + 1] - offsets[position]
+                                              for position, key in enumerate(keys)}
+        for field in NUMERICAL_FIELDS:
+            statistics.sorted_values[field] = self.section("sorted:" + field, "q")
+        return statistics
+
+
+class SnapshotBackend(ColumnarBackend):
+    """
+    ColumnarBackend serving a memory-mapped snapshot, so queries are answered as soon as the file
+    is opened. In the background it compares the snapshot's generation with the upload stamp
+    admin.py writes, and exports and swaps in a new snapshot when the collection has changed
+    """
+
+    def __init__(self, path=SNAPSHOT_FILE, connection=None, refresh=True):
+        self.path = path
+        self.connection = connection if connection is not None else shared_connection
+        self.refresh_enabled = refresh
+        # Held while the table is swapped, so a query never mixes rows of two snapshots
+        self.lock = threading.RLock()
+        self._refresher = None
+        self.load(Snapshot(path))
+
+    def load(self, snapshot):
+        """
+        Starts serving a snapshot
+
+        params: snapshot - the opened Snapshot
+        """
+        table = snapshot.table()
+        statistics = snapshot.statistics()
+        with self.lock:
+            self.snapshot = snapshot
+            self.table = table
+            self.statistics = statistics
+
+    def generation(self):
+        return self.snapshot.generation
+
+    def warm_up(self):
+        if self.refresh_enabled and self._refresher is None:
+            self._refresher = threading.Thread(target=self.refresh, daemon=True)
+            self._refresher.start()
+
+    def refresh(self):
+        """
+        Exports a new snapshot if the collection has been uploaded since this one was written
+
+        returns: True if a new snapshot was swapped in
+        """
+        try:
+            db = self.connection.client()
+            if upload_generation(db) == self.snapshot.generation:
+                return False
+            export_snapshot(self.path, db, self.snapshot.collection)
+            self.load(Snapshot(self.path))
+            return True
+        except Exception as e:
+            # Offline or not logged in: keep answering from the snapshot we have
+            print("Could not check %s against Firestore: %s" % (self.path, e), file=sys.stderr)
+            return False
+
+    def estimate(self, field, op, value):
+        # Planning reads the stored statistics instead of scanning a column
+        return self.statistics.estimate(field, op, value)
+
+    def execute(self, subqueries, fields=None):
+        with self.lock:
+            return super().execute(subqueries, fields)
+
+    def execute_any(self, branches, fields=None):
+        with self.lock:
+            return super().execute_any(branches, fields)
+
+    def execute_select(self, select, fields=None):
+        with self.lock:
+            return super().execute_select(select, fields)
+
+    def execute_page(self, parsed_query, page_size, cursor=None, fields=None):
+        with self.lock:
+            return super().execute_page(parsed_query, page_size, cursor, fields)
@@ -1,9 +1,32 @@
-from query import StateQueryEngine
+from query import StateQueryEngine, QueryGrammar
+from backends import (META_COLLECTION, UPLOAD_DOCUMENT, AnyOf, FirestoreBackend, LocalBackend, ReplicaBackend, Select,
+                      Statistics, compare)
+from connection import FirestoreConnection
+from cache import ResultCache
+import admin
+import benchmarks
+import snapshot
+import asyncio
+from async_engine import AsyncStateQueryEngine
+from columnar import ColumnarBackend, StateTable
+from server import QueryServer, RemoteBackend
+from tracing import NULL_TRACER, JsonLinesExporter, MetricsExporter, Tracer
+from results import (CsvRenderer, JsonLinesRenderer, ResultSet, StateRecord, TableRenderer,
+                     TextRenderer)
 import pyparsing as pp
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 import pytest
 import sys
+import os
+import json
+import tempfile
+import subprocess
+import io
+import threading
+import time
+import urllib.error
+import urllib.request
 
 class run_tests(unittest.TestCase):
 
@@ -175,6 +198,878 @@ class run_tests(unittest.TestCase):
             print("test_nine FAILED. Error: ", e)
             self.failed += 1
 
+    # test_ten ensures the grammar is built once and repeated queries are served from the parse cache
+    def test_ten(self):
+        print("test_ten: testing the parse cache")
+        grammar = QueryGrammar(cache_size=2)
+
+        first = grammar.parse("region == northeast")
+        second = grammar.parse("  region   ==  northeast ")
+        self.assertEqual(first, ["region", "==", "northeast"])
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+        self.assertEqual((grammar.hits, grammar.misses), (1, 1))
+
+        # Least recently used entry is evicted once the cache is full
+        grammar.parse("population > 5")
+        grammar.parse("capital == montpelier")
+        grammar.parse("region == northeast")
+        self.assertEqual(grammar.misses, 4)
+        self.assertIs(QueryGrammar.parser(), StateQueryEngine.grammar.parser())
+
+        # Whitespace inside quotes is part of the value, so it isn't collapsed
+        self.assertEqual(grammar.parse("governor  ==  'phil  scott'"), ["governor", "==", "phil  scott"])
+        self.assertEqual(grammar.parse("governor == 'phil scott'"), ["governor", "==", "phil scott"])
+        print("test_ten PASSED")
+        self.passed += 1
+
+    # test_eleven checks the local backend's indexes against a plain scan of the dataset
+    def test_eleven(self):
+        print("test_eleven: testing the local in-memory backend")
+        backend = LocalBackend()
+        records = list(backend.docs.values())
+
+        for field, op, value in [("region", "==", "Northeast"), ("region", "!=", "South"),
+                                 ("population", ">", 10000000), ("population", "<=", 648493),
+                                 ("num_counties", "!=", 67), ("governor", ">=", "Phil Scott")]:
+            expected = {r["uuid"] for r in records if field in r and compare(r[field], op, value)}
+            self.assertEqual(set(backend.fetch(field, op, value)), expected)
+
+        # Removing a record drops it from every index
+        vermont = next(r for r in records if r["state"] == "Vermont")
+        backend.remove(vermont["uuid"])
+        self.assertEqual(backend.fetch("state", "==", "Vermont"), {})
+        self.assertNotIn(vermont["uuid"], backend.fetch("population", "<", 700000))
+
+        # Loading in bulk builds the same indexes as adding records one at a time
+        incremental = LocalBackend([])
+        for record in records:
+            incremental.add(record)
+        bulk = LocalBackend(records + [vermont])
+        self.assertEqual(bulk.hash_indexes, incremental.hash_indexes)
+        for field, (values, uuids) in bulk.sorted_indexes.items():
+            self.assertEqual(values, incremental.sorted_indexes[field][0])
+            self.assertEqual(sorted(zip(values, uuids)), sorted(zip(*incremental.sorted_indexes[field])))
+        print("test_eleven PASSED")
+        self.passed += 1
+
+    # test_twelve checks which clauses of a compound query are pushed down to Firestore
+    def test_twelve(self):
+        print("test_twelve: testing the Firestore query planner")
+        # Empty statistics estimate every clause at zero, so clauses keep their original order
+        backend = FirestoreBackend(statistics=Statistics([]))
+
+        plan = backend.plan([["region", "==", "South"], ["population", ">", 1000], ["population", "<", 9000]])
+        self.assertEqual(len(plan.pushed), 3)
+        self.assertEqual(plan.residual, [])
+        self.assertEqual(plan.strategy, "single Firestore query")
+
+        # Inequalities on a second field, and a second !=, are filtered client-side
+        plan = backend.plan([["population", ">", 1000], ["num_counties", "<", 20],
+                             ["region", "!=", "South"], ["population", "!=", 5]])
+        self.assertEqual(plan.pushed, [("population", ">", 1000), ("population", "!=", 5)])
+        self.assertEqual(plan.residual, [("num_counties", "<", 20), ("region", "!=", "South")])
+        self.assertIn("client-side filter: num_counties < 20", plan.describe())
+
+        # With statistics from the dataset the more selective inequality is sent to Firestore
+        plan = FirestoreBackend().plan([["population", ">", 1000], ["num_counties", "<", 20]])
+        self.assertEqual(plan.pushed, [("num_counties", "<", 20)])
+        print("test_twelve PASSED")
+        self.passed += 1
+
+    # test_thirteen checks that compound queries run the most selective clause first
+    def test_thirteen(self):
+        print("test_thirteen: testing cost-based clause ordering")
+        backend = LocalBackend()
+        subqueries = [["population", ">", 1000], ["region", "==", "Northeast"], ["state", "==", "Vermont"]]
+
+        self.assertEqual(backend.estimate("state", "==", "Vermont"), 1)
+        self.assertEqual(backend.estimate("population", ">", 1000), len(backend.docs))
+        plan = backend.plan(subqueries)
+        self.assertEqual(plan.pushed, [("state", "==", "Vermont")])
+        self.assertEqual([r["state"] for r in backend.execute(subqueries)], ["Vermont"])
+
+        # Statistics computed from the JSON file agree with the local indexes
+        statistics = Statistics.from_file()
+        for subquery in subqueries + [["governor", "<", "M"], ["num_counties", "!=", 14]]:
+            self.assertEqual(statistics.estimate(*subquery), backend.estimate(*subquery))
+
+        self.assertEqual(backend.execute([["state", "==", "Atlantis"], ["population", ">", 5]]), [])
+        print("test_thirteen PASSED")
+        self.passed += 1
+
+    # test_fourteen ensures the firebase app and Firestore client are only created once
+    @patch("firebase_admin.firestore.client")
+    @patch("firebase_admin.initialize_app")
+    @patch("firebase_admin.credentials.Certificate")
+    def test_fourteen(self, mock_certificate, mock_initialize, mock_client):
+        print("test_fourteen: testing Firestore connection reuse")
+        connection = FirestoreConnection()
+        backend = FirestoreBackend(connection=connection)
+
+        backend.connect()
+        backend.connect()
+        self.assertIs(connection.client(), mock_client.return_value)
+        self.assertEqual(mock_initialize.call_count, 1)
+        self.assertEqual(mock_client.call_count, 1)
+
+        connection.record_query(0.5)
+        connection.record_query(0.25)
+        connection.record_query(0.75)
+        timings = connection.timings()
+        self.assertEqual((timings["first_query"], timings["steady_state"]), (0.5, 0.75))
+        self.assertIsNotNone(timings["connect"])
+        print("test_fourteen PASSED")
+        self.passed += 1
+
+    # test_fifteen tests result cache expiry, eviction and invalidation when the data changes
+    @patch("builtins.print")
+    def test_fifteen(self, mock_print):
+        print("test_fifteen: testing the result cache")
+        now = [0]
+        cache = ResultCache(max_size=2, ttl=10, clock=lambda: now[0])
+        key = cache.key([["population", ">", 5], ["region", "==", "South"]])
+        self.assertEqual(key, cache.key([["region", "==", "South"], ["population", ">", 5]]))
+
+        cache.put(key, ["texas"], generation=1)
+        self.assertEqual(cache.get(key, generation=1), ["texas"])
+        self.assertIsNone(cache.get(key, generation=2))
+        cache.put(key, ["texas"], generation=1)
+        now[0] = 11
+        self.assertIsNone(cache.get(key, generation=1))
+
+        # Repeated queries skip the backend until the data changes
+        backend = LocalBackend()
+        engine = StateQueryEngine(backend)
+        with patch.object(backend, "execute", wraps=backend.execute) as mock_execute:
+            engine.validate_and_parse_input("region == northeast")
+            engine.validate_and_parse_input("region == NORTHEAST")
+            self.assertEqual(mock_execute.call_count, 1)
+            backend.add({"uuid": "test", "state": "Test", "region": "Northeast"})
+            engine.validate_and_parse_input("region == northeast")
+            self.assertEqual(mock_execute.call_count, 2)
+        self.assertEqual((engine.result_cache.hits, engine.result_cache.misses), (1, 2))
+
+        # Threads asking for the generation at once share a single upload listener
+        db = MagicMock()
+        upload = db.collection.return_value.document.return_value
+        upload.on_snapshot.side_effect = lambda callback: time.sleep(0.05) or MagicMock()
+        firestore = FirestoreBackend(connection=MagicMock(client=MagicMock(return_value=db)))
+        threads = [threading.Thread(target=firestore.generation) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(upload.on_snapshot.call_count, 1)
+        print("test_fifteen PASSED")
+        self.passed += 1
+
+    # test_sixteen tests that the bulk loader writes in batches of at most 500 and retries transient failures
+    @patch("time.sleep")
+    def test_sixteen(self, mock_sleep):
+        print("test_sixteen: testing the batched bulk loader")
+        from google.api_core.exceptions import ServiceUnavailable
+
+        db = MagicMock()
+        batches = []
+        def new_batch():
+            batch = MagicMock()
+            batches.append(batch)
+            return batch
+        db.batch.side_effect = new_batch
+
+        records = [{"uuid": str(i), "state": "State %d" % i} for i in range(1200)]
+        written, seconds = admin.bulk_load(db, records, chunk_size=1000, workers=2)
+        self.assertEqual(written, 1200)
+        self.assertEqual(sorted(batch.set.call_count for batch in batches), [200, 500, 500])
+
+        # A failed commit is retried with a fresh batch
+        batches.clear()
+        db.batch.side_effect = None
+        db.batch.return_value.commit.side_effect = [ServiceUnavailable("busy"), None]
+        self.assertEqual(admin.write_chunk(db, records[:3]), 3)
+        self.assertEqual(db.batch.return_value.commit.call_count, 2)
+        self.assertEqual(mock_sleep.call_count, 1)
+        print("test_sixteen PASSED")
+        self.passed += 1
+
+    # test_seventeen tests streaming uploads from NDJSON and JSON array files and resuming from a checkpoint
+    @patch("builtins.print")
+    def test_seventeen(self, mock_print):
+        print("test_seventeen: testing streaming uploads")
+        records = [{"uuid": str(i), "state": "State %d" % i, "population": i} for i in range(25)]
+        records[3]["population"] = "many"
+
+        with tempfile.TemporaryDirectory() as tmp:
+            array_file = os.path.join(tmp, "states.json")
+            ndjson_file = os.path.join(tmp, "states.ndjson")
+            checkpoint_file = os.path.join(tmp, "upload.checkpoint")
+            with open(array_file, "w") as f:
+                json.dump(records, f, indent=4)
+            with open(ndjson_file, "w") as f:
+                f.writelines(json.dumps(record) + "\n" for record in records)
+
+            for path in (array_file, ndjson_file):
+                self.assertEqual([r for _, r in admin.iter_records(path)], records)
+
+                # Fail the third batch, then resume from the checkpoint of the first two
+                db = MagicMock()
+                db.batch.return_value.commit.side_effect = [None, None, ValueError("crash")]
+                with self.assertRaises(ValueError):
+                    admin.stream_load(db, path, chunk_size=5, workers=1, checkpoint_file=checkpoint_file)
+                offset = admin.read_checkpoint(checkpoint_file, path)
+                self.assertEqual([r["uuid"] for _, r in admin.iter_records(path, offset)][0], "11")
+
+                db = MagicMock()
+                written, rejected, seconds = admin.stream_load(db, path, chunk_size=5, workers=2,
+                                                               checkpoint_file=checkpoint_file)
+                self.assertEqual((written, rejected), (14, 0))
+                os.remove(checkpoint_file)
+
+            written, rejected, seconds = admin.stream_load(MagicMock(), array_file, chunk_size=5)
+            self.assertEqual((written, rejected), (24, 1))
+
+            # A line that isn't JSON is skipped like an invalid record instead of stopping the load
+            with open(ndjson_file, "a") as f:
+                f.write('{"uuid": "25", "state": \n')
+                f.write(json.dumps({"uuid": "26", "state": "State 26"}) + "\n")
+            written, rejected, seconds = admin.stream_load(MagicMock(), ndjson_file, chunk_size=5)
+            self.assertEqual((written, rejected), (25, 2))
+
+            # A number split across two reads is decoded whole
+            with open(array_file, "w") as f:
+                f.write("[" + " " * (admin.READ_SIZE - 3) + "12345, 6]")
+            self.assertEqual([r for _, r in admin.iter_records(array_file)], [12345, 6])
+        print("test_seventeen PASSED")
+        self.passed += 1
+
+    # test_eighteen tests batch mode: one JSON line per query, with identical queries only run once
+    def test_eighteen(self):
+        print("test_eighteen: testing batch mode")
+        backend = LocalBackend()
+        engine = StateQueryEngine(backend)
+        queries = ["region == northeast", "", "region == NORTHEAST", "gobernor == phil scott",
+                   "state == vermont && population < 1000000", "help"]
+        out = io.StringIO()
+
+        with patch.object(backend, "execute", wraps=backend.execute) as mock_execute:
+            self.assertEqual(engine.run_batch(queries, out, workers=2), 5)
+            self.assertEqual(mock_execute.call_count, 2)
+
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([result["query"] for result in results], [q for q in queries if q])
+        self.assertEqual(len(results[0]["results"]), 9)
+        self.assertEqual(results[0]["results"], results[1]["results"])
+        self.assertIn("error", results[2])
+        self.assertEqual([r["state"] for r in results[3]["results"]], ["Vermont"])
+        self.assertIn("error", results[4])
+
+        # A value int() can't read is compared as text, and a line that still fails only errors itself
+        self.assertEqual(engine.normalize_value("½"), "½")
+        out = io.StringIO()
+        normalize_value = engine.normalize_value
+
+        def fail_on_x(value):
+            if value == "x":
+                raise ValueError("bad value")
+            return normalize_value(value)
+
+        with patch.object(engine, "normalize_value", side_effect=fail_on_x):
+            engine.run_batch(["state == x", "state == ohio"], out)
+        bad, ohio = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertIn("bad value", bad["error"])
+        self.assertEqual([r["state"] for r in ohio["results"]], ["Ohio"])
+        out = io.StringIO()
+        asyncio.run(AsyncStateQueryEngine(LocalBackend()).run_batch_async(["state == '½'", "state == ohio"], out))
+        self.assertEqual([len(json.loads(line)["results"]) for line in out.getvalue().splitlines()], [0, 1])
+        print("test_eighteen PASSED")
+        self.passed += 1
+
+    # test_nineteen tests that the async engine runs queries concurrently up to its limit
+    def test_nineteen(self):
+        print("test_nineteen: testing the asyncio engine")
+        local = LocalBackend()
+
+        class SlowBackend(LocalBackend):
+            in_flight = 0
+            max_in_flight = 0
+
+            async def execute_async(self, subqueries, limiter, fields=None):
+                async with limiter:
+                    SlowBackend.in_flight += 1
+                    SlowBackend.max_in_flight = max(SlowBackend.max_in_flight, SlowBackend.in_flight)
+                    await asyncio.sleep(0.01)
+                    SlowBackend.in_flight -= 1
+                return self.execute(subqueries, fields)
+
+        engine = AsyncStateQueryEngine(SlowBackend(list(local.docs.values())), concurrency=3)
+        queries = ["population > %d" % (i * 1000000) for i in range(8)] + ["population > 0"]
+        out = io.StringIO()
+        self.assertEqual(asyncio.run(engine.run_batch_async(queries, out)), 9)
+        self.assertEqual(SlowBackend.max_in_flight, 3)
+
+        expected = io.StringIO()
+        StateQueryEngine(local).run_batch(queries, expected)
+        self.assertEqual(out.getvalue(), expected.getvalue())
+
+        # Backends without execute_async run in a worker thread
+        engine = AsyncStateQueryEngine(local)
+        records = asyncio.run(engine.run_query_async([["state", "==", "vermont"]]))
+        self.assertEqual([r["state"] for r in records], ["Vermont"])
+        print("test_nineteen PASSED")
+        self.passed += 1
+
+    # test_twenty tests the result set and each output format
+    def test_twenty(self):
+        print("test_twenty: testing result rendering")
+        docs = [{"uuid": "1", "state": "Vermont", "population": 648493, "state_bird": "Hermit Thrush"},
+                {"uuid": "2", "state": "Ohio", "population": 11883304, "popular_food": "Buckeye Candies"}]
+        queries = [["population", ">", 600000]]
+        result_set = ResultSet(queries, docs)
+        records = list(result_set)
+        self.assertEqual(records[0], StateRecord(uuid="1", state="Vermont", population=648493,
+                                                 state_bird="Hermit Thrush"))
+        self.assertIsNone(records[1].state_bird)
+        self.assertEqual(result_set.columns, ("state", "population"))
+
+        def render(renderer):
+            out = io.StringIO()
+            # Rows are streamed from a generator rather than a buffered list
+            renderer.render(ResultSet(queries, (doc for doc in docs)), out)
+            return out.getvalue()
+
+        self.assertEqual(render(TextRenderer()),
+                         "States with a population of over 600,000: \nVermont = 648,493\nOhio = 11,883,304\n\n\n")
+        self.assertEqual(render(CsvRenderer()).splitlines(), ["state,population", "Vermont,648493", "Ohio,11883304"])
+        self.assertEqual([json.loads(line) for line in render(JsonLinesRenderer()).splitlines()],
+                         [{"state": "Vermont", "population": 648493}, {"state": "Ohio", "population": 11883304}])
+        self.assertIn("| Vermont | 648493", render(TableRenderer()))
+
+        out = io.StringIO()
+        JsonLinesRenderer().render(ResultSet([["state", "==", "Ohio"]], docs[1:]), out)
+        self.assertEqual(json.loads(out.getvalue()), {"state": "Ohio", "population": 11883304,
+                                                      "popular_food": "Buckeye Candies"})
+        print("test_twenty PASSED")
+        self.passed += 1
+
+    # test_twenty_one checks the columnar table against the indexed local backend
+    def test_twenty_one(self):
+        print("test_twenty_one: testing the columnar backend")
+        local = LocalBackend()
+        columnar = ColumnarBackend(StateTable(list(local.docs.values())))
+        self.assertEqual(len(columnar.table), len(local.docs))
+
+        queries = [[["region", "==", "Northeast"]], [["state_bird", "!=", "Hermit Thrush"]],
+                   [["popular_food", "==", "Clam Chowder"]], [["population", "<=", 648493]],
+                   [["num_counties", "!=", 67], ["region", "==", "South"]], [["governor", ">", "M"]],
+                   [["region", "==", "West"], ["population", ">", 30000000], ["num_counties", "<", 100]],
+                   [["population", "==", "Vermont"]], [["state", "==", "Atlantis"], ["population", ">", 0]]]
+        for subqueries in queries:
+            expected = sorted(local.execute(subqueries), key=lambda r: r["uuid"])
+            self.assertEqual(sorted(columnar.execute(subqueries), key=lambda r: r["uuid"]), expected)
+            self.assertEqual(columnar.estimate(*subqueries[0]), local.estimate(*subqueries[0]))
+
+        # Optional fields are tracked by the validity bitsets rather than stored for every row
+        vermont = columnar.execute([["state", "==", "Vermont"]])[0]
+        self.assertNotIn("popular_food", vermont)
+        self.assertEqual(columnar.table.scan("region", "==", "Northeast") & columnar.table.scan("state", "==", "Vermont"),
+                         columnar.table.scan("state", "==", "Vermont"))
+        print("test_twenty_one PASSED")
+        self.passed += 1
+
+    # test_twenty_two tests the query server and the thin client backend
+    @patch("builtins.print")
+    def test_twenty_two(self, mock_print):
+        print("test_twenty_two: testing server mode")
+        server = QueryServer(StateQueryEngine(LocalBackend()), port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = "http://%s:%d" % server.server_address[:2]
+            client = StateQueryEngine(RemoteBackend(url))
+            result_set = client.validate_and_parse_input("region == northeast && population > 5000000")
+            self.assertIsNone(result_set)
+            # Served from the client's result cache without another request
+            parsed_query = [["region", "==", "northeast"], ["population", ">", "5000000"]]
+            records = client.run_query(parsed_query, ResultSet.required_fields(parsed_query))
+            self.assertEqual(sorted(r["state"] for r in records), ["Massachusetts", "New Jersey", "New York", "Pennsylvania"])
+
+            request = urllib.request.Request(url + "/query", data=json.dumps({"query": "gobernor == x"}).encode())
+            with self.assertRaises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(request)
+            self.assertEqual(error.exception.code, 400)
+
+            with urllib.request.urlopen(url + "/stats") as response:
+                stats = json.loads(response.read())
+            self.assertEqual(stats["requests"], 2)
+            self.assertIsNotNone(stats["p99_ms"])
+
+            # Malformed clauses are bad requests, not server errors
+            for body in [{"subqueries": [["state", "=="]]}, {"subqueries": [["gobernor", "==", "x"]]},
+                         {"subqueries": [["state", "~", "x"]]}, {"subqueries": "state == ohio"},
+                         {"any_of": [[["state", "==", "Ohio"]], [["population", "between", [1]]]]},
+                         {"select": {"where": [["region"]], "aggregate": "count"}},
+                         {"select": {"aggregate": "bogus", "field": "population"}},
+                         {"select": {"aggregate": "sum", "field": "state"}}, {"select": {"order_by": "nope"}},
+                         {"select": {"order_by": "population", "limit": -1}}, {"select": "x"}]:
+                request = urllib.request.Request(url + "/query", data=json.dumps(body).encode())
+                with self.assertRaises(urllib.error.HTTPError) as error:
+                    urllib.request.urlopen(request)
+                self.assertEqual(error.exception.code, 400, body)
+                self.assertIn("Bad request", json.loads(error.exception.read())["error"])
+        finally:
+            server.shutdown()
+            server.server_close()
+        print("test_twenty_two PASSED")
+        self.passed += 1
+
+    # test_twenty_three ensures heavy modules are only imported when they are needed
+    def test_twenty_three(self):
+        print("test_twenty_three: testing lazy imports")
+        code = ("import sys, io, contextlib\n"
+                "from query import StateQueryEngine\n"
+                "from backends import LocalBackend\n"
+                "with contextlib.redirect_stdout(io.StringIO()):\n"
+                "    StateQueryEngine(LocalBackend()).validate_and_parse_input('help')\n"
+                "print(sorted(m for m in ('pyparsing', 'firebase_admin', 'grpc', 'asyncio') if m in sys.modules))")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        self.assertEqual(output.strip(), "[]")
+        print("test_twenty_three PASSED")
+        self.passed += 1
+
+    # test_twenty_four tests that the replica applies snapshot changes incrementally and serves queries from memory
+    @patch("builtins.print")
+    def test_twenty_four(self, mock_print):
+        print("test_twenty_four: testing replica mode")
+        records = list(LocalBackend().docs.values())
+
+        def change(kind, record):
+            document = MagicMock(id=record["uuid"])
+            document.to_dict.return_value = {k: v for k, v in record.items() if k != "uuid"}
+            return MagicMock(type=MagicMock(), document=document, **{"type.name": kind})
+
+        connection = MagicMock()
+        collection = connection.client.return_value.collection.return_value
+        collection.on_snapshot.side_effect = lambda callback: callback([], [change("ADDED", r) for r in records], None)
+
+        replica = ReplicaBackend(connection=connection)
+        engine = StateQueryEngine(replica)
+        result_set = engine.query_database([["state", "==", "vermont"]])
+        self.assertEqual([record.state for record in result_set], ["Vermont"])
+        self.assertEqual(replica.reads, len(records))
+        self.assertEqual(collection.on_snapshot.call_count, 1)
+
+        vermont = next(r for r in records if r["state"] == "Vermont")
+        replica.on_snapshot([], [change("MODIFIED", dict(vermont, population=1000000)),
+                                 change("REMOVED", next(r for r in records if r["state"] == "Texas"))], None)
+        self.assertEqual(replica.reads, len(records) + 2)
+        self.assertEqual(engine.run_query([["state", "==", "vermont"]])[0]["population"], 1000000)
+        self.assertEqual(engine.run_query([["state", "==", "texas"]]), [])
+        self.assertEqual(collection.stream.call_count, 0)
+        print("test_twenty_four PASSED")
+        self.passed += 1
+
+    # test_twenty_five tests that each backend only returns the fields a query needs to display
+    def test_twenty_five(self):
+        print("test_twenty_five: testing projection pushdown")
+        self.assertEqual(ResultSet.required_fields([["population", ">", 1]]), ("uuid", "state", "population"))
+        self.assertEqual(ResultSet.required_fields([["region", "==", "West"]]), ("uuid", "state"))
+
+        fields = ("uuid", "state", "population")
+        for backend in (LocalBackend(), ColumnarBackend()):
+            records = backend.execute([["region", "==", "Northeast"], ["num_counties", "<", 10]], fields)
+            self.assertEqual(sorted(r["state"] for r in records), ["Connecticut", "Rhode Island"])
+            self.assertTrue(all(set(r) <= set(fields) for r in records))
+            # Without a projection, whole records are returned
+            self.assertIn("region", backend.execute([["region", "==", "Northeast"]])[0])
+
+        connection = MagicMock()
+        query = connection.client.return_value.collection.return_value.where.return_value
+        query.select.return_value.stream.return_value = []
+        backend = FirestoreBackend(statistics=Statistics([]), connection=connection)
+        backend.execute([["population", ">", 1], ["num_counties", "<", 5]], ("uuid", "state"))
+        # The residual range clause still needs the population field to be filtered client-side
+        query.select.assert_called_once_with(["num_counties", "state", "uuid"])
+        print("test_twenty_five PASSED")
+        self.passed += 1
+
+    # test_twenty_six tests the benchmark harness: the in-process Firestore stand-in, synthetic datasets and regression checks
+    def test_twenty_six(self):
+        print("test_twenty_six: testing the benchmark harness")
+        records = benchmarks.synthetic_records(benchmarks.load_records(), 10)
+        self.assertEqual(len(records), 500)
+        self.assertEqual(len({record["uuid"] for record in records}), 500)
+
+        fake = benchmarks.make_backend("fake", records)
+        local = LocalBackend(records)
+        engine = StateQueryEngine(local)
+        for text in benchmarks.QUERY_SHAPES.values():
+            parsed_query = engine.normalize_query(engine.parse_query(text))
+            self.assertEqual(sorted(r["uuid"] for r in fake.execute(parsed_query)),
+                             sorted(r["uuid"] for r in local.execute(parsed_query)))
+
+        results = benchmarks.query_benchmark("local", scales=(1,), runs=2)
+        self.assertIn("1x execute compound", results)
+        slower = {name: dict(summary, p50_ms=summary["p50_ms"] * 2 + 1) for name, summary in results.items()}
+        slower["grammar"] = results["grammar"]
+        self.assertEqual(benchmarks.find_regressions(results, results), [])
+        self.assertEqual(len(benchmarks.find_regressions(slower, results)), len(results) - 1)
+        # A uniformly slower machine, or a slowdown below the floor, isn't a regression
+        machine = {name: dict(summary, p50_ms=summary["p50_ms"] * 3) for name, summary in results.items()}
+        self.assertEqual(benchmarks.find_regressions(machine, results), [])
+        noise = {name: dict(summary, p50_ms=summary["p50_ms"] + 0.1) for name, summary in results.items()}
+        noise["grammar"] = results["grammar"]
+        self.assertEqual(benchmarks.find_regressions(noise, results, tolerance=0, floor_ms=0.5), [])
+        self.assertEqual(len(benchmarks.find_regressions(noise, results, tolerance=0, floor_ms=0.05)),
+                         len(results) - 1)
+        print("test_twenty_six PASSED")
+        self.passed += 1
+
+    # test_twenty_seven tests per-stage tracing, document read counts, cache hit rates and explain analyze
+    @patch("builtins.print")
+    def test_twenty_seven(self, mock_print):
+        print("test_twenty_seven: testing tracing and profiling")
+        records = benchmarks.load_records()
+        metrics = MetricsExporter()
+        out = io.StringIO()
+        engine = StateQueryEngine(benchmarks.make_backend("fake", records),
+                                  tracer=Tracer([metrics, JsonLinesExporter(out)]))
+        self.assertIs(engine.backend.tracer, engine.tracer)
+        engine.validate_and_parse_input("region == northeast && population > 5000000")
+        engine.validate_and_parse_input("region == northeast && population > 5000000")
+
+        traces = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(traces), 2)
+        stages = [span["name"] for span in traces[0]["spans"]]
+        for stage in ("parse", "connect", "execute", "network", "materialize", "filter", "render"):
+            self.assertIn(stage, stages)
+        # Both clauses are pushed to Firestore, so only the matching documents are read
+        self.assertEqual(traces[0]["counters"]["documents_read"], 4)
+        self.assertNotIn("execute", [span["name"] for span in traces[1]["spans"]])
+        summary = metrics.summary()
+        self.assertEqual(summary["queries"], 2)
+        self.assertEqual(summary["result_cache_hit_rate"], 0.5)
+        self.assertEqual(summary["parse_cache_hit_rate"], 0.5)
+
+        # explain analyze profiles a single query, then profiling is off again
+        engine = StateQueryEngine(LocalBackend())
+        engine.validate_and_parse_input("explain analyze state == vermont")
+        report = mock_print.call_args_list[-1][0][0]
+        self.assertIn("execute", report)
+        self.assertIn("documents_read: 1", report)
+        self.assertIs(engine.tracer, NULL_TRACER)
+        self.assertIs(engine.backend.tracer, NULL_TRACER)
+
+        # The columnar backend counts the rows it materializes
+        engine = StateQueryEngine(ColumnarBackend())
+        engine.validate_and_parse_input("explain analyze region == northeast && population > 5000000")
+        self.assertIn("documents_read: 4", mock_print.call_args_list[-1][0][0])
+        tracer = Tracer()
+        engine.set_tracer(tracer)
+        with tracer.trace("page") as trace:
+            engine.run_page(engine.parse_query("region != west"), ("uuid",), None, 5)
+        self.assertEqual(trace.counters["documents_read"], 5)
+        print("test_twenty_seven PASSED")
+        self.passed += 1
+
+    # test_twenty_eight tests that explain prints the plan of a query without running it
+    @patch("builtins.print")
+    def test_twenty_eight(self, mock_print):
+        print("test_twenty_eight: testing explain")
+        engine = StateQueryEngine(LocalBackend())
+        self.assertEqual(engine.parse_command("explain region == northeast && population > 5000000"),
+                         ("explain", [["region", "==", "northeast"], ["population", ">", "5000000"]]))
+        self.assertEqual(engine.parse_query("explain analyze state == vermont"), "explain analyze")
+
+        plan = engine.explain([["population", ">", "5000000"], ["region", "==", "northeast"]])
+        self.assertEqual([step[0] for step in plan.steps], [("region", "==", "Northeast"), ("population", ">", 5000000)])
+        self.assertEqual([step[1] for step in plan.steps], ["hash index on region (lookup)", "client-side filter"])
+        self.assertEqual([step[2] for step in plan.steps], [9, 24])
+        output = "\n".join(call[0][0] for call in mock_print.call_args_list)
+        self.assertIn("Query: population > 5000000 && region == 'Northeast'", output)
+        self.assertIn("client-side scan", output)
+
+        # explain never reaches the store
+        connection = MagicMock()
+        backend = FirestoreBackend(connection=connection)
+        StateQueryEngine(backend).validate_and_parse_input("explain region == northeast && population > 5000000")
+        self.assertEqual(connection.client.call_count, 0)
+        plan = backend.explain([("region", "==", "Northeast"), ("population", ">", 5000000)])
+        self.assertEqual(plan.residual, [])
+        self.assertIn("composite index on (population, region)", plan.describe())
+        print("test_twenty_eight PASSED")
+        self.passed += 1
+
+    # test_twenty_nine tests ||, parentheses, in, between and startswith on every backend
+    def test_twenty_nine(self):
+        print("test_twenty_nine: testing or, in, between and startswith")
+        engine = StateQueryEngine(LocalBackend())
+        parsed_query = engine.parse_query("(region == northeast || region == west) && population between 1 and 5")
+        self.assertIsInstance(parsed_query, AnyOf)
+        self.assertEqual(parsed_query, [[["region", "==", "northeast"], ["population", "between", ["1", "5"]]],
+                                        [["region", "==", "west"], ["population", "between", ["1", "5"]]]])
+        self.assertEqual(engine.parse_query("region in [northeast, 'south'] && capital startswith mont"),
+                         [["region", "in", ["northeast", "south"]], ["capital", "startswith", "mont"]])
+        self.assertEqual(ResultCache.key(engine.normalize_query(engine.parse_query("state == ohio || state == utah"))),
+                         ResultCache.key(engine.normalize_query(engine.parse_query("state == utah || state == ohio"))))
+
+        records = benchmarks.load_records()
+        backends = [LocalBackend(), ColumnarBackend(), benchmarks.make_backend("fake", records)]
+        queries = ["region == northeast || region == south",
+                   "(region == northeast || region == west) && population > 10000000",
+                   "region in [northeast, south] && num_counties < 10",
+                   "population between 1000000 and 2000000 || state startswith new",
+                   "governor in ['phil scott', 'mike dewine'] || region != west"]
+        for text in queries:
+            parsed_query = engine.normalize_query(engine.parse_query(text))
+            branches = parsed_query if isinstance(parsed_query, AnyOf) else [parsed_query]
+            expected = sorted(r["uuid"] for r in records
+                              if any(all(compare(r.get(f), op, v) for f, op, v in branch) for branch in branches))
+            self.assertTrue(expected)
+            for backend in backends:
+                results = StateQueryEngine(backend).run_query(parsed_query, ("uuid", "state"))
+                # Records matching several branches are only returned once
+                self.assertEqual(sorted(r["uuid"] for r in results), expected)
+
+        # A || query Firestore can't run as a single Or query is sent branch by branch
+        backend = benchmarks.make_backend("fake", records)
+        self.assertEqual(backend.union_strategy(engine.parse_query("region == west || region == south")),
+                         "single Firestore query with an Or filter")
+        self.assertEqual(backend.union_strategy(engine.parse_query("region != west || region == south")),
+                         "one Firestore query per branch, merged on document id")
+
+        renderer = TextRenderer()
+        for text, context in [("population between 1000000 and 1200000 || state == vermont",
+                               "States that satisfy any of the queries: \n"),
+                              ("capital startswith mont", "States whose capital starts with Mont: \n"),
+                              ("population between 1000000 and 1200000",
+                               "States with a population between 1,000,000 and 1,200,000: \n"),
+                              ("state in [vermont, ohio]", "States whose state is Vermont or Ohio: \n")]:
+            parsed_query = engine.normalize_query(engine.parse_query(text))
+            self.assertEqual(renderer.context(ResultSet(parsed_query, [])), context)
+        print("test_twenty_nine PASSED")
+        self.passed += 1
+
+    # test_thirty tests aggregates and order by/limit on every backend
+    @patch("builtins.print")
+    def test_thirty(self, mock_print):
+        print("test_thirty: testing aggregates and top-k")
+        engine = StateQueryEngine(LocalBackend())
+        select = engine.parse_query("sum(population) region == west || region == south order by population desc limit 3")
+        self.assertIsInstance(select, Select)
+        self.assertIsInstance(select.where, AnyOf)
+        self.assertEqual((select.aggregate, select.field, select.order_by, select.descending, select.limit),
+                         ("sum", "population", "population", True, 3))
+        self.assertEqual(engine.parse_query("count").where, [])
+        self.assertEqual(engine.parse_query("region == west order by state").where, [["region", "==", "west"]])
+        # Queries without an aggregate, order or limit are parsed as before
+        self.assertEqual(engine.parse_query("region == west"), [["region", "==", "west"]])
+        self.assertNotEqual(ResultCache.key(engine.normalize_query(engine.parse_query("count region == west"))),
+                            ResultCache.key(engine.normalize_query(engine.parse_query("region == west"))))
+
+        records = benchmarks.load_records()
+        west = [r for r in records if r.get("region") == "West"]
+        expected = {
+            "count": len(records),
+            "count region == west": len(west),
+            "sum(population) region == west": sum(r["population"] for r in west),
+            "avg(num_counties) region == west": sum(r["num_counties"] for r in west) / len(west),
+            "min(population)": min(r["population"] for r in records),
+            "max(num_counties) region == west || region == south":
+                max(r["num_counties"] for r in records if r.get("region") in ("West", "South")),
+            "max(population) population > 100000000": None,
+            "sum(population) order by population desc limit 3":
+                sum(sorted((r["population"] for r in records), reverse=True)[:3]),
+            "order by population desc limit 5":
+                [r["state"] for r in sorted(records, key=lambda r: r["population"], reverse=True)[:5]],
+            "region == west order by num_counties limit 3":
+                [r["state"] for r in sorted(west, key=lambda r: (r["num_counties"], r["uuid"]))[:3]],
+            "population > 10000000 order by state desc":
+                sorted((r["state"] for r in records if r["population"] > 10000000), reverse=True),
+            "limit 4": [r["state"] for r in sorted(records, key=lambda r: r["uuid"])[:4]],
+            "order by population desc limit 0": [],
+        }
+        server = QueryServer(StateQueryEngine(LocalBackend()), port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            backends = [LocalBackend(), ColumnarBackend(), benchmarks.make_backend("fake", records),
+                        RemoteBackend("http://%s:%d" % server.server_address[:2])]
+            for text, value in expected.items():
+                for backend in backends:
+                    parsed_query = engine.parse_query(text)
+                    result = StateQueryEngine(backend).run_query(parsed_query, ResultSet.required_fields(parsed_query))
+                    if isinstance(value, list):
+                        result = [r["state"] for r in result]
+                    self.assertEqual(result, value, "%s on %s" % (text, type(backend).__name__))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # The local backend walks the sorted index instead of reading every record
+        tracer = Tracer()
+        local = StateQueryEngine(LocalBackend(), tracer=tracer)
+        with tracer.trace("top-k") as trace:
+            local.run_query(local.parse_query("order by population desc limit 5"))
+        self.assertEqual(trace.counters["documents_read"], 5)
+        self.assertEqual(local.backend.select_strategy(local.parse_query("count region == west")),
+                         "index lookups, size of the matching uuid set")
+
+        # Firestore counts with an aggregation query, and falls back when it can't order on the field
+        fake = benchmarks.make_backend("fake", records)
+        fake.tracer = tracer
+        with tracer.trace("count") as trace:
+            self.assertEqual(fake.execute_select(engine.normalize_query(engine.parse_query("count region == west"))),
+                             len(west))
+        self.assertEqual(trace.counters, {"aggregation_queries": 1})
+        self.assertEqual(fake.select_strategy(engine.normalize_query(engine.parse_query("population > 1 order by state"))),
+                         "matching records retrieved and reduced in memory")
+
+        out = io.StringIO()
+        TextRenderer().render_aggregate(engine.parse_query("avg(num_counties) region == west"), 33.769, out)
+        self.assertEqual(out.getvalue().splitlines()[0], "Average number of counties matching the query: 33.77")
+        out = io.StringIO()
+        JsonLinesRenderer().render_aggregate(engine.parse_query("count"), 50, out)
+        self.assertEqual(json.loads(out.getvalue()), {"aggregate": "count", "value": 50})
+        print("test_thirty PASSED")
+        self.passed += 1
+
+    # test_thirty_one tests cursor pagination in the engine, batch mode and the server
+    @patch("builtins.print")
+    def test_thirty_one(self, mock_print):
+        print("test_thirty_one: testing pagination")
+        records = benchmarks.load_records()
+        engine = StateQueryEngine(LocalBackend())
+        self.assertEqual(engine.parse_query("next"), "next")
+        queries = ["population > 5000000", "region == south || region == west",
+                   "population between 1000000 and 5000000 && region != west"]
+        for text in queries:
+            expected = sorted(r["uuid"] for r in engine.run_query(engine.parse_query(text)))
+            for backend in [LocalBackend(), ColumnarBackend(), benchmarks.make_backend("fake", records)]:
+                paged = StateQueryEngine(backend)
+                uuids, cursor = [], None
+                while True:
+                    page, cursor = paged.run_page(paged.parse_query(text), ("uuid", "state"), cursor, 7)
+                    self.assertLessEqual(len(page), 7)
+                    uuids.extend(r["uuid"] for r in page)
+                    if cursor is None:
+                        break
+                    self.assertEqual(len(page), 7)
+                # Every state is on exactly one page
+                self.assertEqual(sorted(uuids), expected, "%s on %s" % (text, type(backend).__name__))
+
+        # Firestore reads one batch per page instead of the whole result
+        tracer = Tracer()
+        fake = StateQueryEngine(benchmarks.make_backend("fake", records), tracer=tracer)
+        with tracer.trace("page") as trace:
+            fake.run_page(fake.parse_query("region != west"), ("uuid", "state"), None, 5)
+        self.assertEqual(trace.counters["documents_read"], 6)
+        with self.assertRaises(ValueError):
+            engine.run_page(engine.parse_query("region != west"), None, "not a cursor", 5)
+
+        # The REPL shows a page, then 'next' shows the rest
+        engine.page_size = 30
+        engine.validate_and_parse_input("population > 1000000")
+        self.assertIsNotNone(engine.pending_page)
+        engine.answer("next")
+        self.assertIsNone(engine.pending_page)
+        engine.answer("next")
+        mock_print.assert_any_call("No more results.\n")
+
+        # Batch mode returns a cursor that resumes the query on a later line
+        engine.page_size = 20
+        out = io.StringIO()
+        engine.run_batch(["region != west", "count"], out)
+        first, count = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(first["results"]), 20)
+        self.assertEqual(count, {"query": "count", "results": 50})
+        out = io.StringIO()
+        engine.run_batch([json.dumps({"query": "region != west", "cursor": first["next_cursor"]}),
+                          json.dumps({"query": "region != west", "cursor": "bad"})], out)
+        second, bad = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertNotIn("next_cursor", second)
+        self.assertEqual(len({r["uuid"] for r in first["results"] + second["results"]}),
+                         sum(1 for r in records if r.get("region") != "West"))
+        self.assertIn("error", bad)
+
+        # The server pages with its own backend and passes cursors back to the client
+        server = QueryServer(StateQueryEngine(LocalBackend()), port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            client = StateQueryEngine(RemoteBackend("http://%s:%d" % server.server_address[:2]))
+            page, cursor = client.run_page(client.parse_query("region != west"), ("uuid", "state"), None, 25)
+            rest, last = client.run_page(client.parse_query("region != west"), ("uuid", "state"), cursor, 25)
+            self.assertEqual((len(page), last), (25, None))
+            self.assertEqual([r["state"] for r in page + rest],
+                             [r["state"] for r in sorted(first["results"] + second["results"], key=lambda r: r["uuid"])])
+            request = urllib.request.Request("http://%s:%d/query" % server.server_address[:2],
+                                             data=json.dumps({"query": "state == ohio", "page_size": 5,
+                                                              "cursor": "bad"}).encode())
+            with self.assertRaises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(request)
+            self.assertEqual(error.exception.code, 400)
+        finally:
+            server.shutdown()
+            server.server_close()
+        print("test_thirty_one PASSED")
+        self.passed += 1
+
+    # test_thirty_two checks that a memory-mapped snapshot answers like the JSON file and refreshes when it is stale
+    @patch("builtins.print")
+    def test_thirty_two(self, mock_print):
+        print("test_thirty_two: testing memory-mapped snapshots")
+        records = benchmarks.load_records()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "states.snapshot")
+            self.assertEqual(snapshot.write_snapshot(path, records, 1), len(records))
+            backend = snapshot.SnapshotBackend(path, refresh=False)
+            self.assertEqual(backend.generation(), 1)
+
+            # The snapshot answers every query the same way as the JSON file
+            local = StateQueryEngine(LocalBackend())
+            mapped = StateQueryEngine(backend)
+            for text in ["region == west", "population > 5000000 && region != south", "num_counties <= 10",
+                         "population between 1000000 and 3000000", "state startswith n", "region in [west, midwest]",
+                         "region == south || population < 1000000", "count region == west", "avg(num_counties)",
+                         "max(population) region == south", "order by population desc limit 3"]:
+                expected, actual = local.run_query(local.parse_query(text)), mapped.run_query(mapped.parse_query(text))
+                if isinstance(expected, list) and "order" not in text:
+                    expected = sorted(expected, key=lambda r: r["uuid"])
+                    actual = sorted(actual, key=lambda r: r["uuid"])
+                self.assertEqual(actual, expected, text)
+            self.assertEqual(backend.access_path("population", ">", 5000000),
+                             "range scan of the sorted index on population")
+            self.assertEqual(ColumnarBackend(StateTable(records)).access_path("population", ">", 5000000),
+                             "range scan of the sorted index on population")
+            self.assertEqual(backend.estimate("population", ">", 5000000),
+                             sum(1 for r in records if r["population"] > 5000000))
+            page, cursor = mapped.run_page(mapped.parse_query("region != west"), ("uuid",), None, 10)
+            self.assertEqual(page, local.run_page(local.parse_query("region != west"), ("uuid",), None, 10)[0])
+
+            # A file in another format version is rejected rather than misread
+            with open(path, "rb") as f:
+                data = bytearray(f.read())
+            data[8] += 1
+            corrupt = os.path.join(directory, "corrupt.snapshot")
+            with open(corrupt, "wb") as f:
+                f.write(data)
+            with self.assertRaises(ValueError):
+                snapshot.Snapshot(corrupt)
+
+            # A newer upload stamp in Firestore makes the backend export and swap in a new snapshot
+            db = benchmarks.FakeFirestore(records[:10])
+            db.collections[META_COLLECTION] = [{"uuid": UPLOAD_DOCUMENT, "generation": 2}]
+            backend.connection = benchmarks.FakeConnection(db)
+            self.assertTrue(backend.refresh())
+            self.assertEqual(backend.generation(), 2)
+            self.assertEqual(mapped.run_query(mapped.parse_query("count")), 10)
+            self.assertFalse(backend.refresh())
+            self.assertEqual(snapshot.Snapshot(path).generation, 2)
+        print("test_thirty_two PASSED")
+        self.passed += 1
+
 if __name__ == '__main__':
     tests = run_tests()
 
@@ -205,5 +1100,74 @@ if __name__ == '__main__':
     tests.test_nine()
     print(' ')
 
+    tests.test_ten()
+    print(' ')
+
+    tests.test_eleven()
+    print(' ')
+
+    tests.test_twelve()
+    print(' ')
+
+    tests.test_thirteen()
+    print(' ')
+
+    tests.test_fourteen()
+    print(' ')
+
+    tests.test_fifteen()
+    print(' ')
+
+    tests.test_sixteen()
+    print(' ')
+
+    tests.test_seventeen()
+    print(' ')
+
+    tests.test_eighteen()
+    print(' ')
+
+    tests.test_nineteen()
+    print(' ')
+
+    tests.test_twenty()
+    print(' ')
+
+    tests.test_twenty_one()
+    print(' ')
+
+    tests.test_twenty_two()
+    print(' ')
+
+    tests.test_twenty_three()
+    print(' ')
+
+    tests.test_twenty_four()
+    print(' ')
+
+    tests.test_twenty_five()
+    print(' ')
+
+    tests.test_twenty_six()
+    print(' ')
+
+    tests.test_twenty_seven()
+    print(' ')
+
+    tests.test_twenty_eight()
+    print(' ')
+
+    tests.test_twenty_nine()
+    print(' ')
+
+    tests.test_thirty()
+    print(' ')
+
+    tests.test_thirty_one()
+    print(' ')
+
+    tests.test_thirty_two()
+    print(' ')
+
     print("Tests passed: ", tests.passed)
     print("Tests failed: ", tests.failed)
@@ -0,0 +1,236 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Trace:
+    """
+    Timings and counters collected while answering one query. Spans are kept in the order
+    they started, with their nesting depth, so the breakdown reads top to bottom
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.spans = []  # [name, depth, seconds]
+        self.counters = {}
+        self.total = None
+        self.depth = 0
+
+    def format(self):
+        """
+        Formats the breakdown for display
+
+        returns: a multi-line string with each stage in milliseconds, then the counters
+        """
+        lines = ["%s" % self.query]
+        for name, depth, seconds in self.spans:
+            label = "  " * (depth + 1) + name
+            lines.append("%-24s %10.3f ms" % (label, (seconds or 0) * 1000))
+        if self.total is not None:
+            lines.append("%-24s %10.3f ms" % ("  total", self.total * 1000))
+        for name, value in self.counters.items():
+            lines.append("  %s: %d" % (name, value))
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {
+            "query": self.query,
+            "spans": [{"name": name, "depth": depth, "ms": round((seconds or 0) * 1000, 3)}
+                      for name, depth, seconds in self.spans],
+            "counters": dict(self.counters),
+            "total_ms": round(self.total * 1000, 3) if self.total is not None else None,
+        }
+
+
+class TraceExporter:
+    """
+    Receives every finished trace. Subclasses decide where the timings go
+    """
+
+    def export(self, trace):
+        raise NotImplementedError
+
+
+class TextExporter(TraceExporter):
+    """
+    Writes a readable breakdown of each query to a stream (stderr for --profile)
+    """
+
+    def __init__(self, out):
+        self.out = out
+
+    def export(self, trace):
+        self.out.write(trace.format() + "\n")
+
+
+class JsonLinesExporter(TraceExporter):
+    """
+    Writes one JSON object per query, for log shippers and scripts
+    """
+
+    def __init__(self, out):
+        self.out = out
+
+    def export(self, trace):
+        self.out.write(json.dumps(trace.to_dict()) + "\n")
+
+
+class MetricsExporter(TraceExporter):
+    """
+    Aggregates traces into per-stage totals and counter sums, e.g. for a metrics endpoint
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.stages = {}  # name -> [calls, seconds]
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def export(self, trace):
+        with self._lock:
+            self.queries += 1
+            for name, _, seconds in trace.spans:
+                stage = self.stages.setdefault(name, [0, 0.0])
+                stage[0] += 1
+                stage[1] += seconds or 0
+            for name, value in trace.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def hit_rate(self, cache):
+        """
+        Computes the hit rate of a cache from the aggregated counters
+
+        params: cache - the counter prefix, e.g. "result_cache"
+        returns: the fraction of lookups that hit, or None if there were none
+        """
+        hits = self.counters.get(cache + "_hits", 0)
+        lookups = hits + self.counters.get(cache + "_misses", 0)
+        return hits / lookups if lookups else None
+
+    def summary(self):
+        """
+        Summarizes every query exported so far
+
+        returns: a dictionary of query count, per-stage calls and milliseconds, counters and cache hit rates
+        """
+        with self._lock:
+            return {
+                "queries": self.queries,
+                "stages": {name: {"calls": calls, "ms": round(seconds * 1000, 3)}
+                           for name, (calls, seconds) in self.stages.items()},
+                "counters": dict(self.counters),
+                "parse_cache_hit_rate": self.hit_rate("parse_cache"),
+                "result_cache_hit_rate": self.hit_rate("result_cache"),
+            }
+
+
+class NullSpan:
+    """
+    Context manager that does nothing, shared by every disabled span
+    """
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class NullTracer:
+    """
+    Tracer used when profiling is off. Every call returns immediately without allocating,
+    so instrumented code costs one method call per stage
+    """
+    enabled = False
+
+    def trace(self, query):
+        return NULL_SPAN
+
+    def span(self, name):
+        return NULL_SPAN
+
+    def count(self, name, value=1):
+        pass
+
+    def current(self):
+        return None
+
+
+NULL_TRACER = NullTracer()
+
+
+class Tracer:
+    """
+    Times the stages of each query and counts document reads and cache hits. A trace is
+    started per query and belongs to the thread that started it; spans and counts outside
+    a trace are ignored. Finished traces are handed to every exporter
+    """
+    enabled = True
+
+    def __init__(self, exporters=()):
+        self.exporters = list(exporters)
+        self._local = threading.local()
+
+    def current(self):
+        """
+        Returns the trace being collected on this thread
+
+        returns: the Trace, or None outside a trace
+        """
+        return getattr(self._local, "trace", None)
+
+    @contextmanager
+    def trace(self, query):
+        """
+        Collects a trace for one query and exports it when the query finishes
+
+        params: query - the query text, used to label the trace
+        returns: a context manager yielding the Trace
+        """
+        trace = Trace(query)
+        self._local.trace = trace
+        start = time.perf_counter()
+        try:
+            yield trace
+        finally:
+            trace.total = time.perf_counter() - start
+            self._local.trace = None
+            for exporter in self.exporters:
+                exporter.export(trace)
+
+    @contextmanager
+    def span(self, name):
+        """
+        Times a stage of the current query. Spans started inside another span are nested under it
+
+        params: name - the stage name
+        returns: a context manager
+        """
+        trace = self.current()
+        if trace is None:
+            yield
+            return
+        entry = [name, trace.depth, None]
+        trace.spans.append(entry)
+        trace.depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry[2] = time.perf_counter() - start
+            trace.depth -= 1
+
+    def count(self, name, value=1):
+        """
+        Adds to a counter of the current query
+
+        params: name - the counter name, e.g. "documents_read"
+                value - the amount to add
+        """
+        trace = self.current()
+        if trace is not None:
+            trace.counters[name] = trace.counters.get(name, 0) + value